@@ -1,9 +1,37 @@
-from flask import Flask, request, jsonify
+from flask import Flask, g, request, jsonify
 import requests
 import io
 import os
 import json
+import multiprocessing
+import time
+import base64
+import codecs
+import atexit
+import contextlib
+import contextvars
+import logging
+import logging.handlers
+import queue
+import sys
+import hashlib
+import hmac
+import importlib.util
+import math
+import sqlite3
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeout
+from urllib.parse import urlparse
+import openai
 from openai import OpenAI
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
 
 app = Flask(__name__)
 
@@ -13,9 +41,1334 @@ client = None
 def get_openai_client():
     global client
     if client is None:
-        client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+        # As retentativas ficam com o openai_scheduler, que conhece os limites
+        client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'), max_retries=0)
     return client
 
+# ==================== MÉTRICAS E LOGS ====================
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# json (uma linha por evento, para agregadores de log) ou text
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()
+# Com várias instâncias (gunicorn/uvicorn --workers), aponte para um diretório
+# vazio a cada deploy para que o /metrics some os valores de todos os processos
+PROMETHEUS_MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120)
+
+# Tipo de mensagem implícito nos endpoints que só aceitam um tipo
+ENDPOINT_MESSAGE_TYPES = {'transcribe': 'audio', 'analyze_image': 'image', 'extract_document': 'document'}
+MESSAGE_TYPES = {'text', 'location', 'audio', 'image', 'document', 'video'}
+
+REQUEST_SECONDS = Histogram(
+    'twilio_whisper_request_duration_seconds', 'Duração das requisições',
+    ['endpoint', 'message_type', 'status'], buckets=LATENCY_BUCKETS
+)
+STAGE_SECONDS = Histogram(
+    'twilio_whisper_stage_duration_seconds',
+    'Duração de cada etapa: download, preprocess, extraction, openai_queue, openai, chatwoot, chatwoot_attachment',
+    ['stage', 'endpoint', 'message_type', 'model'], buckets=LATENCY_BUCKETS
+)
+DOWNLOADED_BYTES = Counter(
+    'twilio_whisper_downloaded_bytes', 'Bytes de mídia baixados do Twilio', ['endpoint', 'message_type']
+)
+OPENAI_TOKENS = Counter(
+    'twilio_whisper_openai_tokens', 'Tokens usados na OpenAI (prompt/completion)',
+    ['endpoint', 'message_type', 'model', 'kind']
+)
+
+# Endpoint, tipo de mensagem e id da requisição atual, usados nos rótulos e nos logs
+request_context = contextvars.ContextVar('request_context', default=None)
+
+def begin_request(endpoint, request_id=None):
+    """Abre o contexto da requisição (ou job). Retorna o token para request_context.reset."""
+    return request_context.set({
+        'request_id': request_id or uuid.uuid4().hex[:16],
+        'endpoint': endpoint,
+        'message_type': ENDPOINT_MESSAGE_TYPES.get(endpoint, ''),
+    })
+
+def set_message_type(message_type):
+    context = request_context.get()
+    if context is not None:
+        # Valores fora da lista viram 'other', para não criar séries sem fim
+        context['message_type'] = message_type if message_type in MESSAGE_TYPES else 'other'
+
+def _request_labels():
+    context = request_context.get() or {}
+    return context.get('endpoint', ''), context.get('message_type', '')
+
+def with_request_context(fn):
+    """Leva a conta e os rótulos da requisição atual para tarefas executadas em outras threads."""
+    context = contextvars.copy_context()
+
+    def run(*args):
+        return context.copy().run(fn, *args)
+    return run
+
+@contextlib.contextmanager
+def timed(stage, model=''):
+    """Mede a etapa no histograma STAGE_SECONDS, com os rótulos da requisição atual."""
+    endpoint, message_type = _request_labels()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage, endpoint, message_type, model).observe(time.perf_counter() - started)
+
+def observe_request(status, seconds):
+    endpoint, message_type = _request_labels()
+    REQUEST_SECONDS.labels(endpoint, message_type, str(status)).observe(seconds)
+
+def count_downloaded(size):
+    if size:
+        DOWNLOADED_BYTES.labels(*_request_labels()).inc(size)
+
+def count_tokens(model, usage):
+    endpoint, message_type = _request_labels()
+    for kind in ('prompt', 'completion'):
+        tokens = getattr(usage, f'{kind}_tokens', None)
+        if tokens:
+            OPENAI_TOKENS.labels(endpoint, message_type, model, kind).inc(tokens)
+
+def metrics_payload():
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest()
+
+# Atributos padrão do LogRecord; o resto veio do contexto ou de extra={...}
+_LOG_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+class JsonFormatter(logging.Formatter):
+    """Uma linha JSON por evento, com os campos passados em extra={...}."""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname.lower(),
+            'msg': record.getMessage(),
+        }
+        for field, value in vars(record).items():
+            if field not in _LOG_RECORD_ATTRS and value not in (None, ''):
+                entry[field] = value
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class _ContextFilter(logging.Filter):
+    """Copia o contexto da requisição para o registro ainda na thread que gerou o log."""
+
+    def filter(self, record):
+        context = request_context.get() or {}
+        record.request_id = context.get('request_id')
+        record.endpoint = context.get('endpoint')
+        record.message_type = context.get('message_type')
+        record.tenant = openai_tenant.get()
+        return True
+
+def setup_logging():
+    """Logs nunca bloqueiam a requisição: vão para uma fila escrita por uma thread própria."""
+    handler = logging.StreamHandler(sys.stderr)
+    if LOG_FORMAT == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(request_id)s] %(message)s'))
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    # Em fork (gunicorn --preload) a thread não vai junto para o processo filho
+    os.register_at_fork(after_in_child=listener.start)
+
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(_ContextFilter())
+    logger = logging.getLogger('twilio_whisper')
+    logger.addHandler(queue_handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+    return logger
+
+log = setup_logging()
+
+# ==================== TRANSPORTE HTTP ====================
+
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 5))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 30))
+# Conexões mantidas abertas por host (Twilio, Chatwoot, ...)
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 10))
+HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', 2))
+HTTP_BACKOFF = float(os.getenv('HTTP_BACKOFF', 0.5))
+TWILIO_ACCOUNT_SID = os.getenv('TWILIO_ACCOUNT_SID')
+TWILIO_AUTH_TOKEN = os.getenv('TWILIO_AUTH_TOKEN')
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+http_session = requests.Session()
+_http_adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+http_session.mount('https://', _http_adapter)
+http_session.mount('http://', _http_adapter)
+
+def _retry_delay(attempt, response=None):
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), 30.0)
+        except ValueError:
+            pass
+    return HTTP_BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+def http_request(method, url, **kwargs):
+    """Faz a requisição pela sessão compartilhada, com timeout e retentativas.
+
+    GET é repetido em erros de conexão, 429 e 5xx. POST só é repetido em 429
+    ou se a conexão nem chegou a ser aberta, para não duplicar mensagens.
+    """
+    kwargs.setdefault('timeout', (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    idempotent = method.upper() in ('GET', 'HEAD')
+
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        last_attempt = attempt == HTTP_MAX_RETRIES
+        if hasattr(kwargs.get('data'), 'seek'):
+            # Corpo em stream (upload de anexo) volta ao início a cada tentativa
+            kwargs['data'].seek(0)
+        try:
+            response = http_session.request(method, url, **kwargs)
+        except requests.exceptions.ConnectTimeout:
+            if last_attempt:
+                raise
+            time.sleep(_retry_delay(attempt))
+            continue
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if last_attempt or not idempotent:
+                raise
+            time.sleep(_retry_delay(attempt))
+            continue
+
+        retryable = response.status_code == 429 or (idempotent and response.status_code in RETRY_STATUSES)
+        if not retryable or last_attempt:
+            return response
+        delay = _retry_delay(attempt, response)
+        log.warning("Status %s em %s, nova tentativa em %.1fs", response.status_code, urlparse(url).netloc, delay,
+                    extra={'status': response.status_code, 'host': urlparse(url).netloc, 'delay': round(delay, 2)})
+        response.close()
+        time.sleep(delay)
+
+def download_media(url, **kwargs):
+    auth = None
+    if TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN and urlparse(url).netloc.endswith('twilio.com'):
+        auth = (TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+    return http_request('GET', url, auth=auth, **kwargs)
+
+# ==================== DOWNLOAD DE MÍDIA ====================
+
+# Tamanho máximo aceito para mídias (padrão: 25 MB, limite do Whisper)
+MEDIA_MAX_BYTES = int(os.getenv('MEDIA_MAX_BYTES', 25 * 1024 * 1024))
+# Limite da Whisper API para um arquivo enviado inteiro
+WHISPER_MAX_BYTES = 25 * 1024 * 1024
+# Acima desse tamanho a mídia vai para um arquivo temporário em disco
+MEDIA_SPOOL_BYTES = int(os.getenv('MEDIA_SPOOL_BYTES', 1024 * 1024))
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+class MediaTooLarge(Exception):
+    def __init__(self, limit):
+        super().__init__(f'Arquivo excede o limite de {limit / (1024 * 1024):g} MB')
+
+class AudioTooLong(MediaTooLarge):
+    def __init__(self, seconds):
+        Exception.__init__(self, f'Áudio excede o limite de {seconds / 60:g} minutos')
+
+class Media:
+    """Mídia baixada do Twilio.
+
+    O conteúdo fica em um SpooledTemporaryFile (em memória até
+    MEDIA_SPOOL_BYTES, em disco acima disso) e o hash é calculado durante o
+    download, então ninguém precisa manter uma cópia inteira em bytes.
+    """
+
+    def __init__(self, status_code, content_type, max_bytes=MEDIA_MAX_BYTES):
+        self.status_code = status_code
+        self.content_type = content_type
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.file = tempfile.SpooledTemporaryFile(max_size=MEDIA_SPOOL_BYTES)
+        self._hash = hashlib.sha256()
+
+    def check_length(self, content_length):
+        if content_length and content_length.isdigit() and int(content_length) > self.max_bytes:
+            raise MediaTooLarge(self.max_bytes)
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise MediaTooLarge(self.max_bytes)
+        self._hash.update(chunk)
+        self.file.write(chunk)
+
+    @property
+    def sha256(self):
+        return self._hash.hexdigest()
+
+    def stream(self):
+        self.file.seek(0)
+        return self.file
+
+    def read(self):
+        return self.stream().read()
+
+    def reader(self):
+        """Leitor com posição própria, para ler a mídia em duas threads ao mesmo tempo.
+
+        Deve ser criado antes de a mídia ser compartilhada entre threads.
+        """
+        if self.size <= MEDIA_SPOOL_BYTES:
+            return io.BytesIO(self.read())
+        return _PositionalReader(self.file.fileno(), self.size)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class _PositionalReader:
+    """Lê um arquivo com os.pread, sem mexer na posição compartilhada do descritor."""
+
+    def __init__(self, fd, size):
+        self.fd = fd
+        self.size = size
+        self.position = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.position
+        chunk = os.pread(self.fd, size, self.position)
+        self.position += len(chunk)
+        return chunk
+
+    def seek(self, offset, whence=0):
+        self.position = offset if whence == 0 else self.position + offset if whence == 1 else self.size + offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+def fetch_media(url, max_bytes=MEDIA_MAX_BYTES):
+    """Baixa a mídia em blocos, abortando assim que passar de max_bytes."""
+    log.debug("Baixando mídia de %s", url)
+    with timed('download'):
+        response = download_media(url, stream=True)
+        with response:
+            media = Media(response.status_code, response.headers.get('Content-Type'), max_bytes)
+            if response.status_code != 200:
+                return media
+            try:
+                media.check_length(response.headers.get('Content-Length'))
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    media.write(chunk)
+            except Exception:
+                media.close()
+                raise
+            finally:
+                count_downloaded(media.size)
+    return media
+
+# ==================== CACHE DE RESULTADOS ====================
+
+# Tamanho máximo (em bytes) do cache em memória de cada worker
+CACHE_MAX_BYTES = int(os.getenv('CACHE_MAX_BYTES', 32 * 1024 * 1024))
+# Tempo de vida dos resultados em segundos (padrão: 7 dias)
+CACHE_TTL = int(os.getenv('CACHE_TTL', 7 * 24 * 3600))
+# Caminho do SQLite compartilhado entre os workers do gunicorn (opcional)
+CACHE_DB_PATH = os.getenv('CACHE_DB_PATH')
+# Intervalo entre as limpezas de registros vencidos nas tabelas SQLite
+# (cache, conversas, idempotência), em vez de uma limpeza a cada gravação
+SQLITE_PURGE_SECONDS = 60
+
+class ResultCache:
+    """Cache de resultados da OpenAI indexado pelo hash da mídia.
+
+    Tem uma camada LRU em memória limitada por tamanho e, se db_path for
+    informado, uma camada em SQLite compartilhada entre os workers.
+    """
+
+    def __init__(self, max_bytes, ttl, db_path=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.db_path = db_path
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._next_purge = 0.0
+        if self.db_path:
+            db = self._db()
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS result_cache '
+                '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)'
+            )
+            db.execute('CREATE INDEX IF NOT EXISTS result_cache_expires ON result_cache (expires_at)')
+            db.commit()
+
+    @staticmethod
+    def make_key(media, model, prompt='', max_tokens=None):
+        # media pode ser o conteúdo em bytes ou o sha256 já calculado (Media.sha256)
+        media_hash = media if isinstance(media, str) else hashlib.sha256(media).hexdigest()
+        return hashlib.sha256(f"{media_hash}|{model}|{prompt}|{max_tokens}".encode('utf-8')).hexdigest()
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.db_path, timeout=5)
+            db.execute('PRAGMA journal_mode=WAL')
+            self._local.db = db
+        return db
+
+    def _remember(self, key, value, expires_at):
+        size = len(key) + len(value.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= old[2]
+            self._items[key] = (value, expires_at, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (_, _, evicted_size) = self._items.popitem(last=False)
+                self._size -= evicted_size
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                if item[1] > now:
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return item[0]
+                del self._items[key]
+                self._size -= item[2]
+
+        if self.db_path:
+            try:
+                row = self._db().execute(
+                    'SELECT value, expires_at FROM result_cache WHERE key = ? AND expires_at > ?',
+                    (key, now)
+                ).fetchone()
+            except sqlite3.Error as e:
+                log.error("Erro ao ler cache em disco: %s", e)
+                row = None
+            if row is not None:
+                self._remember(key, row[0], row[1])
+                with self._lock:
+                    self.disk_hits += 1
+                return row[0]
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, value):
+        expires_at = time.time() + self.ttl
+        self._remember(key, value, expires_at)
+        if self.db_path:
+            try:
+                db = self._db()
+                db.execute(
+                    'INSERT OR REPLACE INTO result_cache (key, value, expires_at) VALUES (?, ?, ?)',
+                    (key, value, expires_at)
+                )
+                now = time.time()
+                if now >= self._next_purge:
+                    self._next_purge = now + SQLITE_PURGE_SECONDS
+                    db.execute('DELETE FROM result_cache WHERE expires_at <= ?', (now,))
+                db.commit()
+            except sqlite3.Error as e:
+                log.error("Erro ao gravar cache em disco: %s", e)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'entries': len(self._items),
+                'bytes': self._size,
+            }
+
+result_cache = ResultCache(CACHE_MAX_BYTES, CACHE_TTL, CACHE_DB_PATH)
+
+# ==================== ÁUDIOS LONGOS ====================
+
+AUDIO_CHUNKING = os.getenv('AUDIO_CHUNKING', 'true').lower() in ('1', 'true', 'yes')
+# Áudios menores que isso vão inteiros para o Whisper, sem decodificar
+# (~2 minutos de áudio do WhatsApp)
+AUDIO_CHUNK_MIN_BYTES = int(os.getenv('AUDIO_CHUNK_MIN_BYTES', 256 * 1024))
+AUDIO_CHUNK_SECONDS = int(os.getenv('AUDIO_CHUNK_SECONDS', 120))
+AUDIO_CHUNK_OVERLAP_SECONDS = float(os.getenv('AUDIO_CHUNK_OVERLAP_SECONDS', 2))
+# Chamadas simultâneas ao Whisper para as partes de um áudio (por worker)
+AUDIO_CHUNK_WORKERS = int(os.getenv('AUDIO_CHUNK_WORKERS', 4))
+# Janela, antes do ponto de corte, em que procuramos um silêncio para cortar
+AUDIO_SILENCE_SEARCH_SECONDS = 15
+AUDIO_SILENCE_MIN_MS = 400
+
+# Com a divisão disponível (pydub + ffmpeg), áudios maiores que o limite do
+# Whisper podem ser baixados; os 25 MB valem só para o envio inteiro
+AUDIO_MAX_BYTES = int(os.getenv('AUDIO_MAX_BYTES', 50 * 1024 * 1024))
+# Duração máxima decodificada para divisão: o áudio vira PCM 16 kHz mono
+# (~115 MB por hora), então é isso que limita a memória do worker
+AUDIO_MAX_SECONDS = int(os.getenv('AUDIO_MAX_SECONDS', 3600))
+AUDIO_SAMPLE_RATE = 16000
+AUDIO_CHUNKING_AVAILABLE = (
+    AUDIO_CHUNKING
+    and importlib.util.find_spec('pydub') is not None
+    and shutil.which('ffmpeg') is not None
+)
+
+transcription_pool = ThreadPoolExecutor(max_workers=AUDIO_CHUNK_WORKERS, thread_name_prefix='whisper-chunk')
+
+def audio_max_bytes():
+    return max(AUDIO_MAX_BYTES, MEDIA_MAX_BYTES) if AUDIO_CHUNKING_AVAILABLE else MEDIA_MAX_BYTES
+
+def _wav_chunk(segment):
+    buffer = io.BytesIO()
+    segment.export(buffer, format='wav')
+    buffer.seek(0)
+    return buffer
+
+def _silence_cut(audio, start, target, silence_thresh):
+    from pydub import silence
+
+    window_start = max(start + 1000, target - AUDIO_SILENCE_SEARCH_SECONDS * 1000)
+    silences = silence.detect_silence(
+        audio[window_start:target],
+        min_silence_len=AUDIO_SILENCE_MIN_MS,
+        silence_thresh=silence_thresh,
+        seek_step=10
+    )
+    if not silences:
+        return target
+    # Corta no meio do último silêncio da janela, para aproveitar ao máximo a parte
+    silence_start, silence_end = silences[-1]
+    return window_start + (silence_start + silence_end) // 2
+
+def _decode_pcm(media, filename):
+    """Decodifica direto para PCM 16 kHz mono, parando logo depois de AUDIO_MAX_SECONDS.
+
+    O ffmpeg lê de um arquivo temporário (formatos como m4a precisam de seek) e
+    nunca produz o áudio na taxa original, que ocuparia várias vezes mais memória.
+    """
+    from pydub import AudioSegment
+
+    with tempfile.NamedTemporaryFile(suffix=os.path.splitext(filename)[1]) as audio_file:
+        shutil.copyfileobj(media.stream(), audio_file)
+        audio_file.flush()
+        result = subprocess.run(
+            ['ffmpeg', '-nostdin', '-v', 'error', '-i', audio_file.name, '-t', str(AUDIO_MAX_SECONDS + 1),
+             '-vn', '-ac', '1', '-ar', str(AUDIO_SAMPLE_RATE), '-f', 's16le', 'pipe:1'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True
+        )
+    if len(result.stdout) > AUDIO_MAX_SECONDS * AUDIO_SAMPLE_RATE * 2:
+        raise AudioTooLong(AUDIO_MAX_SECONDS)
+    return AudioSegment(data=result.stdout, sample_width=2, frame_rate=AUDIO_SAMPLE_RATE, channels=1)
+
+def _trailing_silence(audio, silence_thresh, step_ms=10):
+    # Mesmo resultado de detect_leading_silence(audio.reverse()), sem copiar o áudio inteiro
+    end = len(audio)
+    while end > 0 and audio[max(0, end - step_ms):end].dBFS < silence_thresh:
+        end -= step_ms
+    return len(audio) - max(0, end)
+
+def split_audio(media, filename='audio.ogg'):
+    """Remove o silêncio das pontas e divide áudios longos em partes WAV.
+
+    Os cortes são feitos em silêncios e cada parte começa
+    AUDIO_CHUNK_OVERLAP_SECONDS antes do corte, para não perder palavras.
+    Retorna None quando o áudio deve ir inteiro para o Whisper (curto,
+    pydub/ffmpeg indisponível ou formato não reconhecido) e levanta
+    AudioTooLong acima de AUDIO_MAX_SECONDS.
+    """
+    if media.size < AUDIO_CHUNK_MIN_BYTES or not AUDIO_CHUNKING_AVAILABLE:
+        return None
+    from pydub import silence
+
+    try:
+        audio = _decode_pcm(media, filename)
+    except subprocess.CalledProcessError as e:
+        log.warning("Não foi possível decodificar o áudio, enviando inteiro: %s", e.stderr.decode('utf-8', 'replace').strip())
+        return None
+
+    chunk_ms = AUDIO_CHUNK_SECONDS * 1000
+    if len(audio) <= chunk_ms or audio.dBFS == float('-inf'):
+        return None
+
+    # O áudio não é recortado: start/end delimitam a parte útil e cada parte
+    # é copiada só na hora de exportar
+    silence_thresh = audio.dBFS - 16
+    start = silence.detect_leading_silence(audio, silence_threshold=silence_thresh)
+    end = len(audio) - _trailing_silence(audio, silence_thresh)
+
+    cuts = []
+    position = start
+    while end - position > chunk_ms:
+        position = _silence_cut(audio, position, position + chunk_ms, silence_thresh)
+        cuts.append(position)
+    cuts.append(end)
+
+    overlap_ms = int(AUDIO_CHUNK_OVERLAP_SECONDS * 1000)
+    chunks = []
+    previous = start
+    for cut in cuts:
+        chunks.append(_wav_chunk(audio[max(start, previous - overlap_ms):cut]))
+        previous = cut
+    return chunks
+
+def _normalize_word(word):
+    return word.strip('.,;:!?…"\'()').lower()
+
+def stitch_transcripts(texts, max_overlap_words=30):
+    """Junta as transcrições das partes, removendo as palavras repetidas na sobreposição."""
+    words = []
+    for text in texts:
+        next_words = text.split()
+        if words and next_words:
+            tail = [_normalize_word(w) for w in words[-max_overlap_words:]]
+            head = [_normalize_word(w) for w in next_words[:max_overlap_words]]
+            # Exige pelo menos 2 palavras para não descartar repetições legítimas ("é é")
+            for size in range(min(len(tail), len(head)), 1, -1):
+                if tail[-size:] == head[:size]:
+                    next_words = next_words[size:]
+                    break
+        words.extend(next_words)
+    return ' '.join(words)
+
+# ==================== PRÉ-PROCESSAMENTO DE IMAGENS ====================
+
+IMAGE_PREPROCESS = os.getenv('IMAGE_PREPROCESS', 'true').lower() in ('1', 'true', 'yes')
+# Maior lado da imagem enviada para o modelo de visão
+IMAGE_MAX_DIMENSION = int(os.getenv('IMAGE_MAX_DIMENSION', 1536))
+IMAGE_FORMAT = os.getenv('IMAGE_FORMAT', 'JPEG').upper()
+IMAGE_QUALITY = int(os.getenv('IMAGE_QUALITY', 80))
+# Imagens que cabem nesse tamanho são enviadas com detail=low (custo fixo de tokens)
+IMAGE_LOW_DETAIL_MAX = 512
+
+PreparedImage = namedtuple('PreparedImage', 'stream content_type detail original_size size')
+
+def prepare_image(media, content_type):
+    """Reduz a imagem para IMAGE_MAX_DIMENSION e recodifica sem EXIF.
+
+    Se o Pillow não estiver instalado, a imagem não puder ser lida ou a versão
+    recodificada ficar maior, devolve a original.
+    """
+    original = PreparedImage(media.stream(), content_type, 'auto', media.size, media.size)
+    if not IMAGE_PREPROCESS:
+        return original
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return original
+
+    try:
+        with Image.open(media.stream()) as source:
+            # Aplica a rotação do EXIF antes de descartá-lo
+            image = ImageOps.exif_transpose(source)
+            image.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION))
+            if image.mode in ('RGBA', 'LA', 'P'):
+                image = image.convert('RGBA')
+                background = Image.new('RGB', image.size, 'white')
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+            elif image.mode != 'RGB':
+                image = image.convert('RGB')
+            buffer = io.BytesIO()
+            image.save(buffer, format=IMAGE_FORMAT, quality=IMAGE_QUALITY, optimize=True)
+    except Exception as e:
+        log.warning("Não foi possível pré-processar a imagem, enviando original: %s", e)
+        return original
+
+    detail = 'low' if max(image.size) <= IMAGE_LOW_DETAIL_MAX else 'high'
+    if buffer.tell() >= media.size:
+        return original._replace(stream=media.stream(), detail=detail)
+    size = buffer.tell()
+    buffer.seek(0)
+    return PreparedImage(buffer, f'image/{IMAGE_FORMAT.lower()}', detail, media.size, size)
+
+def log_image_savings(image):
+    if image.size < image.original_size:
+        saved = image.original_size - image.size
+        log.debug("Imagem reduzida de %s para %s bytes (%.0f%% menor, detail=%s)",
+                  image.original_size, image.size, 100 * saved / image.original_size, image.detail)
+
+# ==================== RESUMO DE DOCUMENTOS LONGOS ====================
+
+# Tamanho (em tokens) de cada trecho resumido separadamente
+SUMMARY_CHUNK_TOKENS = int(os.getenv('SUMMARY_CHUNK_TOKENS', 3000))
+SUMMARY_CHUNK_MAX_TOKENS = int(os.getenv('SUMMARY_CHUNK_MAX_TOKENS', 400))
+# Trechos resumidos ao mesmo tempo (por worker)
+SUMMARY_WORKERS = int(os.getenv('SUMMARY_WORKERS', 4))
+# Aproximação de caracteres por token para texto em português
+CHARS_PER_TOKEN = 4
+
+summary_pool = ThreadPoolExecutor(max_workers=SUMMARY_WORKERS, thread_name_prefix='summary-chunk')
+
+def split_text_chunks(text, max_tokens):
+    """Divide o texto em trechos de até max_tokens, cortando entre linhas sempre que possível."""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    chunks = []
+    current = []
+    current_size = 0
+    for line in text.splitlines():
+        if len(line) > max_chars and current:
+            # Fecha o trecho em andamento antes de cortar a linha longa, para manter a ordem
+            chunks.append("\n".join(current))
+            current = []
+            current_size = 0
+        while len(line) > max_chars:
+            chunks.append(line[:max_chars])
+            line = line[max_chars:]
+        if current_size + len(line) + 1 > max_chars and current:
+            chunks.append("\n".join(current))
+            current = []
+            current_size = 0
+        current.append(line)
+        current_size += len(line) + 1
+    if current and any(part.strip() for part in current):
+        chunks.append("\n".join(current))
+    return chunks
+
+def group_summaries(summaries):
+    """Agrupa resumos parciais para que cada redução caiba em SUMMARY_CHUNK_TOKENS.
+
+    Cada grupo tem pelo menos dois resumos, então as rodadas de redução sempre
+    terminam.
+    """
+    max_chars = SUMMARY_CHUNK_TOKENS * CHARS_PER_TOKEN
+    groups = [[]]
+    size = 0
+    for summary in summaries:
+        if len(groups[-1]) >= 2 and size + len(summary) > max_chars:
+            groups.append([])
+            size = 0
+        groups[-1].append(summary)
+        size += len(summary)
+    return groups
+
+# ==================== AGENDADOR DA OPENAI ====================
+
+# Limites por modelo (requisições e tokens por minuto). Os valores reais são
+# lidos dos headers x-ratelimit-* de cada resposta e substituem estes.
+OPENAI_RATE_LIMITS = {
+    'gpt-4.1-mini': {'rpm': 500, 'tpm': 200000},
+    'whisper-1': {'rpm': 500},
+    **json.loads(os.getenv('OPENAI_RATE_LIMITS', '{}'))
+}
+# Chamadas esperando por modelo, no total e por conta do Chatwoot; acima
+# disso (ou de OPENAI_MAX_QUEUE_SECONDS de espera estimada) a API responde 503
+OPENAI_QUEUE_MAX = int(os.getenv('OPENAI_QUEUE_MAX', 256))
+OPENAI_TENANT_QUEUE_MAX = int(os.getenv('OPENAI_TENANT_QUEUE_MAX', 64))
+OPENAI_MAX_QUEUE_SECONDS = float(os.getenv('OPENAI_MAX_QUEUE_SECONDS', 30))
+# Retentativas em 429, 5xx e erros de conexão
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', 3))
+
+# Tokens contados pela OpenAI para uma imagem em detail=low e (aproximadamente)
+# para as imagens de até IMAGE_MAX_DIMENSION em detail=auto/high
+IMAGE_LOW_DETAIL_TOKENS = 85
+IMAGE_HIGH_DETAIL_TOKENS = 765
+
+# Conta do Chatwoot da requisição atual, usada para dividir a fila com justiça
+openai_tenant = contextvars.ContextVar('openai_tenant', default='')
+
+class OpenAIOverloaded(Exception):
+    def __init__(self, retry_after):
+        self.retry_after = max(1, math.ceil(retry_after))
+        super().__init__(f'Serviço sobrecarregado, tente novamente em {self.retry_after}s')
+
+def estimate_tokens(messages, max_tokens):
+    """Tokens que a OpenAI desconta do limite por minuto: entrada estimada + max_tokens."""
+    total = max_tokens
+    for message in messages:
+        content = message['content']
+        if isinstance(content, str):
+            total += len(content) // CHARS_PER_TOKEN
+            continue
+        for part in content:
+            if part['type'] == 'text':
+                total += len(part['text']) // CHARS_PER_TOKEN
+            elif part['image_url'].get('detail') == 'low':
+                total += IMAGE_LOW_DETAIL_TOKENS
+            else:
+                total += IMAGE_HIGH_DETAIL_TOKENS
+    return total
+
+def _reset_seconds(value):
+    """Converte os tempos dos headers da OpenAI ('1s', '6m0s', '120ms') em segundos."""
+    seconds = 0.0
+    number = ''
+    i = 0
+    while i < len(value or ''):
+        char = value[i]
+        if char.isdigit() or char == '.':
+            number += char
+        elif value.startswith('ms', i):
+            seconds += float(number or 0) / 1000
+            number = ''
+            i += 1
+        else:
+            seconds += float(number or 0) * {'h': 3600, 'm': 60, 's': 1}.get(char, 0)
+            number = ''
+        i += 1
+    return seconds
+
+class TokenBucket:
+    """Balde com capacidade de um minuto de limite, reabastecido continuamente."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        self._refill(now)
+        # Uma chamada maior que o balde inteiro espera só até ele encher
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing * 60 / self.capacity)
+
+    def take(self, amount, now):
+        self._refill(now)
+        self.level -= amount
+
+    def give_back(self, amount, now):
+        self._refill(now)
+        self.level = min(self.capacity, self.level + amount)
+
+    def sync(self, limit, remaining, now):
+        self._refill(now)
+        self.capacity = float(limit)
+        self.level = float(remaining)
+
+class _Waiter:
+    def __init__(self, tenant, tokens):
+        self.tenant = tenant
+        self.tokens = tokens
+
+class ModelLane:
+    """Limites e fila de espera de um modelo, com uma fila por conta em rodízio."""
+
+    def __init__(self, limits):
+        self.requests = TokenBucket(limits['rpm'])
+        self.tokens = TokenBucket(limits['tpm']) if limits.get('tpm') else None
+        self.queues = OrderedDict()
+        self.queued_tokens = 0
+        self.blocked_until = 0.0
+
+    @property
+    def waiting(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def estimated_wait(self, now):
+        wait = max(0.0, self.blocked_until - now, self.requests.wait_time(self.waiting + 1, now))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(self.queued_tokens, now))
+        return wait
+
+    def check_admission(self, tenant, now):
+        if self.waiting >= OPENAI_QUEUE_MAX or len(self.queues.get(tenant, ())) >= OPENAI_TENANT_QUEUE_MAX:
+            raise OpenAIOverloaded(self.estimated_wait(now))
+        wait = self.estimated_wait(now)
+        if wait > OPENAI_MAX_QUEUE_SECONDS:
+            raise OpenAIOverloaded(wait)
+
+    def enqueue(self, waiter):
+        self.queues.setdefault(waiter.tenant, deque()).append(waiter)
+        self.queued_tokens += waiter.tokens
+
+    def discard(self, waiter):
+        """Tira da fila quem desistiu de esperar (timeout, cliente desconectou)."""
+        queue = self.queues.get(waiter.tenant)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            self.queued_tokens -= waiter.tokens
+            if not queue:
+                del self.queues[waiter.tenant]
+
+    def head(self):
+        # A primeira conta da ordem é a próxima a ser atendida
+        return self.queues[next(iter(self.queues))][0] if self.queues else None
+
+    def wait_time(self, waiter, now):
+        wait = max(0.0, self.blocked_until - now, self.requests.wait_time(1, now))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(waiter.tokens, now))
+        return wait
+
+    def grant(self, waiter, now):
+        queue = self.queues.pop(waiter.tenant)
+        queue.popleft()
+        if queue:
+            # Volta para o fim do rodízio
+            self.queues[waiter.tenant] = queue
+        self.queued_tokens -= waiter.tokens
+        self.requests.take(1, now)
+        if self.tokens is not None:
+            self.tokens.take(waiter.tokens, now)
+
+    def observe(self, headers, estimated_tokens, used_tokens, now):
+        """Ajusta os baldes com os headers x-ratelimit-* e o uso real da chamada."""
+        if headers.get('x-ratelimit-limit-requests') and headers.get('x-ratelimit-remaining-requests'):
+            self.requests.sync(int(headers['x-ratelimit-limit-requests']), int(headers['x-ratelimit-remaining-requests']), now)
+        if self.tokens is not None:
+            if headers.get('x-ratelimit-limit-tokens') and headers.get('x-ratelimit-remaining-tokens'):
+                self.tokens.sync(int(headers['x-ratelimit-limit-tokens']), int(headers['x-ratelimit-remaining-tokens']), now)
+            elif used_tokens is not None:
+                self.tokens.give_back(estimated_tokens - used_tokens, now)
+
+    def penalize(self, headers, attempt, now):
+        """Depois de um 429: ninguém chama este modelo até o limite liberar."""
+        delay = None
+        if headers.get('retry-after-ms'):
+            delay = float(headers['retry-after-ms']) / 1000
+        elif headers.get('retry-after'):
+            delay = float(headers['retry-after'])
+        else:
+            resets = [_reset_seconds(headers.get(name)) for name in ('x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens')]
+            delay = max(resets) or None
+        if delay is None:
+            delay = _retry_delay(attempt)
+        self.blocked_until = max(self.blocked_until, now + min(delay, 60.0))
+        return delay
+
+class OpenAIScheduler:
+    """Ponto único de saída das chamadas à OpenAI.
+
+    Cada modelo tem baldes de requisições e de tokens por minuto, ajustados
+    pelos headers de cada resposta. Quem não cabe no limite espera numa fila
+    por conta do Chatwoot, atendidas em rodízio para que uma conta movimentada
+    não ocupe a cota inteira. 429, 5xx e erros de conexão são repetidos com
+    backoff. A admissão (admit) é feita na chegada da requisição, para recusar
+    com 503 antes de baixar mídia ou enviar qualquer coisa ao Chatwoot.
+    """
+
+    def __init__(self, rate_limits):
+        self.rate_limits = rate_limits
+        self.lanes = {}
+        self._cond = threading.Condition()
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """callback() é chamado, com o lock, sempre que uma fila ou um limite muda.
+
+        É assim que o agendador do event loop (asgi.py), que usa as mesmas
+        filas e baldes, acorda quem está esperando do lado dele.
+        """
+        self._listeners.append(callback)
+
+    def _notify(self):
+        self._cond.notify_all()
+        for callback in self._listeners:
+            callback()
+
+    def lane(self, model):
+        lane = self.lanes.get(model)
+        if lane is None:
+            lane = self.lanes[model] = ModelLane(self.rate_limits.get(model, {'rpm': 500}))
+        return lane
+
+    def _check_admission(self, models, tenant):
+        now = time.monotonic()
+        for model in models:
+            self.lane(model).check_admission(tenant, now)
+
+    def admit(self, models, tenant=''):
+        """Levanta OpenAIOverloaded se a fila de algum dos modelos estiver cheia."""
+        with self._cond:
+            self._check_admission(models, tenant)
+
+    def _acquire(self, lane, waiter):
+        with self._cond:
+            lane.enqueue(waiter)
+            try:
+                while True:
+                    delay = None
+                    if lane.head() is waiter:
+                        now = time.monotonic()
+                        delay = lane.wait_time(waiter, now)
+                        if delay <= 0:
+                            lane.grant(waiter, now)
+                            return
+                    self._cond.wait(delay)
+            except BaseException:
+                lane.discard(waiter)
+                raise
+            finally:
+                self._notify()
+
+    def _observe(self, lane, model, headers, estimated_tokens, result):
+        usage = getattr(result, 'usage', None)
+        count_tokens(model, usage)
+        used_tokens = getattr(usage, 'total_tokens', None)
+        with self._cond:
+            lane.observe(headers, estimated_tokens, used_tokens, time.monotonic())
+
+    def _penalize(self, lane, headers, attempt):
+        with self._cond:
+            delay = lane.penalize(headers, attempt, time.monotonic())
+            self._notify()
+        return delay
+
+    def call(self, tokens, create, **kwargs):
+        """Chama create(**kwargs) (um método with_raw_response do SDK) respeitando os limites do modelo."""
+        model = kwargs['model']
+        lane = self.lane(model)
+        for attempt in range(OPENAI_MAX_RETRIES + 1):
+            last_attempt = attempt == OPENAI_MAX_RETRIES
+            rewind_upload(kwargs)
+            with timed('openai_queue', model):
+                self._acquire(lane, _Waiter(openai_tenant.get(), tokens))
+            try:
+                with timed('openai', model):
+                    raw = create(**kwargs)
+            except openai.RateLimitError as e:
+                if getattr(e, 'code', None) == 'insufficient_quota':
+                    raise
+                delay = self._penalize(lane, e.response.headers, attempt)
+                log.warning("OpenAI 429 em %s, nova tentativa em %.1fs", model, delay, extra={'model': model, 'delay': round(delay, 2)})
+                if last_attempt:
+                    raise OpenAIOverloaded(delay)
+                continue
+            except (openai.InternalServerError, openai.APIConnectionError) as e:
+                if last_attempt:
+                    raise
+                delay = _retry_delay(attempt, getattr(e, 'response', None))
+                log.warning("Erro da OpenAI em %s (%s), nova tentativa em %.1fs", model, type(e).__name__, delay,
+                            extra={'model': model, 'delay': round(delay, 2)})
+                time.sleep(delay)
+                continue
+
+            result = raw.parse()
+            self._observe(lane, model, raw.headers, tokens, result)
+            return result
+
+def rewind_upload(kwargs):
+    # Arquivo enviado ao Whisper volta ao início a cada tentativa
+    upload = kwargs.get('file')
+    if isinstance(upload, tuple) and hasattr(upload[1], 'seek'):
+        upload[1].seek(0)
+
+openai_scheduler = OpenAIScheduler(OPENAI_RATE_LIMITS)
+
+# Modelo chamado por cada tipo de mensagem do process-and-send
+MESSAGE_MODELS = {
+    'audio': ['whisper-1'],
+    'image': ['gpt-4.1-mini'],
+}
+
+def overloaded_response(e):
+    response = jsonify({'success': False, 'error': str(e)})
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 503
+
+# ==================== FUNÇÕES AUXILIARES OPENAI ====================
+
+def transcribe_audio(media, filename='audio.ogg'):
+    key = result_cache.make_key(media.sha256, 'whisper-1')
+    cached = result_cache.get(key)
+    if cached is not None:
+        return cached
+
+    with timed('preprocess', 'whisper-1'):
+        chunks = split_audio(media, filename) if AUDIO_CHUNKING else None
+    if chunks:
+        log.info("Transcrevendo áudio em %s partes", len(chunks))
+        text = stitch_transcripts(transcription_pool.map(with_request_context(lambda chunk: _whisper(('chunk.wav', chunk))), chunks))
+    else:
+        if media.size > WHISPER_MAX_BYTES:
+            raise MediaTooLarge(WHISPER_MAX_BYTES)
+        text = _whisper((filename, media.stream()))
+    result_cache.set(key, text)
+    return text
+
+def _whisper(file):
+    openai_client = get_openai_client()
+    return openai_scheduler.call(
+        0, openai_client.audio.transcriptions.with_raw_response.create, model="whisper-1", file=file
+    ).text
+
+def image_data_url(stream, content_type):
+    # Codifica em blocos múltiplos de 3 bytes direto no buffer da URL, sem
+    # carregar a imagem inteira nem criar cópias intermediárias em base64
+    data_url = bytearray(f"data:{content_type};base64,".encode('ascii'))
+    while True:
+        chunk = stream.read(3 * DOWNLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        data_url += base64.b64encode(chunk)
+    return data_url.decode('ascii')
+
+def image_messages(data_url, prompt, detail='auto'):
+    return [{
+        "role": "user",
+        "content": [
+            {"type": "text", "text": prompt},
+            {"type": "image_url", "image_url": {"url": data_url, "detail": detail}}
+        ]
+    }]
+
+def prepare_image_messages(media, content_type, prompt):
+    """Reduz a imagem e monta as mensagens com a data URL (CPU e disco: fora do event loop no ASGI)."""
+    image = prepare_image(media, content_type)
+    return image, image_messages(image_data_url(image.stream, image.content_type), prompt, image.detail)
+
+def document_analysis_prompt(text):
+    return f"Analise e resuma o seguinte documento:\n\n{text}"
+
+def chunk_summary_prompt(text):
+    # Sem número da parte no prompt, para que o cache de cada trecho continue
+    # valendo quando o documento é reanalisado com partes a mais ou a menos
+    return (
+        "Resuma o trecho de documento abaixo, preservando valores, datas, nomes, "
+        f"itens e conclusões importantes:\n\n{text}"
+    )
+
+def reduce_summary_prompt(summaries):
+    parts = "\n\n".join(f"Parte {i}:\n{summary}" for i, summary in enumerate(summaries, 1))
+    return (
+        "Os textos abaixo são resumos, em ordem, de partes consecutivas de um mesmo documento. "
+        f"Com base neles, analise e resuma o documento completo:\n\n{parts}"
+    )
+
+def image_cache_key(media, prompt, max_tokens):
+    # A resposta depende da imagem enviada ao modelo: mudar o pré-processamento invalida o cache
+    settings = f'{IMAGE_PREPROCESS}|{IMAGE_MAX_DIMENSION}|{IMAGE_FORMAT}|{IMAGE_QUALITY}|{IMAGE_LOW_DETAIL_MAX}'
+    return result_cache.make_key(media.sha256, f'gpt-4.1-mini|{settings}', prompt, max_tokens)
+
+def describe_image(media, content_type, prompt='Descreva esta imagem em detalhes.', max_tokens=1000):
+    key = image_cache_key(media, prompt, max_tokens)
+    cached = result_cache.get(key)
+    if cached is not None:
+        return cached
+
+    with timed('preprocess', 'gpt-4.1-mini'):
+        image, messages = prepare_image_messages(media, content_type, prompt)
+    log_image_savings(image)
+    openai_client = get_openai_client()
+    response = openai_scheduler.call(
+        estimate_tokens(messages, max_tokens), openai_client.chat.completions.with_raw_response.create,
+        model="gpt-4.1-mini",
+        messages=messages,
+        max_tokens=max_tokens
+    )
+    analysis = response.choices[0].message.content
+    result_cache.set(key, analysis)
+    return analysis
+
+def complete_text(prompt, max_tokens=1000):
+    key = result_cache.make_key(prompt.encode('utf-8'), 'gpt-4.1-mini', max_tokens=max_tokens)
+    cached = result_cache.get(key)
+    if cached is not None:
+        return cached
+
+    messages = [{"role": "user", "content": prompt}]
+    openai_client = get_openai_client()
+    response = openai_scheduler.call(
+        estimate_tokens(messages, max_tokens), openai_client.chat.completions.with_raw_response.create,
+        model="gpt-4.1-mini",
+        messages=messages,
+        max_tokens=max_tokens
+    )
+    analysis = response.choices[0].message.content
+    result_cache.set(key, analysis)
+    return analysis
+
+def analyze_document_text(text, max_tokens=1000):
+    """Resume o documento inteiro em map-reduce.
+
+    Documentos que cabem em um trecho são resumidos em uma chamada. Os demais
+    têm cada trecho resumido em paralelo (com cache por trecho) e os resumos
+    parciais são combinados na resposta final.
+    """
+    chunks = split_text_chunks(text, SUMMARY_CHUNK_TOKENS)
+    if len(chunks) <= 1:
+        return complete_text(document_analysis_prompt(text), max_tokens)
+
+    log.info("Resumindo documento em %s partes", len(chunks))
+    summaries = list(summary_pool.map(
+        with_request_context(lambda chunk: complete_text(chunk_summary_prompt(chunk), SUMMARY_CHUNK_MAX_TOKENS)), chunks
+    ))
+    groups = group_summaries(summaries)
+    while len(groups) > 1:
+        summaries = list(summary_pool.map(
+            with_request_context(lambda group: complete_text(reduce_summary_prompt(group), SUMMARY_CHUNK_MAX_TOKENS)), groups
+        ))
+        groups = group_summaries(summaries)
+    return complete_text(reduce_summary_prompt(groups[0]), max_tokens)
+
+# ==================== EXTRAÇÃO DE DOCUMENTOS ====================
+
+# Limite de caracteres extraídos; a extração para assim que ele é atingido
+DOCUMENT_MAX_CHARS = int(os.getenv('DOCUMENT_MAX_CHARS', 100000))
+DOCUMENT_MAX_PAGES = int(os.getenv('DOCUMENT_MAX_PAGES', 200))
+# PDFs com pelo menos essa quantidade de páginas são extraídos em paralelo;
+# os menores vão inteiros para um único worker do pool
+DOCUMENT_PARALLEL_MIN_PAGES = int(os.getenv('DOCUMENT_PARALLEL_MIN_PAGES', 16))
+DOCUMENT_WORKERS = int(os.getenv('DOCUMENT_WORKERS', min(4, os.cpu_count() or 1)))
+# Tempo máximo de extração de uma página
+DOCUMENT_PAGE_TIMEOUT = float(os.getenv('DOCUMENT_PAGE_TIMEOUT', 10))
+DOCUMENT_PAGE_BATCH = 4
+DOCUMENT_TEXT_READ_SIZE = 64 * 1024
+
+DOCUMENT_EXTENSIONS = {'pdf': 'pdf', 'docx': 'docx', 'text': 'txt'}
+
+extraction_pool = None
+
+def get_extraction_pool():
+    global extraction_pool
+    if extraction_pool is None:
+        # spawn: fazer fork de um worker com várias threads não é seguro
+        extraction_pool = ProcessPoolExecutor(
+            max_workers=DOCUMENT_WORKERS,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+    return extraction_pool
+
+def _iter_pdf_pages_pooled(stream, total, batch_size):
+    import pdf_pages
+
+    with tempfile.NamedTemporaryFile(suffix='.pdf') as pdf_file:
+        stream.seek(0)
+        shutil.copyfileobj(stream, pdf_file)
+        pdf_file.flush()
+
+        pool = get_extraction_pool()
+        batches = iter(range(0, total, batch_size))
+        pending = deque()
+
+        def submit_next():
+            start = next(batches, None)
+            if start is not None:
+                stop = min(start + batch_size, total)
+                pending.append((stop - start, pool.submit(pdf_pages.extract_batch, pdf_file.name, start, stop, DOCUMENT_PAGE_TIMEOUT)))
+
+        # Mantém no máximo DOCUMENT_WORKERS lotes em andamento e devolve as
+        # páginas em ordem; se quem consome parar, os lotes pendentes são cancelados
+        for _ in range(DOCUMENT_WORKERS):
+            submit_next()
+        try:
+            while pending:
+                size, future = pending.popleft()
+                try:
+                    pages = future.result(timeout=DOCUMENT_PAGE_TIMEOUT * size + 5)
+                except FuturesTimeout:
+                    log.warning("Lote de %s páginas excedeu o tempo limite e foi ignorado", size)
+                    pages = [''] * size
+                submit_next()
+                yield from pages
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+def iter_pdf_pages(stream):
+    import PyPDF2
+
+    reader = PyPDF2.PdfReader(stream)
+    total = min(len(reader.pages), DOCUMENT_MAX_PAGES)
+    if total == 0:
+        return
+    # Mesmo PDFs pequenos são extraídos no pool: só num processo separado dá
+    # para interromper uma página que trava o PyPDF2
+    if total >= DOCUMENT_PARALLEL_MIN_PAGES and DOCUMENT_WORKERS > 1:
+        yield from _iter_pdf_pages_pooled(stream, total, DOCUMENT_PAGE_BATCH)
+    else:
+        yield from _iter_pdf_pages_pooled(stream, total, total)
+
+def iter_docx_paragraphs(stream):
+    import docx
+
+    for paragraph in docx.Document(stream).paragraphs:
+        yield paragraph.text
+
+def document_kind(stream, content_type, url=''):
+    content_type = (content_type or '').lower()
+    path = urlparse(url).path.lower()
+    if 'pdf' in content_type or path.endswith('.pdf'):
+        return 'pdf'
+    if 'word' in content_type or path.endswith(('.doc', '.docx')):
+        return 'docx'
+    # Sem tipo reconhecível (ex.: application/octet-stream), olha a assinatura do arquivo
+    stream.seek(0)
+    head = stream.read(4)
+    stream.seek(0)
+    if head == b'%PDF':
+        return 'pdf'
+    if head == b'PK\x03\x04':
+        return 'docx'
+    return 'text'
+
+def iter_text_blocks(stream):
+    # Lê e decodifica aos poucos, para parar no limite sem carregar o arquivo todo
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    while True:
+        block = stream.read(DOCUMENT_TEXT_READ_SIZE)
+        if not block:
+            break
+        text = decoder.decode(block)
+        if text:
+            yield text
+    tail = decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+def iter_document_parts(stream, kind):
+    if kind == 'pdf':
+        return iter_pdf_pages(stream)
+    if kind == 'docx':
+        return iter_docx_paragraphs(stream)
+    return iter_text_blocks(stream)
+
+def extract_document_text(stream, content_type, url='', max_chars=DOCUMENT_MAX_CHARS):
+    """Extrai o texto de PDF, Word ou texto puro, parando em max_chars.
+
+    Retorna None se o tipo não for suportado.
+    """
+    parts = []
+    total = 0
+    with timed('extraction'):
+        kind = document_kind(stream, content_type, url)
+        # Páginas e parágrafos viram linhas; blocos de texto puro são contínuos
+        separator = '' if kind == 'text' else '\n'
+        try:
+            extracted = iter_document_parts(stream, kind)
+            for part in extracted:
+                parts.append(part)
+                total += len(part) + len(separator)
+                if total >= max_chars:
+                    extracted.close()
+                    break
+        except UnicodeDecodeError:
+            return None
+    return separator.join(parts)[:max_chars]
+
+def parse_max_chars(value):
+    """Valida o max_chars do corpo; None se não for um inteiro positivo."""
+    if isinstance(value, bool) or isinstance(value, float) and not value.is_integer():
+        return None
+    try:
+        max_chars = int(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    if max_chars <= 0:
+        return None
+    return min(max_chars, DOCUMENT_MAX_CHARS)
+
 @app.route('/transcribe', methods=['POST'])
 def transcribe():
     try:
@@ -23,22 +1376,19 @@ def transcribe():
         if not data or 'twilio_url' not in data:
             return jsonify({'success': False, 'error': 'Campo "twilio_url" é obrigatório'}), 400
         
+        openai_scheduler.admit(['whisper-1'])
         twilio_url = data['twilio_url']
-        print(f"Baixando áudio de: {twilio_url}")
-        audio_response = requests.get(twilio_url, timeout=30)
-        if audio_response.status_code != 200:
-            return jsonify({'success': False, 'error': f'Erro ao baixar áudio do Twilio: {audio_response.status_code}'}), 400
-        
-        audio_buffer = io.BytesIO(audio_response.content)
-        audio_buffer.name = "audio.ogg"
-        print("Enviando áudio para OpenAI Whisper...")
-        openai_client = get_openai_client()
-        transcript = openai_client.audio.transcriptions.create(
-            model="whisper-1",
-            file=audio_buffer
-        )
+        with fetch_media(twilio_url, audio_max_bytes()) as audio:
+            if audio.status_code != 200:
+                return jsonify({'success': False, 'error': f'Erro ao baixar áudio do Twilio: {audio.status_code}'}), 400
+            
+            transcription = transcribe_audio(audio)
         
-        return jsonify({'success': True, 'transcription': transcript.text})
+        return jsonify({'success': True, 'transcription': transcription})
+    except MediaTooLarge as e:
+        return jsonify({'success': False, 'error': str(e)}), 413
+    except OpenAIOverloaded as e:
+        return overloaded_response(e)
     except requests.exceptions.RequestException as e:
         return jsonify({'success': False, 'error': f'Erro ao fazer requisição: {str(e)}'}), 500
     except Exception as e:
@@ -51,38 +1401,21 @@ def analyze_image():
         if not data or 'twilio_url' not in data:
             return jsonify({'success': False, 'error': 'Campo "twilio_url" é obrigatório'}), 400
         
+        openai_scheduler.admit(['gpt-4.1-mini'])
         twilio_url = data['twilio_url']
         prompt = data.get('prompt', 'Descreva esta imagem em detalhes.')
-        print(f"Baixando imagem de: {twilio_url}")
-        image_response = requests.get(twilio_url, timeout=30)
-        if image_response.status_code != 200:
-            return jsonify({'success': False, 'error': f'Erro ao baixar imagem do Twilio: {image_response.status_code}'}), 400
-        
-        import base64
-        image_base64 = base64.b64encode(image_response.content).decode('utf-8')
-        content_type = image_response.headers.get('Content-Type', 'image/jpeg')
-        print("Enviando imagem para GPT-4 Vision...")
-        openai_client = get_openai_client()
-        response = openai_client.chat.completions.create(
-            model="gpt-4.1-mini",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:{content_type};base64,{image_base64}"
-                            }
-                        }
-                    ]
-                }
-            ],
-            max_tokens=1000
-        )
+        with fetch_media(twilio_url) as image:
+            if image.status_code != 200:
+                return jsonify({'success': False, 'error': f'Erro ao baixar imagem do Twilio: {image.status_code}'}), 400
+            
+            content_type = image.content_type or 'image/jpeg'
+            analysis = describe_image(image, content_type, prompt)
         
-        return jsonify({'success': True, 'analysis': response.choices[0].message.content})
+        return jsonify({'success': True, 'analysis': analysis})
+    except MediaTooLarge as e:
+        return jsonify({'success': False, 'error': str(e)}), 413
+    except OpenAIOverloaded as e:
+        return overloaded_response(e)
     except requests.exceptions.RequestException as e:
         return jsonify({'success': False, 'error': f'Erro ao fazer requisição: {str(e)}'}), 500
     except Exception as e:
@@ -97,49 +1430,29 @@ def extract_document():
         
         twilio_url = data['twilio_url']
         should_analyze = data.get('analyze', False)
-        print(f"Baixando documento de: {twilio_url}")
-        doc_response = requests.get(twilio_url, timeout=30)
-        if doc_response.status_code != 200:
-            return jsonify({'success': False, 'error': f'Erro ao baixar documento do Twilio: {doc_response.status_code}'}), 400
-        
-        content_type = doc_response.headers.get('Content-Type', '')
-        extracted_text = ""
-        
-        if 'pdf' in content_type.lower() or twilio_url.lower().endswith('.pdf'):
-            import PyPDF2
-            pdf_buffer = io.BytesIO(doc_response.content)
-            pdf_reader = PyPDF2.PdfReader(pdf_buffer)
-            for page in pdf_reader.pages:
-                extracted_text += page.extract_text() + "\n"
-        elif 'word' in content_type.lower() or twilio_url.lower().endswith(('.doc', '.docx')):
-            import docx
-            doc_buffer = io.BytesIO(doc_response.content)
-            doc = docx.Document(doc_buffer)
-            for paragraph in doc.paragraphs:
-                extracted_text += paragraph.text + "\n"
-        else:
-            try:
-                extracted_text = doc_response.content.decode('utf-8')
-            except:
-                return jsonify({'success': False, 'error': f'Tipo de documento não suportado: {content_type}'}), 400
+        max_chars = parse_max_chars(data.get('max_chars', DOCUMENT_MAX_CHARS))
+        if max_chars is None:
+            return jsonify({'success': False, 'error': 'Campo "max_chars" deve ser um inteiro positivo'}), 400
+        if should_analyze:
+            openai_scheduler.admit(['gpt-4.1-mini'])
+        with fetch_media(twilio_url) as document:
+            if document.status_code != 200:
+                return jsonify({'success': False, 'error': f'Erro ao baixar documento do Twilio: {document.status_code}'}), 400
+            
+            content_type = document.content_type or ''
+            extracted_text = extract_document_text(document.stream(), content_type, twilio_url, max_chars)
+        if extracted_text is None:
+            return jsonify({'success': False, 'error': f'Tipo de documento não suportado: {content_type}'}), 400
         
         result = {'success': True, 'text': extracted_text.strip()}
         if should_analyze and extracted_text.strip():
-            print("Analisando documento com GPT-4...")
-            openai_client = get_openai_client()
-            analysis_response = openai_client.chat.completions.create(
-                model="gpt-4.1-mini",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": f"Analise e resuma o seguinte documento:\n\n{extracted_text[:4000]}"
-                    }
-                ],
-                max_tokens=1000
-            )
-            result['analysis'] = analysis_response.choices[0].message.content
+            result['analysis'] = analyze_document_text(extracted_text)
         
         return jsonify(result)
+    except MediaTooLarge as e:
+        return jsonify({'success': False, 'error': str(e)}), 413
+    except OpenAIOverloaded as e:
+        return overloaded_response(e)
     except requests.exceptions.RequestException as e:
         return jsonify({'success': False, 'error': f'Erro ao fazer requisição: {str(e)}'}), 500
     except Exception as e:
@@ -147,271 +1460,1217 @@ def extract_document():
 
 @app.route('/health', methods=['GET'])
 def health():
-    return jsonify({'status': 'ok'})
+    return jsonify({'status': 'ok', 'cache': result_cache.stats()})
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return metrics_payload(), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+
+@app.before_request
+def open_request_context():
+    g.request_started = time.perf_counter()
+    g.request_context_token = begin_request(request.endpoint or '', request.headers.get('X-Request-Id', '')[:64])
+
+@app.after_request
+def record_request(response):
+    observe_request(response.status_code, time.perf_counter() - g.request_started)
+    response.headers['X-Request-Id'] = request_context.get()['request_id']
+    return response
+
+@app.teardown_request
+def close_request_context(exc):
+    token = g.pop('request_context_token', None)
+    if token is not None:
+        request_context.reset(token)
 
 # ==================== FUNÇÕES AUXILIARES CHATWOOT ====================
 
-def send_to_chatwoot_new(config, content, file_data=None):
-    headers = {
+# Envia a mídia original como anexo, em paralelo com a transcrição/análise
+CHATWOOT_ATTACHMENTS = os.getenv('CHATWOOT_ATTACHMENTS', 'true').lower() in ('1', 'true', 'yes')
+# Uploads de anexos simultâneos por worker
+CHATWOOT_UPLOAD_WORKERS = int(os.getenv('CHATWOOT_UPLOAD_WORKERS', 8))
+
+upload_pool = ThreadPoolExecutor(max_workers=CHATWOOT_UPLOAD_WORKERS, thread_name_prefix='chatwoot-upload')
+
+def chatwoot_headers(config):
+    return {
         'Content-Type': 'application/json',
         'api_access_token': config['api_token']
     }
+
+class MultipartBody:
+    """Corpo multipart/form-data lido sob demanda, sem montar o arquivo em memória.
+
+    O tamanho é conhecido (vai no Content-Length) e seek(0) volta ao início,
+    para que a requisição possa ser repetida em caso de 429.
+    """
+
+    def __init__(self, fields, file_field, files):
+        self.boundary = uuid.uuid4().hex
+        head = b''.join(
+            f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode('utf-8')
+            for name, value in fields
+        )
+        self._parts = []
+        self._length = 0
+        for filename, reader, content_type in files:
+            head += (
+                f'--{self.boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+                f'Content-Type: {content_type}\r\n\r\n'
+            ).encode('utf-8')
+            self._parts += [io.BytesIO(head), reader]
+            self._length += len(head) + reader.seek(0, 2)
+            reader.seek(0)
+            head = b'\r\n'
+        tail = f'{head.decode()}--{self.boundary}--\r\n'.encode('utf-8')
+        self._parts.append(io.BytesIO(tail))
+        self._length += len(tail)
+        self._index = 0
+        self._position = 0
+
+    @property
+    def content_type(self):
+        return f'multipart/form-data; boundary={self.boundary}'
+
+    def __len__(self):
+        return self._length
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=0):
+        if offset or whence:
+            raise io.UnsupportedOperation('MultipartBody só pode voltar ao início')
+        for part in self._parts:
+            part.seek(0)
+        self._index = 0
+        self._position = 0
+        return 0
+
+    def read(self, size=-1):
+        chunks = []
+        while self._index < len(self._parts) and size != 0:
+            chunk = self._parts[self._index].read(size)
+            if not chunk:
+                self._index += 1
+                continue
+            chunks.append(chunk)
+            self._position += len(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b''.join(chunks)
+
+    def __iter__(self):
+        self.seek(0)
+        while True:
+            chunk = self.read(DOWNLOAD_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+def chatwoot_new_request(config, content=None):
     data = {
         'inbox_id': config['inbox_id'],
-        'source_id': config['source_id'],
-        'message': {
+        'source_id': config['source_id']
+    }
+    # Sem content a conversa é criada vazia e as mensagens vão depois
+    if content is not None:
+        data['message'] = {
             'content': content,
             'message_type': 'incoming'
         }
-    }
     url = f"{config['api_url']}/api/v1/accounts/{config['account_id']}/conversations"
+    return url, data
+
+def chatwoot_existing_request(config, conversation_id, content):
+    data = {
+        'content': content,
+        'message_type': 'incoming'
+    }
+    url = f"{config['api_url']}/api/v1/accounts/{config['account_id']}/conversations/{conversation_id}/messages"
+    return url, data
 
-    # Logs de depuração
-    print("🚀 Enviando para Chatwoot (nova conversa):")
-    print(f"🔗 URL: {url}")
-    print(f"📦 Headers: {headers}")
-    print(f"📝 Body:\n{json.dumps(data, indent=2)}")
+def chatwoot_attachment_request(config, conversation_id, files, content=None):
+    """Mensagem com anexos: retorna (url, headers, corpo multipart em stream).
+
+    files é uma lista de (nome_do_arquivo, leitor, content_type).
+    """
+    fields = [('message_type', 'incoming')]
+    if content:
+        fields.append(('content', content))
+    body = MultipartBody(fields, 'attachments[]', files)
+    headers = {
+        'Content-Type': body.content_type,
+        'api_access_token': config['api_token']
+    }
+    url = f"{config['api_url']}/api/v1/accounts/{config['account_id']}/conversations/{conversation_id}/messages"
+    return url, headers, body
+
+def created_conversation_id(resp_json):
+    # Dependendo de como a resposta vem, pode ser "id" ou dentro de outro objeto
+    return resp_json.get('id') or resp_json.get('conversation', {}).get('id')
+
+def log_chatwoot_failure(action, response):
+    # Só o começo do corpo: o suficiente para ver o erro do Chatwoot
+    log.warning("Erro ao %s no Chatwoot: %s - %s", action, response.status_code, response.text[:500],
+                extra={'status': response.status_code})
+
+def send_to_chatwoot_new(config, content, file_data=None):
+    headers = chatwoot_headers(config)
+    url, data = chatwoot_new_request(config, content)
+    log.debug("Criando conversa no Chatwoot: %s", url)
 
     try:
-        response = requests.post(url, headers=headers, json=data)
-        print("📡 Status da resposta:", response.status_code)
-        print("📨 Corpo da resposta:", response.text)
+        with timed('chatwoot'):
+            response = http_request('POST', url, headers=headers, json=data)
 
         if response.status_code in (200, 201):
             # Retornar a conversa criada
-            resp_json = response.json()
-            # Dependendo de como a resposta vem, pode ser "id" ou dentro de outro objeto
-            conversation_id = resp_json.get('id') or resp_json.get('conversation', {}).get('id')
-            return conversation_id
+            new_id = created_conversation_id(response.json())
+            if new_id is not None and file_data is not None:
+                send_chatwoot_attachment(config, new_id, [file_data])
+            return new_id
         else:
+            log_chatwoot_failure('criar conversa', response)
             return None
     except Exception as e:
-        print("💥 Erro ao enviar para Chatwoot:", str(e))
+        log.error("Erro ao enviar para Chatwoot: %s", e)
+        return None
+
+def create_chatwoot_conversation(config):
+    """Cria a conversa sem mensagem, para o anexo poder ser enviado antes do texto."""
+    url, data = chatwoot_new_request(config)
+    try:
+        with timed('chatwoot'):
+            response = http_request('POST', url, headers=chatwoot_headers(config), json=data)
+        if response.status_code in (200, 201):
+            return created_conversation_id(response.json())
+        log_chatwoot_failure('criar conversa', response)
+        return None
+    except Exception as e:
+        log.error("Erro ao criar conversa no Chatwoot: %s", e)
         return None
 
+def send_chatwoot_attachment(config, conversation_id, files, content=None):
+    url, headers, body = chatwoot_attachment_request(config, conversation_id, files, content)
+    try:
+        with timed('chatwoot_attachment'):
+            response = http_request('POST', url, headers=headers, data=body)
+        if response.status_code in (200, 201):
+            return True
+        log_chatwoot_failure('enviar anexo', response)
+        return False
+    except Exception as e:
+        log.error("Erro ao enviar anexo ao Chatwoot: %s", e)
+        return False
+
 def send_to_chatwoot_existing(config, conversation_id, content, file_data=None):
-    headers = {
-        'Content-Type': 'application/json',
-        'api_access_token': config['api_token']
-    }
-    data = {
-        'content': content,
-        'message_type': 'incoming'
-    }
-    url = f"{config['api_url']}/api/v1/accounts/{config['account_id']}/conversations/{conversation_id}/messages"
+    if file_data is not None:
+        return send_chatwoot_attachment(config, conversation_id, [file_data], content)
+
+    headers = chatwoot_headers(config)
+    url, data = chatwoot_existing_request(config, conversation_id, content)
 
     try:
-        response = requests.post(url, headers=headers, json=data)
+        with timed('chatwoot'):
+            response = http_request('POST', url, headers=headers, json=data)
         if response.status_code in (200, 201):
             return True
         else:
-            print(f"Erro ao enviar mensagem existente: {response.status_code} - {response.text}")
+            log_chatwoot_failure('enviar mensagem', response)
             return False
     except Exception as e:
-        print("💥 Erro ao enviar mensagem existente:", str(e))
+        log.error("Erro ao enviar mensagem ao Chatwoot: %s", e)
         return False
 
+def upload_attachment(config, conversation_id, files, content=None):
+    """Envia a mídia original (com content opcional) para o Chatwoot.
+
+    Normalmente roda enquanto a OpenAI ainda processa o conteúdo, e o texto
+    gerado vai depois como segunda mensagem. Sem conversation_id, usa a
+    conversa aberta do contato (ou cria uma). Retorna (conversation_id, enviado).
+    """
+    if conversation_id is not None:
+        return conversation_id, send_chatwoot_attachment(config, conversation_id, files, content)
+
+    resolver = get_conversation_resolver()
+    for attempt in range(2):
+        conversation_id, created = resolver.resolve(config, lambda: create_chatwoot_conversation(config))
+        if conversation_id is None:
+            return None, False
+        sent = send_chatwoot_attachment(config, conversation_id, files, content)
+        if sent or created:
+            return conversation_id, sent
+        # A conversa guardada pode ter sido apagada no Chatwoot: esquece e cria outra
+        resolver.forget(config, conversation_id)
+    return None, False
+
+def send_to_contact_conversation(config, content):
+    """Envia content para a conversa aberta do contato, criando-a se não houver.
+
+    Retorna o conversation_id, ou None se o envio falhou.
+    """
+    resolver = get_conversation_resolver()
+    for attempt in range(2):
+        conversation_id, created = resolver.resolve(config, lambda: send_to_chatwoot_new(config, content))
+        if conversation_id is None or created:
+            return conversation_id
+        if send_to_chatwoot_existing(config, conversation_id, content):
+            return conversation_id
+        resolver.forget(config, conversation_id)
+    return None
+
+# ==================== CONVERSAS POR CONTATO ====================
+
+# SQLite compartilhado entre os workers com a conversa aberta de cada contato
+CONVERSATIONS_DB_PATH = os.getenv('CONVERSATIONS_DB_PATH', os.path.join(tempfile.gettempdir(), 'twilio-whisper-conversations.sqlite3'))
+# Por quanto tempo a conversa criada para um contato é reaproveitada
+CONVERSATION_TTL = int(os.getenv('CONVERSATION_TTL', 6 * 3600))
+# Tempo máximo que a criação em andamento em outro worker segura o contato
+CONVERSATION_LOCK_SECONDS = int(os.getenv('CONVERSATION_LOCK_SECONDS', 30))
+CONVERSATION_POLL_SECONDS = 0.1
+# Token exigido em /chatwoot/webhook?token=...; sem ele o webhook fica desativado,
+# porque qualquer um poderia apagar o mapeamento contato → conversa
+CHATWOOT_WEBHOOK_TOKEN = os.getenv('CHATWOOT_WEBHOOK_TOKEN')
+
+def webhook_token_error(token):
+    """(mensagem, status) se o webhook deve ser recusado, ou None."""
+    if not CHATWOOT_WEBHOOK_TOKEN:
+        return 'Webhook desativado: defina CHATWOOT_WEBHOOK_TOKEN', 503
+    if not hmac.compare_digest((token or '').encode('utf-8'), CHATWOOT_WEBHOOK_TOKEN.encode('utf-8')):
+        return 'Token inválido', 401
+    return None
+
+def conversation_key(config):
+    return f"{config.get('account_id')}:{config.get('inbox_id')}:{config.get('source_id')}"
+
+class ConversationResolver:
+    """Mapeia (account_id, inbox_id, source_id) para a conversa aberta do contato.
+
+    Mensagens seguidas do mesmo contato vão para a mesma conversa: só a
+    primeira cria, as simultâneas esperam por ela (no mesmo processo ou, via
+    linha "pendente" no SQLite, em outro worker) e as seguintes usam o envio
+    para conversa existente.
+    """
+
+    def __init__(self, db_path, ttl):
+        self.db_path = db_path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._next_purge = 0.0
+        db = self._db()
+        # conversation_id sem tipo, para manter o inteiro retornado pelo Chatwoot
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS conversations ('
+            'key TEXT PRIMARY KEY, account_id TEXT, conversation_id, started_at REAL NOT NULL, expires_at REAL)'
+        )
+        db.execute('CREATE INDEX IF NOT EXISTS conversations_by_id ON conversations (conversation_id)')
+        db.execute('CREATE INDEX IF NOT EXISTS conversations_expires ON conversations (expires_at)')
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            self._local.db = db
+        return db
+
+    def acquire(self, key, account_id):
+        """Retorna ('hit', conversation_id), ('leader', None) ou ('pending', None)."""
+        now = time.time()
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute(
+                'SELECT conversation_id, started_at, expires_at FROM conversations WHERE key = ?', (key,)
+            ).fetchone()
+            if row is not None and row[0] is not None and row[2] > now:
+                db.execute('COMMIT')
+                return 'hit', row[0]
+            if row is not None and row[0] is None and row[1] > now - CONVERSATION_LOCK_SECONDS:
+                db.execute('COMMIT')
+                return 'pending', None
+            db.execute(
+                'INSERT OR REPLACE INTO conversations (key, account_id, started_at) VALUES (?, ?, ?)',
+                (key, str(account_id), now)
+            )
+            if now >= self._next_purge:
+                self._next_purge = now + SQLITE_PURGE_SECONDS
+                db.execute('DELETE FROM conversations WHERE expires_at < ?', (now,))
+            db.execute('COMMIT')
+            return 'leader', None
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+
+    def complete(self, key, conversation_id):
+        db = self._db()
+        if conversation_id is None:
+            db.execute('DELETE FROM conversations WHERE key = ? AND conversation_id IS NULL', (key,))
+            return
+        db.execute(
+            'UPDATE conversations SET conversation_id = ?, expires_at = ? WHERE key = ?',
+            (conversation_id, time.time() + self.ttl, key)
+        )
+
+    def forget(self, config, conversation_id):
+        self._db().execute(
+            'DELETE FROM conversations WHERE key = ? AND conversation_id = ?',
+            (conversation_key(config), conversation_id)
+        )
+
+    def invalidate(self, conversation_id, account_id=None):
+        """Esquece a conversa (resolvida ou apagada no Chatwoot). Retorna quantas foram removidas."""
+        db = self._db()
+        if account_id is None:
+            cursor = db.execute('DELETE FROM conversations WHERE conversation_id = ?', (conversation_id,))
+        else:
+            cursor = db.execute(
+                'DELETE FROM conversations WHERE conversation_id = ? AND account_id = ?',
+                (conversation_id, str(account_id))
+            )
+        return cursor.rowcount
+
+    def _resolve_shared(self, key, account_id, create):
+        # A linha pendente expira em CONVERSATION_LOCK_SECONDS, então o laço termina
+        while True:
+            state, conversation_id = self.acquire(key, account_id)
+            if state == 'hit':
+                return conversation_id, False
+            if state == 'leader':
+                break
+            time.sleep(CONVERSATION_POLL_SECONDS)
+
+        conversation_id = None
+        try:
+            conversation_id = create()
+        finally:
+            self.complete(key, conversation_id)
+        return conversation_id, conversation_id is not None
+
+    def resolve(self, config, create):
+        """Retorna (conversation_id, criada_agora).
+
+        create() cria a conversa no Chatwoot e retorna o id (ou None se falhou);
+        só é chamada se o contato ainda não tiver conversa guardada.
+        """
+        key = conversation_key(config)
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.event.wait(CONVERSATION_LOCK_SECONDS)
+            if flight.result is not None:
+                return flight.result, False
+            return self._resolve_shared(key, config.get('account_id'), create)
+
+        try:
+            conversation_id, created = self._resolve_shared(key, config.get('account_id'), create)
+            flight.result = conversation_id
+            return conversation_id, created
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.event.set()
+
+conversation_resolver = None
+
+def get_conversation_resolver():
+    global conversation_resolver
+    if conversation_resolver is None:
+        conversation_resolver = ConversationResolver(CONVERSATIONS_DB_PATH, CONVERSATION_TTL)
+    return conversation_resolver
+
+def resolved_conversation(payload):
+    """(conversation_id, account_id) de um webhook do Chatwoot que encerra a conversa, ou None."""
+    if payload.get('event') not in ('conversation_status_changed', 'conversation_updated'):
+        return None
+    if payload.get('status') != 'resolved' or payload.get('id') is None:
+        return None
+    return payload['id'], payload.get('account', {}).get('id')
+
+@app.route('/chatwoot/webhook', methods=['POST'])
+def chatwoot_webhook():
+    """Webhook do Chatwoot: conversas resolvidas deixam de receber mensagens novas do contato."""
+    refused = webhook_token_error(request.args.get('token'))
+    if refused:
+        return jsonify({'success': False, 'error': refused[0]}), refused[1]
+
+    resolved = resolved_conversation(request.get_json(silent=True) or {})
+    if resolved is None:
+        return jsonify({'success': True, 'invalidated': 0})
+    return jsonify({'success': True, 'invalidated': get_conversation_resolver().invalidate(*resolved)})
+
+# ==================== AGRUPAMENTO DE MENSAGENS ====================
+
+# Mensagens da mesma conversa que chegam dentro dessa janela (em segundos)
+# são enviadas ao Chatwoot como uma só; 0 desativa o agrupamento
+COALESCE_WINDOW_SECONDS = float(os.getenv('COALESCE_WINDOW_SECONDS', 0))
+# Um grupo é enviado assim que atingir esse número de mensagens
+COALESCE_MAX_MESSAGES = int(os.getenv('COALESCE_MAX_MESSAGES', 10))
+
+def coalesce_key(config, conversation_id):
+    if conversation_id is not None:
+        return f"{config.get('account_id')}:{conversation_id}"
+    return f"contato:{conversation_key(config)}"
+
+def coalesced_content(contents):
+    if len(contents) == 1:
+        return contents[0]
+    return FIXED_TEXTS['coalesced'] + '\n\n'.join(f'{i}. {content}' for i, content in enumerate(contents, 1))
+
+def send_coalesced(config, conversation_id, content, files):
+    """Envia a mensagem agrupada, com os anexos de todas as mensagens. Retorna (conversation_id, enviado)."""
+    if files:
+        return upload_attachment(config, conversation_id, files, content)
+    if conversation_id is None:
+        conversation_id = send_to_contact_conversation(config, content)
+        return conversation_id, conversation_id is not None
+    return conversation_id, send_to_chatwoot_existing(config, conversation_id, content)
+
+class _CoalesceSlot:
+    def __init__(self, batch):
+        self.batch = batch
+        self.index = None
+        self.state = 'pending'
+        self.content = None
+        self.files = []
+
+class _CoalesceBatch:
+    def __init__(self, config, conversation_id, previous):
+        self.config = config
+        self.conversation_id = conversation_id
+        # Grupo anterior da mesma conversa: este só é enviado depois dele
+        self.previous = previous
+        self.slots = []
+        self.deadline = 0
+        self.done = threading.Event()
+        self.result = None
+
+class MessageCoalescer:
+    """Junta mensagens seguidas da mesma conversa em um único envio ao Chatwoot.
+
+    Cada mensagem reserva sua posição ao chegar (join) e preenche o conteúdo
+    quando o processamento termina (fill), então uma transcrição lenta não
+    perde o lugar. O grupo é enviado quando passa a janela sem mensagens
+    novas, ou ao atingir max_messages, e sempre depois de todas as posições
+    preenchidas ou canceladas. O agrupamento é por processo.
+    """
+
+    def __init__(self, window, max_messages):
+        self.window = window
+        self.max_messages = max_messages
+        self._cond = threading.Condition()
+        self._open = {}
+        self._last = {}
+
+    def join(self, config, conversation_id):
+        key = coalesce_key(config, conversation_id)
+        with self._cond:
+            batch = self._open.get(key)
+            if batch is None:
+                batch = _CoalesceBatch(config, conversation_id, self._last.get(key))
+                self._open[key] = self._last[key] = batch
+                threading.Thread(target=with_request_context(self._flush), args=(key, batch), daemon=True).start()
+            slot = _CoalesceSlot(batch)
+            batch.slots.append(slot)
+            batch.deadline = time.time() + self.window
+            if len(batch.slots) >= self.max_messages:
+                del self._open[key]
+            self._cond.notify_all()
+        return slot
+
+    def fill(self, slot, content, file_data=None):
+        with self._cond:
+            slot.content = content
+            slot.files = [file_data] if file_data is not None else []
+            slot.state = 'ready'
+            self._cond.notify_all()
+
+    def cancel(self, slot):
+        with self._cond:
+            if slot.state == 'pending':
+                slot.state = 'cancelled'
+                self._cond.notify_all()
+
+    def wait(self, slot):
+        """Espera o envio do grupo. Retorna (conversation_id, enviado, conteúdo_agrupado, total)."""
+        slot.batch.done.wait()
+        return slot.batch.result
+
+    def _ready(self, key, batch):
+        if self._open.get(key) is batch and time.time() < batch.deadline:
+            return False
+        return all(slot.state != 'pending' for slot in batch.slots)
+
+    def _flush(self, key, batch):
+        with self._cond:
+            while not self._ready(key, batch):
+                remaining = batch.deadline - time.time()
+                self._cond.wait(remaining if remaining > 0 and self._open.get(key) is batch else None)
+            if self._open.get(key) is batch:
+                del self._open[key]
+
+        slots = [slot for slot in batch.slots if slot.state == 'ready']
+        for index, slot in enumerate(slots, 1):
+            slot.index = index
+        content = coalesced_content([slot.content for slot in slots]) if slots else None
+        batch.result = (batch.conversation_id, False, content, len(slots))
+        try:
+            if batch.previous is not None:
+                batch.previous.done.wait()
+                # Sem isso cada grupo manteria vivos todos os anteriores da conversa
+                batch.previous = None
+            if slots:
+                files = [file_data for slot in slots for file_data in slot.files]
+                conversation_id, sent = send_coalesced(batch.config, batch.conversation_id, content, files)
+                batch.result = (conversation_id, sent, content, len(slots))
+        except Exception as e:
+            log.error("Erro ao enviar mensagens agrupadas: %s", e)
+        finally:
+            # Os anexos (até MEDIA_SPOOL_BYTES em memória cada) não são mais necessários
+            for slot in batch.slots:
+                slot.content = None
+                slot.files = []
+            batch.done.set()
+            with self._cond:
+                if self._last.get(key) is batch:
+                    del self._last[key]
+
+message_coalescer = MessageCoalescer(COALESCE_WINDOW_SECONDS, COALESCE_MAX_MESSAGES)
+
+# ==================== PROCESSAMENTO E ENVIO ====================
+
 FIXED_TEXTS = {
     'audio': 'Esta mensagem é a transcrição de um áudio que o cliente enviou para você. Responda com naturalidade e se for necessário trate a mensagem como se de fato estivesse recebido o áudio. Mensagem: ',
     'image': 'O cliente enviou uma imagem e o que consta nela segue abaixo. Siga essas orientações: Se for informações de um pedido, proceda conforme já orientado em seu prompt. Se for informações de uma comanda confirme com o cliente se ele quer que seja lançado um pedido com esses produtos. Caso seja informações de um comprovante de pagamento confirme se o pagamento foi efetivado conforme dados do mesmo exponha esses dados e se confirmado, informe que irá verificar junto o departamento responsável. Caso seja outro tipo de conteúdo confirme com o cliente do que se trata e qual é a intenção do cliente. Imagem: ',
     'document': 'O cliente enviou um documento e o que consta nele segue abaixo. Siga essas orientações: Se for informações de um pedido, proceda conforme já orientado em seu prompt. Se for informações de uma comanda confirme com o cliente se ele quer que seja lançado um pedido com esses produtos. Caso seja informações de um comprovante de pagamento confirme se o pagamento foi efetivado conforme dados do mesmo exponha esses dados e se confirmado, informe que irá verificar junto o departamento responsável. Caso seja outro tipo de conteúdo confirme com o cliente do que se trata e qual é a intenção do cliente. Documento: ',
     'video': 'O cliente enviou um vídeo e o que consta nele segue abaixo. Siga essas orientações: Caso o cliente não tenha informado o motivo para o envio do vídeo, questione. Caso seja uma reclamação informe que um atentendente humano irá verificar o ocorrido. Caso seja um elogio agradeça com entusiasmo: ',
-    'location': 'Você recebeu uma localização. Caso tenha solicitado o endereço e o cliente está lhe enviando a localização, agradeça pois nos ajudará bastante na entrega, mas reforce a necessidade de envio do endereço por escrito. Se for outra situação, apenas agradeça.'
+    'location': 'Você recebeu uma localização. Caso tenha solicitado o endereço e o cliente está lhe enviando a localização, agradeça pois nos ajudará bastante na entrega, mas reforce a necessidade de envio do endereço por escrito. Se for outra situação, apenas agradeça.',
+    'coalesced': 'O cliente enviou várias mensagens seguidas, reproduzidas abaixo na ordem em que chegaram. Considere todas juntas e responda uma única vez. Mensagens:\n\n'
 }
 
-@app.route('/process-and-send-new', methods=['POST'])
-def process_and_send_new():
-    try:
-        data = request.get_json()
-        if not data:
-            return jsonify({'success': False, 'error': 'Body vazio'}), 400
+# Vai no lugar do conteúdo quando a OpenAI falha depois que o anexo já subiu
+PROCESSING_FALLBACK = '(Não foi possível processar o conteúdo automaticamente; o arquivo original está anexado na conversa)'
 
-        message_type = data.get('message_type', '').lower()
-        chatwoot_config = data.get('chatwoot', {})
+def validate_process_request(data, new_conversation):
+    message_type = data.get('message_type', '').lower()
+    if not message_type:
+        return 'Campo "message_type" é obrigatório'
+    if not new_conversation and not data.get('chatwoot', {}).get('conversation_id'):
+        return 'Campo "conversation_id" é obrigatório no chatwoot'
+    if message_type == 'text':
+        if not data.get('text_content', ''):
+            return 'Campo "text_content" obrigatório para type=text'
+    elif message_type == 'location':
+        if not data.get('latitude') or not data.get('longitude'):
+            return 'Campos "latitude" e "longitude" obrigatórios para type=location'
+    elif message_type in ('audio', 'image', 'document', 'video'):
+        if not data.get('twilio_url'):
+            return 'Campo "twilio_url" obrigatório para este tipo'
+    else:
+        return f'Tipo de mensagem não suportado: {message_type}'
+    return None
 
-        if not message_type:
-            return jsonify({'success': False, 'error': 'Campo "message_type" é obrigatório'}), 400
+def location_text(latitude, longitude):
+    return f"📍 Localização: https://www.google.com/maps?q={latitude},{longitude}"
 
-        conteudo = ""
-        file_data = None
-
-        if message_type == 'text':
-            text_content = data.get('text_content', '')
-            if not text_content:
-                return jsonify({'success': False, 'error': 'Campo "text_content" obrigatório para type=text'}), 400
+MEDIA_FILENAMES = {
+    'audio': 'audio.ogg',
+    'image': 'image.jpg',
+    'document': 'document.pdf',
+    'video': 'video.mp4',
+}
 
-            conteudo = text_content
-            conversation_id = send_to_chatwoot_new(chatwoot_config, conteudo)
-            return jsonify({'success': True, 'conteudo': conteudo, 'conversation_id': conversation_id, 'chatwoot_sent': conversation_id is not None})
+def media_filename(media, message_type, content_type, url=''):
+    if message_type == 'document':
+        return f"document.{DOCUMENT_EXTENSIONS[document_kind(media.stream(), content_type, url)]}"
+    return MEDIA_FILENAMES[message_type]
 
-        elif message_type == 'location':
-            latitude = data.get('latitude')
-            longitude = data.get('longitude')
-            if not latitude or not longitude:
-                return jsonify({'success': False, 'error': 'Campos "latitude" e "longitude" obrigatórios para type=location'}), 400
+def media_attachment(media, message_type, content_type, url=''):
+    """(nome, leitor, content_type) do anexo enviado ao Chatwoot; lê a mídia."""
+    return media_filename(media, message_type, content_type, url), media.reader(), content_type
 
-            conteudo = FIXED_TEXTS['location']
-            location_text = f"📍 Localização: https://www.google.com/maps?q={latitude},{longitude}"
-            conversation_id = send_to_chatwoot_new(chatwoot_config, location_text)
-            return jsonify({'success': True, 'conteudo': conteudo, 'conversation_id': conversation_id, 'chatwoot_sent': conversation_id is not None})
-
-        twilio_url = data.get('twilio_url')
-        if not twilio_url:
-            return jsonify({'success': False, 'error': 'Campo "twilio_url" obrigatório para este tipo'}), 400
-
-        print(f"Baixando arquivo de: {twilio_url}")
-        file_response = requests.get(twilio_url, timeout=30)
-        if file_response.status_code != 200:
-            return jsonify({'success': False, 'error': f'Erro ao baixar arquivo: {file_response.status_code}'}), 400
-
-        file_bytes = file_response.content
-        content_type = file_response.headers.get('Content-Type', 'application/octet-stream')
-
-        if message_type == 'audio':
-            audio_buffer = io.BytesIO(file_bytes)
-            audio_buffer.name = "audio.ogg"
-            openai_client = get_openai_client()
-            transcript = openai_client.audio.transcriptions.create(model="whisper-1", file=audio_buffer)
-            conteudo = FIXED_TEXTS['audio'] + transcript.text
-            file_data = ('audio.ogg', file_bytes, content_type)
-
-        elif message_type == 'image':
-            import base64
-            image_base64 = base64.b64encode(file_bytes).decode('utf-8')
-            openai_client = get_openai_client()
-            response = openai_client.chat.completions.create(
-                model="gpt-4.1-mini",
-                messages=[{
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": "Descreva esta imagem em detalhes."},
-                        {"type": "image_url", "image_url": {"url": f"data:{content_type};base64,{image_base64}"}}
-                    ]
-                }],
-                max_tokens=1000
-            )
-            conteudo = FIXED_TEXTS['image'] + response.choices[0].message.content
-            file_data = ('image.jpg', file_bytes, content_type)
-
-        elif message_type == 'document':
-            import PyPDF2
-            pdf_buffer = io.BytesIO(file_bytes)
-            pdf_reader = PyPDF2.PdfReader(pdf_buffer)
-            extracted_text = ""
-            for page in pdf_reader.pages:
-                extracted_text += page.extract_text() + "\n"
-            conteudo = FIXED_TEXTS['document'] + extracted_text.strip()
-            file_data = ('document.pdf', file_bytes, content_type)
-
-        elif message_type == 'video':
-            conteudo = FIXED_TEXTS['video'] + "(Vídeo enviado - processamento de vídeo não disponível)"
-            file_data = ('video.mp4', file_bytes, content_type)
-        else:
-            return jsonify({'success': False, 'error': f'Tipo de mensagem não suportado: {message_type}'}), 400
+def document_content(media, content_type, url=''):
+    extracted_text = extract_document_text(media.stream(), content_type, url)
+    if extracted_text is None:
+        return "(Documento enviado - tipo de documento não suportado para extração de texto)"
+    return extracted_text.strip()
 
-        conversation_id = send_to_chatwoot_new(chatwoot_config, conteudo, file_data)
-        return jsonify({'success': True, 'conteudo': conteudo, 'conversation_id': conversation_id, 'chatwoot_sent': conversation_id is not None})
-    except Exception as e:
-        return jsonify({'success': False, 'error': f'Erro interno: {str(e)}'}), 500
+def process_and_send_pipeline(data, new_conversation, progress=None):
+    """Processa a mensagem e envia para o Chatwoot.
 
-@app.route('/process-and-send', methods=['POST'])
-def process_and_send():
-    try:
-        data = request.get_json()
-        if not data:
-            return jsonify({'success': False, 'error': 'Body vazio'}), 400
+    Usado pelas rotas /process-and-send* e pelos workers da fila de jobs.
+    Retorna (corpo_da_resposta, status_http).
+    """
+    def report(stage):
+        if progress:
+            progress(stage)
 
-        message_type = data.get('message_type', '').lower()
-        chatwoot_config = data.get('chatwoot', {})
-        conversation_id = chatwoot_config.get('conversation_id')
+    error = validate_process_request(data, new_conversation)
+    if error:
+        return {'success': False, 'error': error}, 400
 
-        if not message_type:
-            return jsonify({'success': False, 'error': 'Campo "message_type" é obrigatório'}), 400
+    message_type = data.get('message_type', '').lower()
+    chatwoot_config = data.get('chatwoot', {})
+    conversation_id = None if new_conversation else chatwoot_config.get('conversation_id')
 
-        if not conversation_id:
-            return jsonify({'success': False, 'error': 'Campo "conversation_id" é obrigatório no chatwoot'}), 400
+    # Chamadas à OpenAI desta mensagem entram na fila da conta do Chatwoot
+    tenant_token = openai_tenant.set(str(chatwoot_config.get('account_id', '')))
+    # Com o agrupamento ativo, a mensagem reserva sua posição já na chegada
+    slot = message_coalescer.join(chatwoot_config, conversation_id) if COALESCE_WINDOW_SECONDS > 0 else None
 
-        conteudo = ""
-        file_data = None
+    def send(content, target_id=None, file_data=None):
+        """Envia o texto; target_id é a conversa já criada pelo upload do anexo."""
+        report('sending')
+        if slot is not None:
+            message_coalescer.fill(slot, content, file_data)
+            target_id, success, combined, count = message_coalescer.wait(slot)
+            result = {
+                'chatwoot_sent': success,
+                'coalesced_messages': count,
+                'coalesced_position': slot.index,
+                'conteudo_agrupado': combined
+            }
+        elif new_conversation and target_id is None:
+            target_id = send_to_contact_conversation(chatwoot_config, content)
+            result = {'chatwoot_sent': target_id is not None}
+        else:
+            result = {'chatwoot_sent': send_to_chatwoot_existing(chatwoot_config, target_id or conversation_id, content)}
+        if new_conversation:
+            result['conversation_id'] = target_id
+        return result
 
+    try:
         if message_type == 'text':
-            text_content = data.get('text_content', '')
-            if not text_content:
-                return jsonify({'success': False, 'error': 'Campo "text_content" obrigatório para type=text'}), 400
-            conteudo = text_content
-            success = send_to_chatwoot_existing(chatwoot_config, conversation_id, conteudo)
-            return jsonify({'success': True, 'conteudo': conteudo, 'chatwoot_sent': success})
-
-        elif message_type == 'location':
-            latitude = data.get('latitude')
-            longitude = data.get('longitude')
-            if not latitude or not longitude:
-                return jsonify({'success': False, 'error': 'Campos "latitude" e "longitude" obrigatórios para type=location'}), 400
+            conteudo = data['text_content']
+            return {'success': True, 'conteudo': conteudo, **send(conteudo)}, 200
+
+        if message_type == 'location':
             conteudo = FIXED_TEXTS['location']
-            location_text = f"📍 Localização: https://www.google.com/maps?q={latitude},{longitude}"
-            success = send_to_chatwoot_existing(chatwoot_config, conversation_id, location_text)
-            return jsonify({'success': True, 'conteudo': conteudo, 'chatwoot_sent': success})
-
-        twilio_url = data.get('twilio_url')
-        if not twilio_url:
-            return jsonify({'success': False, 'error': 'Campo "twilio_url" obrigatório para este tipo'}), 400
-
-        print(f"Baixando arquivo de: {twilio_url}")
-        file_response = requests.get(twilio_url, timeout=30)
-        if file_response.status_code != 200:
-            return jsonify({'success': False, 'error': f'Erro ao baixar arquivo: {file_response.status_code}'}), 400
-
-        file_bytes = file_response.content
-        content_type = file_response.headers.get('Content-Type', 'application/octet-stream')
-
-        if message_type == 'audio':
-            audio_buffer = io.BytesIO(file_bytes)
-            audio_buffer.name = "audio.ogg"
-            openai_client = get_openai_client()
-            transcript = openai_client.audio.transcriptions.create(model="whisper-1", file=audio_buffer)
-            conteudo = FIXED_TEXTS['audio'] + transcript.text
-            file_data = ('audio.ogg', file_bytes, content_type)
-
-        elif message_type == 'image':
-            import base64
-            image_base64 = base64.b64encode(file_bytes).decode('utf-8')
-            openai_client = get_openai_client()
-            response = openai_client.chat.completions.create(
-                model="gpt-4.1-mini",
-                messages=[{
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": "Descreva esta imagem em detalhes."},
-                        {"type": "image_url", "image_url": {"url": f"data:{content_type};base64,{image_base64}"}}
-                    ]
-                }],
-                max_tokens=1000
+            return {'success': True, 'conteudo': conteudo, **send(location_text(data['latitude'], data['longitude']))}, 200
+
+        twilio_url = data['twilio_url']
+        report('downloading')
+        try:
+            media = fetch_media(twilio_url, audio_max_bytes() if message_type == 'audio' else MEDIA_MAX_BYTES)
+        except MediaTooLarge as e:
+            return {'success': False, 'error': str(e)}, 413
+
+        with media:
+            if media.status_code != 200:
+                return {'success': False, 'error': f'Erro ao baixar arquivo: {media.status_code}'}, 400
+
+            content_type = media.content_type or 'application/octet-stream'
+
+            file_data = None
+            if CHATWOOT_ATTACHMENTS:
+                file_data = media_attachment(media, message_type, content_type, twilio_url)
+
+            # O anexo sobe para o Chatwoot enquanto a OpenAI processa a mídia;
+            # com o agrupamento ativo, ele vai junto com a mensagem do grupo
+            upload = None
+            if file_data is not None and slot is None:
+                upload = upload_pool.submit(with_request_context(upload_attachment), chatwoot_config, conversation_id, [file_data])
+
+            report('processing')
+            target_id, attachment_sent = None, False
+            processing_error = None
+            try:
+                try:
+                    if message_type == 'audio':
+                        conteudo = FIXED_TEXTS['audio'] + transcribe_audio(media)
+
+                    elif message_type == 'image':
+                        conteudo = FIXED_TEXTS['image'] + describe_image(media, content_type)
+
+                    elif message_type == 'document':
+                        conteudo = FIXED_TEXTS['document'] + document_content(media, content_type, twilio_url)
+
+                    else:
+                        conteudo = FIXED_TEXTS['video'] + "(Vídeo enviado - processamento de vídeo não disponível)"
+                finally:
+                    # A mídia só pode ser fechada depois que o upload terminar
+                    target_id, attachment_sent = upload.result() if upload else (None, False)
+            except Exception as e:
+                if not attachment_sent:
+                    if isinstance(e, MediaTooLarge):
+                        return {'success': False, 'error': str(e)}, 413
+                    raise
+                # O anexo já está no Chatwoot e uma retentativa o enviaria de novo:
+                # a mensagem segue com um texto padrão e a requisição é concluída
+                log.error("Erro ao processar %s já anexado no Chatwoot: %s", message_type, e)
+                conteudo = FIXED_TEXTS[message_type] + PROCESSING_FALLBACK
+                processing_error = str(e)
+
+            if slot is not None:
+                result = send(conteudo, file_data=file_data)
+                attachment_sent = file_data is not None and result['chatwoot_sent']
+            else:
+                result = send(conteudo, target_id)
+            body = {'success': True, 'conteudo': conteudo, **result, 'attachment_sent': attachment_sent}
+            if processing_error:
+                body['processing_error'] = processing_error
+            return body, 200
+    finally:
+        if slot is not None:
+            message_coalescer.cancel(slot)
+        openai_tenant.reset(tenant_token)
+
+# ==================== FILA DE JOBS ASSÍNCRONOS ====================
+
+# SQLite compartilhado entre os workers do gunicorn
+JOBS_DB_PATH = os.getenv('JOBS_DB_PATH', os.path.join(tempfile.gettempdir(), 'twilio-whisper-jobs.sqlite3'))
+# Threads de processamento em background por worker
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 4))
+# Jobs "running" há mais tempo que isso voltam para a fila (worker morreu)
+JOB_LEASE_SECONDS = int(os.getenv('JOB_LEASE_SECONDS', 300))
+# Jobs finalizados são apagados depois desse tempo
+JOB_RETENTION_SECONDS = int(os.getenv('JOB_RETENTION_SECONDS', 24 * 3600))
+
+class JobQueue:
+    """Fila durável em SQLite para o modo assíncrono do process-and-send."""
+
+    def __init__(self, db_path, workers):
+        self.db_path = db_path
+        self.workers = workers
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        self._started = False
+        self._start_lock = threading.Lock()
+        # Jobs em execução neste processo; o lease deles é renovado periodicamente
+        self._running = set()
+        self._running_lock = threading.Lock()
+        # Em fork (gunicorn --preload) as threads não vão junto para o processo filho
+        os.register_at_fork(after_in_child=self._after_fork)
+        db = self._db()
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'id TEXT PRIMARY KEY, kind TEXT NOT NULL, payload TEXT NOT NULL, '
+            'status TEXT NOT NULL, stage TEXT, result TEXT, http_status INTEGER, '
+            'created_at REAL NOT NULL, updated_at REAL NOT NULL, claimed_at REAL)'
+        )
+        db.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)')
+        db.commit()
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            self._local.db = db
+        return db
+
+    def enqueue(self, kind, payload):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._db().execute(
+            'INSERT INTO jobs (id, kind, payload, status, stage, created_at, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (job_id, kind, json.dumps(payload), 'queued', 'queued', now, now)
+        )
+        self._wakeup.set()
+        return job_id
+
+    def get(self, job_id):
+        row = self._db().execute(
+            'SELECT id, kind, status, stage, result, http_status, created_at, updated_at FROM jobs WHERE id = ?',
+            (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            'job_id': row[0],
+            'kind': row[1],
+            'status': row[2],
+            'stage': row[3],
+            'result': json.loads(row[4]) if row[4] else None,
+            'http_status': row[5],
+            'created_at': row[6],
+            'updated_at': row[7],
+        }
+
+    def _claim(self):
+        now = time.time()
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute(
+                "SELECT id, kind, payload FROM jobs WHERE status = 'queued' "
+                "OR (status = 'running' AND claimed_at < ?) ORDER BY created_at LIMIT 1",
+                (now - JOB_LEASE_SECONDS,)
+            ).fetchone()
+            if row is not None:
+                db.execute(
+                    "UPDATE jobs SET status = 'running', stage = 'running', claimed_at = ?, updated_at = ? WHERE id = ?",
+                    (now, now, row[0])
+                )
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        return row
+
+    def _update(self, job_id, **fields):
+        fields['updated_at'] = time.time()
+        columns = ', '.join(f'{name} = ?' for name in fields)
+        self._db().execute(f'UPDATE jobs SET {columns} WHERE id = ?', (*fields.values(), job_id))
+
+    def _purge(self):
+        self._db().execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+            (time.time() - JOB_RETENTION_SECONDS,)
+        )
+
+    def start(self):
+        with self._start_lock:
+            if self._started:
+                return
+            self._started = True
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f'job-worker-{i}', daemon=True).start()
+        threading.Thread(target=self._renew_leases, name='job-lease', daemon=True).start()
+
+    def _after_fork(self):
+        started = self._started
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        self._started = False
+        self._start_lock = threading.Lock()
+        self._running = set()
+        self._running_lock = threading.Lock()
+        if started:
+            self.start()
+
+    def _renew_leases(self):
+        # Jobs longos (PDF grande, áudio em partes) não podem ser retomados por
+        # outro worker enquanto este ainda está processando
+        while True:
+            time.sleep(JOB_LEASE_SECONDS / 3)
+            with self._running_lock:
+                running = list(self._running)
+            if not running:
+                continue
+            try:
+                self._db().execute(
+                    f"UPDATE jobs SET claimed_at = ? WHERE status = 'running' AND id IN ({', '.join('?' * len(running))})",
+                    (time.time(), *running)
+                )
+            except sqlite3.Error as e:
+                log.error("Erro ao renovar o lease dos jobs: %s", e)
+
+    def _worker(self):
+        while True:
+            try:
+                row = self._claim()
+            except sqlite3.Error as e:
+                log.error("Erro ao buscar job na fila: %s", e)
+                row = None
+            if row is None:
+                self._wakeup.wait(1.0)
+                self._wakeup.clear()
+                continue
+            with self._running_lock:
+                self._running.add(row[0])
+            try:
+                self._run(*row)
+            except Exception:
+                # Nada pode derrubar a thread; o job fica "running" e volta para a fila quando o lease vencer
+                log.exception("Erro inesperado no job %s", row[0])
+            finally:
+                with self._running_lock:
+                    self._running.discard(row[0])
+
+    def _run(self, job_id, kind, payload):
+        data = json.loads(payload)
+        context_token = begin_request(f'job:{kind}', job_id)
+        try:
+            set_message_type(data.get('message_type', '').lower())
+            log.info("Executando job %s (%s)", job_id, kind)
+            started = time.perf_counter()
+            try:
+                body, status = process_and_send_pipeline(
+                    data,
+                    new_conversation=(kind == 'process-and-send-new'),
+                    progress=lambda stage: self._progress(job_id, stage)
+                )
+            except Exception as e:
+                body, status = {'success': False, 'error': f'Erro interno: {str(e)}'}, 500
+            observe_request(status, time.perf_counter() - started)
+
+            final_status = 'done' if body.get('success') else 'failed'
+            self._update(job_id, status=final_status, stage=final_status, result=json.dumps(body), http_status=status)
+            try:
+                self._purge()
+            except sqlite3.Error as e:
+                log.error("Erro ao limpar jobs antigos: %s", e)
+
+            callback_url = data.get('callback_url')
+            if callback_url:
+                try:
+                    http_request('POST', callback_url, json=self.get(job_id))
+                except Exception as e:
+                    log.error("Erro ao chamar callback do job %s: %s", job_id, e)
+        finally:
+            request_context.reset(context_token)
+
+    def _progress(self, job_id, stage):
+        # O estágio é só informativo; falha ao gravá-lo não interrompe o job
+        try:
+            self._update(job_id, stage=stage)
+        except sqlite3.Error as e:
+            log.error("Erro ao atualizar o estágio do job %s: %s", job_id, e)
+
+job_queue = None
+
+def get_job_queue():
+    global job_queue
+    if job_queue is None:
+        job_queue = JobQueue(JOBS_DB_PATH, JOB_WORKERS)
+    return job_queue
+
+def start_job_queue(server=False):
+    """Inicia os workers da fila, para que jobs pendentes (deploy, reinício) sejam retomados.
+
+    Só o servidor processa jobs: o gunicorn.conf.py, o lifespan do ASGI e o
+    __main__ chamam com server=True (os workers do uvicorn são processos
+    filhos do multiprocessing). Fora disso, um processo filho (pool de
+    extração, scripts) nunca inicia a fila.
+    """
+    if not server and multiprocessing.parent_process() is not None:
+        return None
+    queue = get_job_queue()
+    queue.start()
+    return queue
+
+def enqueue_process_job(kind, data, new_conversation):
+    error = validate_process_request(data, new_conversation)
+    if error:
+        return {'success': False, 'error': error}, 400
+    # Garante os workers mesmo se o servidor subiu sem o gunicorn.conf.py
+    start_job_queue()
+    job_id = get_job_queue().enqueue(kind, data)
+    return {'success': True, 'job_id': job_id, 'status': 'queued', 'status_url': f'/jobs/{job_id}'}, 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = get_job_queue().get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Job não encontrado'}), 404
+    return jsonify({'success': True, **job})
+
+# ==================== IDEMPOTÊNCIA ====================
+
+IDEMPOTENCY_DB_PATH = os.getenv('IDEMPOTENCY_DB_PATH', os.path.join(tempfile.gettempdir(), 'twilio-whisper-idempotency.sqlite3'))
+# Por quanto tempo a resposta de uma requisição concluída é reaproveitada
+IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', 24 * 3600))
+# Tempo máximo que uma execução em andamento segura a chave; depois disso
+# outra requisição assume (o worker que segurava provavelmente morreu)
+IDEMPOTENCY_LOCK_SECONDS = int(os.getenv('IDEMPOTENCY_LOCK_SECONDS', 120))
+IDEMPOTENCY_POLL_SECONDS = 0.25
+
+IN_PROGRESS_RESPONSE = ({'success': False, 'error': 'Requisição idêntica ainda em processamento, tente novamente'}, 409)
+
+def replayable(body, status):
+    """Só respostas de sucesso são reaproveitadas.
+
+    Falhas transitórias (download, 413, Chatwoot fora do ar, 5xx) liberam a
+    chave, para que a retentativa do Twilio/Fiqon execute de novo.
+    """
+    return status < 400 and bool(body.get('success')) and body.get('chatwoot_sent', True) is not False
+
+def idempotency_key(data, kind, explicit_key=None):
+    """Chave da requisição: a informada, o MessageSid do Twilio ou a twilio_url.
+
+    Mensagens de texto sem chave explícita não são deduplicadas, porque o
+    cliente pode mandar o mesmo texto duas vezes de propósito.
+    """
+    key = explicit_key or data.get('idempotency_key') or data.get('message_sid') or data.get('twilio_url')
+    if not key:
+        return None
+    chatwoot = data.get('chatwoot', {})
+    target = chatwoot.get('conversation_id') or f"{chatwoot.get('inbox_id')}:{chatwoot.get('source_id')}"
+    return hashlib.sha256(f"{kind}|{chatwoot.get('account_id')}|{target}|{key}".encode('utf-8')).hexdigest()
+
+class _Flight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+class IdempotencyStore:
+    """Respostas por chave de idempotência, compartilhadas entre os workers via SQLite.
+
+    Requisições idênticas simultâneas no mesmo processo esperam a execução em
+    andamento; entre processos, a linha "pending" no SQLite faz o mesmo papel.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._next_purge = 0.0
+        db = self._db()
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS idempotency ('
+            'key TEXT PRIMARY KEY, status TEXT NOT NULL, response TEXT, http_status INTEGER, '
+            'started_at REAL NOT NULL, expires_at REAL)'
+        )
+        db.execute('CREATE INDEX IF NOT EXISTS idempotency_expires ON idempotency (expires_at)')
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            self._local.db = db
+        return db
+
+    def acquire(self, key):
+        """Retorna ('leader', None), ('done', (corpo, status)) ou ('pending', None)."""
+        now = time.time()
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute(
+                'SELECT status, response, http_status, started_at, expires_at FROM idempotency WHERE key = ?',
+                (key,)
+            ).fetchone()
+            if row is not None and row[0] == 'done' and row[4] > now:
+                db.execute('COMMIT')
+                return 'done', (json.loads(row[1]), row[2])
+            if row is not None and row[0] == 'pending' and row[3] > now - IDEMPOTENCY_LOCK_SECONDS:
+                db.execute('COMMIT')
+                return 'pending', None
+            db.execute(
+                "INSERT OR REPLACE INTO idempotency (key, status, started_at) VALUES (?, 'pending', ?)",
+                (key, now)
             )
-            conteudo = FIXED_TEXTS['image'] + response.choices[0].message.content
-            file_data = ('image.jpg', file_bytes, content_type)
-
-        elif message_type == 'document':
-            import PyPDF2
-            pdf_buffer = io.BytesIO(file_bytes)
-            pdf_reader = PyPDF2.PdfReader(pdf_buffer)
-            extracted_text = ""
-            for page in pdf_reader.pages:
-                extracted_text += page.extract_text() + "\n"
-            conteudo = FIXED_TEXTS['document'] + extracted_text.strip()
-            file_data = ('document.pdf', file_bytes, content_type)
-
-        elif message_type == 'video':
-            conteudo = FIXED_TEXTS['video'] + "(Vídeo enviado - processamento de vídeo não disponível)"
-            file_data = ('video.mp4', file_bytes, content_type)
-        else:
-            return jsonify({'success': False, 'error': f'Tipo de mensagem não suportado: {message_type}'}), 400
+            if now >= self._next_purge:
+                self._next_purge = now + SQLITE_PURGE_SECONDS
+                db.execute('DELETE FROM idempotency WHERE expires_at < ?', (now,))
+            db.execute('COMMIT')
+            return 'leader', None
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+
+    def complete(self, key, body, status):
+        if not replayable(body, status):
+            self.release(key)
+            return
+        self._db().execute(
+            "UPDATE idempotency SET status = 'done', response = ?, http_status = ?, expires_at = ? WHERE key = ?",
+            (json.dumps(body), status, time.time() + IDEMPOTENCY_TTL, key)
+        )
+
+    def release(self, key):
+        self._db().execute("DELETE FROM idempotency WHERE key = ? AND status = 'pending'", (key,))
+
+    def _run_shared(self, key, compute):
+        deadline = time.time() + IDEMPOTENCY_LOCK_SECONDS
+        while True:
+            state, stored = self.acquire(key)
+            if state == 'done':
+                return stored[0], stored[1], True
+            if state == 'leader':
+                break
+            if time.time() > deadline:
+                return (*IN_PROGRESS_RESPONSE, False)
+            time.sleep(IDEMPOTENCY_POLL_SECONDS)
+
+        try:
+            body, status = compute()
+        except Exception:
+            self.release(key)
+            raise
+        self.complete(key, body, status)
+        return body, status, False
+
+    def run(self, key, compute):
+        """Executa compute() uma única vez por chave. Retorna (corpo, status, reaproveitada)."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.event.wait(IDEMPOTENCY_LOCK_SECONDS)
+            if flight.result is not None and replayable(*flight.result):
+                return flight.result[0], flight.result[1], True
+            return self._run_shared(key, compute)
+
+        try:
+            body, status, replayed = self._run_shared(key, compute)
+            flight.result = (body, status)
+            return body, status, replayed
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.event.set()
+
+idempotency_store = None
 
-        success = send_to_chatwoot_existing(chatwoot_config, conversation_id, conteudo, file_data)
-        return jsonify({'success': True, 'conteudo': conteudo, 'chatwoot_sent': success})
+def get_idempotency_store():
+    global idempotency_store
+    if idempotency_store is None:
+        idempotency_store = IdempotencyStore(IDEMPOTENCY_DB_PATH)
+    return idempotency_store
+
+def handle_process_and_send(kind, new_conversation):
+    data = request.get_json()
+    if not data:
+        return jsonify({'success': False, 'error': 'Body vazio'}), 400
+    set_message_type(data.get('message_type', '').lower())
+
+    def run():
+        if data.get('async'):
+            return enqueue_process_job(kind, data, new_conversation)
+        # Recusa logo na chegada se a OpenAI estiver sobrecarregada; jobs só esperam a vez
+        models = MESSAGE_MODELS.get(data.get('message_type', '').lower(), [])
+        openai_scheduler.admit(models, str(data.get('chatwoot', {}).get('account_id', '')))
+        return process_and_send_pipeline(data, new_conversation)
+
+    key = idempotency_key(data, kind, request.headers.get('Idempotency-Key'))
+    if key is None:
+        body, status = run()
+        replayed = False
+    else:
+        body, status, replayed = get_idempotency_store().run(key, run)
+
+    response = jsonify(body)
+    if replayed:
+        response.headers['Idempotent-Replayed'] = 'true'
+    return response, status
+
+@app.route('/process-and-send-new', methods=['POST'])
+def process_and_send_new():
+    try:
+        return handle_process_and_send('process-and-send-new', new_conversation=True)
+    except OpenAIOverloaded as e:
+        return overloaded_response(e)
+    except Exception as e:
+        return jsonify({'success': False, 'error': f'Erro interno: {str(e)}'}), 500
+
+@app.route('/process-and-send', methods=['POST'])
+def process_and_send():
+    try:
+        return handle_process_and_send('process-and-send', new_conversation=False)
+    except OpenAIOverloaded as e:
+        return overloaded_response(e)
     except Exception as e:
         return jsonify({'success': False, 'error': f'Erro interno: {str(e)}'}), 500
 
 if __name__ == '__main__':
     if not os.getenv('OPENAI_API_KEY'):
-        print("AVISO: Variável de ambiente OPENAI_API_KEY não está configurada!")
+        log.warning("Variável de ambiente OPENAI_API_KEY não está configurada!")
+    # Com o reloader do modo debug, só o processo que atende as requisições processa jobs
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_job_queue(server=True)
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,890 @@
+"""Modo de execução assíncrono (ASGI) dos mesmos endpoints do app.py.
+
+Todo o I/O (Twilio, OpenAI e Chatwoot) é feito sem bloquear, então um único
+processo consegue manter centenas de mídias em andamento. O app Flask do
+app.py continua disponível como alternativa.
+
+Executar com: uvicorn asgi:app --host 0.0.0.0 --port 5000
+"""
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse
+
+import httpx
+import openai
+from openai import AsyncOpenAI
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+import app as core
+
+# Requisições simultâneas por serviço externo, em cada processo
+OPENAI_CONCURRENCY = int(os.getenv('OPENAI_CONCURRENCY', 32))
+TWILIO_CONCURRENCY = int(os.getenv('TWILIO_CONCURRENCY', 64))
+CHATWOOT_CONCURRENCY = int(os.getenv('CHATWOOT_CONCURRENCY', 32))
+
+openai_limit = asyncio.Semaphore(OPENAI_CONCURRENCY)
+twilio_limit = asyncio.Semaphore(TWILIO_CONCURRENCY)
+chatwoot_limit = asyncio.Semaphore(CHATWOOT_CONCURRENCY)
+
+http_client = None
+openai_client = None
+
+def get_http_client():
+    global http_client
+    if http_client is None:
+        http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(core.HTTP_READ_TIMEOUT, connect=core.HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=TWILIO_CONCURRENCY + CHATWOOT_CONCURRENCY,
+                max_keepalive_connections=core.HTTP_POOL_SIZE * 3
+            )
+        )
+    return http_client
+
+def get_async_openai_client():
+    global openai_client
+    if openai_client is None:
+        openai_client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'), max_retries=0)
+    return openai_client
+
+# ==================== TRANSPORTE HTTP ====================
+
+async def http_request(method, url, limit, stream=False, **kwargs):
+    """Versão assíncrona de app.http_request, com a mesma política de retentativas.
+
+    Com stream=True o corpo não é lido e quem chamou deve fechar a resposta.
+    """
+    idempotent = method.upper() in ('GET', 'HEAD')
+    auth = kwargs.pop('auth', None)
+    follow_redirects = kwargs.pop('follow_redirects', False)
+
+    for attempt in range(core.HTTP_MAX_RETRIES + 1):
+        last_attempt = attempt == core.HTTP_MAX_RETRIES
+        try:
+            async with limit:
+                client = get_http_client()
+                response = await client.send(
+                    client.build_request(method, url, **kwargs),
+                    auth=auth, follow_redirects=follow_redirects, stream=stream
+                )
+        except httpx.ConnectTimeout:
+            if last_attempt:
+                raise
+            await asyncio.sleep(core._retry_delay(attempt))
+            continue
+        except (httpx.NetworkError, httpx.TimeoutException):
+            if last_attempt or not idempotent:
+                raise
+            await asyncio.sleep(core._retry_delay(attempt))
+            continue
+
+        retryable = response.status_code == 429 or (idempotent and response.status_code in core.RETRY_STATUSES)
+        if not retryable or last_attempt:
+            return response
+        delay = core._retry_delay(attempt, response)
+        core.log.warning("Status %s em %s, nova tentativa em %.1fs", response.status_code, urlparse(url).netloc, delay,
+                         extra={'status': response.status_code, 'host': urlparse(url).netloc, 'delay': round(delay, 2)})
+        await response.aclose()
+        await asyncio.sleep(delay)
+
+async def fetch_media(url, max_bytes=core.MEDIA_MAX_BYTES):
+    """Versão assíncrona de app.fetch_media."""
+    auth = None
+    if core.TWILIO_ACCOUNT_SID and core.TWILIO_AUTH_TOKEN and urlparse(url).netloc.endswith('twilio.com'):
+        auth = (core.TWILIO_ACCOUNT_SID, core.TWILIO_AUTH_TOKEN)
+    core.log.debug("Baixando mídia de %s", url)
+    with core.timed('download'):
+        response = await http_request('GET', url, twilio_limit, stream=True, auth=auth, follow_redirects=True)
+        try:
+            media = core.Media(response.status_code, response.headers.get('Content-Type'), max_bytes)
+            if response.status_code != 200:
+                return media
+            try:
+                media.check_length(response.headers.get('Content-Length'))
+                async for chunk in response.aiter_bytes(core.DOWNLOAD_CHUNK_SIZE):
+                    # Passando de MEDIA_SPOOL_BYTES a mídia vai para o disco: escreve fora do event loop
+                    if media.size + len(chunk) > core.MEDIA_SPOOL_BYTES:
+                        await asyncio.to_thread(media.write, chunk)
+                    else:
+                        media.write(chunk)
+            except Exception:
+                media.close()
+                raise
+            finally:
+                core.count_downloaded(media.size)
+        finally:
+            await response.aclose()
+    return media
+
+# ==================== AGENDADOR DA OPENAI ====================
+
+class AsyncOpenAIScheduler:
+    """Front-end do event loop para app.openai_scheduler.
+
+    As filas, os baldes e os bloqueios por 429 são os do agendador do app, que
+    também atende os jobs assíncronos rodando em threads neste processo: os
+    dois lados disputam uma única cota. O lock é segurado só para ler e
+    atualizar as filas, nunca durante uma espera. Além dos limites por
+    minuto, OPENAI_CONCURRENCY limita as chamadas em andamento.
+    """
+
+    def __init__(self, shared):
+        self.shared = shared
+        self._changed = asyncio.Event()
+        loop = asyncio.get_running_loop()
+
+        def wake():
+            try:
+                loop.call_soon_threadsafe(self._wake)
+            except RuntimeError:
+                # Event loop já encerrado
+                pass
+
+        shared.add_listener(wake)
+
+    def _wake(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def admit(self, models, tenant=''):
+        self.shared.admit(models, tenant)
+
+    async def _acquire(self, lane, waiter):
+        lock = self.shared._cond
+        with lock:
+            lane.enqueue(waiter)
+        try:
+            while True:
+                delay = None
+                with lock:
+                    if lane.head() is waiter:
+                        now = time.monotonic()
+                        delay = lane.wait_time(waiter, now)
+                        if delay <= 0:
+                            lane.grant(waiter, now)
+                            return
+                    changed = self._changed
+                try:
+                    await asyncio.wait_for(changed.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            with lock:
+                lane.discard(waiter)
+            raise
+        finally:
+            with lock:
+                self.shared._notify()
+
+    async def call(self, tokens, create, **kwargs):
+        model = kwargs['model']
+        lock = self.shared._cond
+        with lock:
+            lane = self.shared.lane(model)
+        for attempt in range(core.OPENAI_MAX_RETRIES + 1):
+            last_attempt = attempt == core.OPENAI_MAX_RETRIES
+            core.rewind_upload(kwargs)
+            with core.timed('openai_queue', model):
+                await self._acquire(lane, core._Waiter(core.openai_tenant.get(), tokens))
+            try:
+                async with openai_limit:
+                    with core.timed('openai', model):
+                        raw = await create(**kwargs)
+            except openai.RateLimitError as e:
+                if getattr(e, 'code', None) == 'insufficient_quota':
+                    raise
+                with lock:
+                    delay = lane.penalize(e.response.headers, attempt, time.monotonic())
+                    self.shared._notify()
+                core.log.warning("OpenAI 429 em %s, nova tentativa em %.1fs", model, delay,
+                                 extra={'model': model, 'delay': round(delay, 2)})
+                if last_attempt:
+                    raise core.OpenAIOverloaded(delay)
+                continue
+            except (openai.InternalServerError, openai.APIConnectionError) as e:
+                if last_attempt:
+                    raise
+                delay = core._retry_delay(attempt, getattr(e, 'response', None))
+                core.log.warning("Erro da OpenAI em %s (%s), nova tentativa em %.1fs", model, type(e).__name__, delay,
+                                 extra={'model': model, 'delay': round(delay, 2)})
+                await asyncio.sleep(delay)
+                continue
+
+            result = raw.parse()
+            usage = getattr(result, 'usage', None)
+            core.count_tokens(model, usage)
+            used_tokens = getattr(usage, 'total_tokens', None)
+            with lock:
+                lane.observe(raw.headers, tokens, used_tokens, time.monotonic())
+            return result
+
+openai_scheduler = None
+
+def get_openai_scheduler():
+    # Criado sob demanda para pertencer ao event loop do servidor
+    global openai_scheduler
+    if openai_scheduler is None:
+        openai_scheduler = AsyncOpenAIScheduler(core.openai_scheduler)
+    return openai_scheduler
+
+# ==================== FUNÇÕES AUXILIARES OPENAI ====================
+
+async def transcribe_audio(media, filename='audio.ogg'):
+    key = core.result_cache.make_key(media.sha256, 'whisper-1')
+    # Com CACHE_DB_PATH o cache consulta o SQLite, então sai do event loop
+    cached = await asyncio.to_thread(core.result_cache.get, key)
+    if cached is not None:
+        return cached
+
+    with core.timed('preprocess', 'whisper-1'):
+        chunks = await asyncio.to_thread(core.split_audio, media, filename) if core.AUDIO_CHUNKING else None
+    if chunks:
+        # Limita as partes de um mesmo áudio, além do limite global da OpenAI
+        chunk_limit = asyncio.Semaphore(core.AUDIO_CHUNK_WORKERS)
+
+        async def transcribe_chunk(chunk):
+            async with chunk_limit:
+                return await whisper(('chunk.wav', chunk))
+
+        texts = await asyncio.gather(*(transcribe_chunk(chunk) for chunk in chunks))
+        text = core.stitch_transcripts(texts)
+    else:
+        if media.size > core.WHISPER_MAX_BYTES:
+            raise core.MediaTooLarge(core.WHISPER_MAX_BYTES)
+        text = await whisper((filename, media.stream()))
+    await asyncio.to_thread(core.result_cache.set, key, text)
+    return text
+
+async def whisper(file):
+    transcript = await get_openai_scheduler().call(
+        0, get_async_openai_client().audio.transcriptions.with_raw_response.create, model="whisper-1", file=file
+    )
+    return transcript.text
+
+async def describe_image(media, content_type, prompt='Descreva esta imagem em detalhes.', max_tokens=1000):
+    key = core.image_cache_key(media, prompt, max_tokens)
+    cached = await asyncio.to_thread(core.result_cache.get, key)
+    if cached is not None:
+        return cached
+
+    with core.timed('preprocess', 'gpt-4.1-mini'):
+        image, messages = await asyncio.to_thread(core.prepare_image_messages, media, content_type, prompt)
+    core.log_image_savings(image)
+    response = await get_openai_scheduler().call(
+        core.estimate_tokens(messages, max_tokens), get_async_openai_client().chat.completions.with_raw_response.create,
+        model="gpt-4.1-mini",
+        messages=messages,
+        max_tokens=max_tokens
+    )
+    analysis = response.choices[0].message.content
+    await asyncio.to_thread(core.result_cache.set, key, analysis)
+    return analysis
+
+async def complete_text(prompt, max_tokens=1000):
+    key = core.result_cache.make_key(prompt.encode('utf-8'), 'gpt-4.1-mini', max_tokens=max_tokens)
+    cached = await asyncio.to_thread(core.result_cache.get, key)
+    if cached is not None:
+        return cached
+
+    messages = [{"role": "user", "content": prompt}]
+    response = await get_openai_scheduler().call(
+        core.estimate_tokens(messages, max_tokens), get_async_openai_client().chat.completions.with_raw_response.create,
+        model="gpt-4.1-mini",
+        messages=messages,
+        max_tokens=max_tokens
+    )
+    analysis = response.choices[0].message.content
+    await asyncio.to_thread(core.result_cache.set, key, analysis)
+    return analysis
+
+async def analyze_document_text(text, max_tokens=1000):
+    """Versão assíncrona de app.analyze_document_text."""
+    chunks = core.split_text_chunks(text, core.SUMMARY_CHUNK_TOKENS)
+    if len(chunks) <= 1:
+        return await complete_text(core.document_analysis_prompt(text), max_tokens)
+
+    chunk_limit = asyncio.Semaphore(core.SUMMARY_WORKERS)
+
+    async def summarize(prompt):
+        async with chunk_limit:
+            return await complete_text(prompt, core.SUMMARY_CHUNK_MAX_TOKENS)
+
+    summaries = await asyncio.gather(*(summarize(core.chunk_summary_prompt(chunk)) for chunk in chunks))
+    groups = core.group_summaries(summaries)
+    while len(groups) > 1:
+        summaries = await asyncio.gather(*(summarize(core.reduce_summary_prompt(group)) for group in groups))
+        groups = core.group_summaries(summaries)
+    return await complete_text(core.reduce_summary_prompt(groups[0]), max_tokens)
+
+# ==================== FUNÇÕES AUXILIARES CHATWOOT ====================
+
+class AsyncBody:
+    """Adapta app.MultipartBody ao httpx.AsyncClient.
+
+    Cada tentativa itera o corpo de novo desde o início, o que um gerador
+    assíncrono não permitiria.
+    """
+
+    def __init__(self, body):
+        self.body = body
+
+    async def __aiter__(self):
+        # A mídia pode estar num arquivo temporário em disco: lê fora do event loop
+        chunks = iter(self.body)
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+async def send_to_chatwoot_new(config, content, file_data=None):
+    url, data = core.chatwoot_new_request(config, content)
+    core.log.debug("Criando conversa no Chatwoot: %s", url)
+    try:
+        with core.timed('chatwoot'):
+            response = await http_request('POST', url, chatwoot_limit, headers=core.chatwoot_headers(config), json=data)
+        if response.status_code in (200, 201):
+            new_id = core.created_conversation_id(response.json())
+            if new_id is not None and file_data is not None:
+                await send_chatwoot_attachment(config, new_id, [file_data])
+            return new_id
+        core.log_chatwoot_failure('criar conversa', response)
+        return None
+    except Exception as e:
+        core.log.error("Erro ao enviar para Chatwoot: %s", e)
+        return None
+
+async def create_chatwoot_conversation(config):
+    url, data = core.chatwoot_new_request(config)
+    try:
+        with core.timed('chatwoot'):
+            response = await http_request('POST', url, chatwoot_limit, headers=core.chatwoot_headers(config), json=data)
+        if response.status_code in (200, 201):
+            return core.created_conversation_id(response.json())
+        core.log_chatwoot_failure('criar conversa', response)
+        return None
+    except Exception as e:
+        core.log.error("Erro ao criar conversa no Chatwoot: %s", e)
+        return None
+
+async def send_chatwoot_attachment(config, conversation_id, files, content=None):
+    url, headers, body = core.chatwoot_attachment_request(config, conversation_id, files, content)
+    headers['Content-Length'] = str(len(body))
+    try:
+        with core.timed('chatwoot_attachment'):
+            response = await http_request('POST', url, chatwoot_limit, headers=headers, content=AsyncBody(body))
+        if response.status_code in (200, 201):
+            return True
+        core.log_chatwoot_failure('enviar anexo', response)
+        return False
+    except Exception as e:
+        core.log.error("Erro ao enviar anexo ao Chatwoot: %s", e)
+        return False
+
+async def send_to_chatwoot_existing(config, conversation_id, content, file_data=None):
+    if file_data is not None:
+        return await send_chatwoot_attachment(config, conversation_id, [file_data], content)
+
+    url, data = core.chatwoot_existing_request(config, conversation_id, content)
+    try:
+        with core.timed('chatwoot'):
+            response = await http_request('POST', url, chatwoot_limit, headers=core.chatwoot_headers(config), json=data)
+        if response.status_code in (200, 201):
+            return True
+        core.log_chatwoot_failure('enviar mensagem', response)
+        return False
+    except Exception as e:
+        core.log.error("Erro ao enviar mensagem ao Chatwoot: %s", e)
+        return False
+
+async def upload_attachment(config, conversation_id, files, content=None):
+    """Versão assíncrona de app.upload_attachment."""
+    if conversation_id is not None:
+        return conversation_id, await send_chatwoot_attachment(config, conversation_id, files, content)
+
+    for attempt in range(2):
+        conversation_id, created = await resolve_conversation(config, lambda: create_chatwoot_conversation(config))
+        if conversation_id is None:
+            return None, False
+        sent = await send_chatwoot_attachment(config, conversation_id, files, content)
+        if sent or created:
+            return conversation_id, sent
+        await forget_conversation(config, conversation_id)
+    return None, False
+
+async def send_to_contact_conversation(config, content):
+    """Versão assíncrona de app.send_to_contact_conversation."""
+    for attempt in range(2):
+        conversation_id, created = await resolve_conversation(config, lambda: send_to_chatwoot_new(config, content))
+        if conversation_id is None or created:
+            return conversation_id
+        if await send_to_chatwoot_existing(config, conversation_id, content):
+            return conversation_id
+        await forget_conversation(config, conversation_id)
+    return None
+
+# ==================== CONVERSAS POR CONTATO ====================
+
+# Criações de conversa em andamento por contato, neste processo
+conversation_flights = {}
+
+async def forget_conversation(config, conversation_id):
+    resolver = await asyncio.to_thread(core.get_conversation_resolver)
+    await asyncio.to_thread(resolver.forget, config, conversation_id)
+
+async def _resolve_shared_conversation(key, account_id, create):
+    resolver = await asyncio.to_thread(core.get_conversation_resolver)
+    while True:
+        state, conversation_id = await asyncio.to_thread(resolver.acquire, key, account_id)
+        if state == 'hit':
+            return conversation_id, False
+        if state == 'leader':
+            break
+        await asyncio.sleep(core.CONVERSATION_POLL_SECONDS)
+
+    conversation_id = None
+    try:
+        conversation_id = await create()
+    finally:
+        await asyncio.to_thread(resolver.complete, key, conversation_id)
+    return conversation_id, conversation_id is not None
+
+async def resolve_conversation(config, create):
+    """Versão assíncrona de app.ConversationResolver.resolve; create é uma corrotina."""
+    key = core.conversation_key(config)
+    flight = conversation_flights.get(key)
+    if flight is not None:
+        conversation_id = await asyncio.shield(flight)
+        if conversation_id is not None:
+            return conversation_id, False
+        return await _resolve_shared_conversation(key, config.get('account_id'), create)
+
+    flight = conversation_flights[key] = asyncio.get_running_loop().create_future()
+    conversation_id = None
+    try:
+        conversation_id, created = await _resolve_shared_conversation(key, config.get('account_id'), create)
+        return conversation_id, created
+    finally:
+        del conversation_flights[key]
+        flight.set_result(conversation_id)
+
+# ==================== AGRUPAMENTO DE MENSAGENS ====================
+
+async def send_coalesced(config, conversation_id, content, files):
+    """Versão assíncrona de app.send_coalesced."""
+    if files:
+        return await upload_attachment(config, conversation_id, files, content)
+    if conversation_id is None:
+        conversation_id = await send_to_contact_conversation(config, content)
+        return conversation_id, conversation_id is not None
+    return conversation_id, await send_to_chatwoot_existing(config, conversation_id, content)
+
+class _AsyncCoalesceBatch(core._CoalesceBatch):
+    def __init__(self, config, conversation_id, previous):
+        super().__init__(config, conversation_id, previous)
+        self.done = asyncio.Event()
+
+class AsyncMessageCoalescer(core.MessageCoalescer):
+    """Versão para o event loop de app.MessageCoalescer, com as mesmas regras de envio."""
+
+    def __init__(self, window, max_messages):
+        super().__init__(window, max_messages)
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def join(self, config, conversation_id):
+        key = core.coalesce_key(config, conversation_id)
+        batch = self._open.get(key)
+        if batch is None:
+            batch = _AsyncCoalesceBatch(config, conversation_id, self._last.get(key))
+            self._open[key] = self._last[key] = batch
+            batch.task = asyncio.create_task(self._flush(key, batch))
+        slot = core._CoalesceSlot(batch)
+        batch.slots.append(slot)
+        batch.deadline = time.time() + self.window
+        if len(batch.slots) >= self.max_messages:
+            del self._open[key]
+        self._notify()
+        return slot
+
+    def fill(self, slot, content, file_data=None):
+        slot.content = content
+        slot.files = [file_data] if file_data is not None else []
+        slot.state = 'ready'
+        self._notify()
+
+    def cancel(self, slot):
+        if slot.state == 'pending':
+            slot.state = 'cancelled'
+            self._notify()
+
+    async def wait(self, slot):
+        await slot.batch.done.wait()
+        return slot.batch.result
+
+    async def _flush(self, key, batch):
+        while not self._ready(key, batch):
+            remaining = batch.deadline - time.time()
+            try:
+                await asyncio.wait_for(self._changed.wait(), remaining if remaining > 0 and self._open.get(key) is batch else None)
+            except asyncio.TimeoutError:
+                pass
+        if self._open.get(key) is batch:
+            del self._open[key]
+
+        slots = [slot for slot in batch.slots if slot.state == 'ready']
+        for index, slot in enumerate(slots, 1):
+            slot.index = index
+        content = core.coalesced_content([slot.content for slot in slots]) if slots else None
+        batch.result = (batch.conversation_id, False, content, len(slots))
+        try:
+            if batch.previous is not None:
+                await batch.previous.done.wait()
+                # Sem isso cada grupo manteria vivos todos os anteriores da conversa
+                batch.previous = None
+            if slots:
+                files = [file_data for slot in slots for file_data in slot.files]
+                conversation_id, sent = await send_coalesced(batch.config, batch.conversation_id, content, files)
+                batch.result = (conversation_id, sent, content, len(slots))
+        except Exception as e:
+            core.log.error("Erro ao enviar mensagens agrupadas: %s", e)
+        finally:
+            # Os anexos (até MEDIA_SPOOL_BYTES em memória cada) não são mais necessários
+            for slot in batch.slots:
+                slot.content = None
+                slot.files = []
+            batch.done.set()
+            if self._last.get(key) is batch:
+                del self._last[key]
+
+message_coalescer = None
+
+def get_message_coalescer():
+    # Criado sob demanda para pertencer ao event loop do servidor
+    global message_coalescer
+    if message_coalescer is None:
+        message_coalescer = AsyncMessageCoalescer(core.COALESCE_WINDOW_SECONDS, core.COALESCE_MAX_MESSAGES)
+    return message_coalescer
+
+# ==================== ENDPOINTS ====================
+
+def error(message, status, headers=None):
+    return JSONResponse({'success': False, 'error': message}, status_code=status, headers=headers)
+
+async def read_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+def handle_errors(endpoint):
+    """Converte exceções em respostas de erro e registra a duração da requisição."""
+    async def respond(request):
+        try:
+            return await endpoint(request)
+        except core.MediaTooLarge as e:
+            return error(str(e), 413)
+        except core.OpenAIOverloaded as e:
+            return error(str(e), 503, {'Retry-After': str(e.retry_after)})
+        except httpx.HTTPError as e:
+            return error(f'Erro ao fazer requisição: {str(e)}', 500)
+        except Exception as e:
+            return error(f'Erro interno: {str(e)}', 500)
+
+    async def wrapper(request):
+        started = time.perf_counter()
+        context_token = core.begin_request(endpoint.__name__, request.headers.get('X-Request-Id', '')[:64])
+        try:
+            response = await respond(request)
+            core.observe_request(response.status_code, time.perf_counter() - started)
+            response.headers['X-Request-Id'] = core.request_context.get()['request_id']
+            return response
+        finally:
+            core.request_context.reset(context_token)
+    return wrapper
+
+@handle_errors
+async def transcribe(request):
+    data = await read_json(request)
+    if not data or 'twilio_url' not in data:
+        return error('Campo "twilio_url" é obrigatório', 400)
+
+    get_openai_scheduler().admit(['whisper-1'])
+    with await fetch_media(data['twilio_url'], core.audio_max_bytes()) as audio:
+        if audio.status_code != 200:
+            return error(f'Erro ao baixar áudio do Twilio: {audio.status_code}', 400)
+        transcription = await transcribe_audio(audio)
+    return JSONResponse({'success': True, 'transcription': transcription})
+
+@handle_errors
+async def analyze_image(request):
+    data = await read_json(request)
+    if not data or 'twilio_url' not in data:
+        return error('Campo "twilio_url" é obrigatório', 400)
+
+    prompt = data.get('prompt', 'Descreva esta imagem em detalhes.')
+    get_openai_scheduler().admit(['gpt-4.1-mini'])
+    with await fetch_media(data['twilio_url']) as image:
+        if image.status_code != 200:
+            return error(f'Erro ao baixar imagem do Twilio: {image.status_code}', 400)
+        analysis = await describe_image(image, image.content_type or 'image/jpeg', prompt)
+    return JSONResponse({'success': True, 'analysis': analysis})
+
+@handle_errors
+async def extract_document(request):
+    data = await read_json(request)
+    if not data or 'twilio_url' not in data:
+        return error('Campo "twilio_url" é obrigatório', 400)
+
+    twilio_url = data['twilio_url']
+    max_chars = core.parse_max_chars(data.get('max_chars', core.DOCUMENT_MAX_CHARS))
+    if max_chars is None:
+        return error('Campo "max_chars" deve ser um inteiro positivo', 400)
+    if data.get('analyze', False):
+        get_openai_scheduler().admit(['gpt-4.1-mini'])
+    with await fetch_media(twilio_url) as document:
+        if document.status_code != 200:
+            return error(f'Erro ao baixar documento do Twilio: {document.status_code}', 400)
+        content_type = document.content_type or ''
+        # A extração é CPU-bound, então roda fora do event loop
+        extracted_text = await asyncio.to_thread(core.extract_document_text, document.stream(), content_type, twilio_url, max_chars)
+    if extracted_text is None:
+        return error(f'Tipo de documento não suportado: {content_type}', 400)
+
+    result = {'success': True, 'text': extracted_text.strip()}
+    if data.get('analyze', False) and extracted_text.strip():
+        result['analysis'] = await analyze_document_text(extracted_text)
+    return JSONResponse(result)
+
+async def health(request):
+    return JSONResponse({'status': 'ok', 'cache': core.result_cache.stats()})
+
+async def metrics(request):
+    return Response(core.metrics_payload(), headers={'Content-Type': core.CONTENT_TYPE_LATEST})
+
+async def process_and_send_pipeline(data, new_conversation):
+    """Versão assíncrona de app.process_and_send_pipeline."""
+    error_message = core.validate_process_request(data, new_conversation)
+    if error_message:
+        return {'success': False, 'error': error_message}, 400
+
+    message_type = data.get('message_type', '').lower()
+    chatwoot_config = data.get('chatwoot', {})
+    conversation_id = None if new_conversation else chatwoot_config.get('conversation_id')
+
+    tenant_token = core.openai_tenant.set(str(chatwoot_config.get('account_id', '')))
+    coalescer = get_message_coalescer() if core.COALESCE_WINDOW_SECONDS > 0 else None
+    slot = coalescer.join(chatwoot_config, conversation_id) if coalescer else None
+
+    async def send(content, target_id=None, file_data=None):
+        if slot is not None:
+            coalescer.fill(slot, content, file_data)
+            target_id, success, combined, count = await coalescer.wait(slot)
+            result = {
+                'chatwoot_sent': success,
+                'coalesced_messages': count,
+                'coalesced_position': slot.index,
+                'conteudo_agrupado': combined
+            }
+        elif new_conversation and target_id is None:
+            target_id = await send_to_contact_conversation(chatwoot_config, content)
+            result = {'chatwoot_sent': target_id is not None}
+        else:
+            result = {'chatwoot_sent': await send_to_chatwoot_existing(chatwoot_config, target_id or conversation_id, content)}
+        if new_conversation:
+            result['conversation_id'] = target_id
+        return result
+
+    try:
+        if message_type == 'text':
+            conteudo = data['text_content']
+            return {'success': True, 'conteudo': conteudo, **await send(conteudo)}, 200
+
+        if message_type == 'location':
+            conteudo = core.FIXED_TEXTS['location']
+            return {'success': True, 'conteudo': conteudo, **await send(core.location_text(data['latitude'], data['longitude']))}, 200
+
+        try:
+            media = await fetch_media(data['twilio_url'], core.audio_max_bytes() if message_type == 'audio' else core.MEDIA_MAX_BYTES)
+        except core.MediaTooLarge as e:
+            return {'success': False, 'error': str(e)}, 413
+
+        with media:
+            if media.status_code != 200:
+                return {'success': False, 'error': f'Erro ao baixar arquivo: {media.status_code}'}, 400
+
+            content_type = media.content_type or 'application/octet-stream'
+
+            file_data = None
+            if core.CHATWOOT_ATTACHMENTS:
+                file_data = await asyncio.to_thread(core.media_attachment, media, message_type, content_type, data['twilio_url'])
+
+            # O anexo sobe para o Chatwoot enquanto a OpenAI processa a mídia;
+            # com o agrupamento ativo, ele vai junto com a mensagem do grupo
+            upload = None
+            if file_data is not None and slot is None:
+                upload = asyncio.create_task(upload_attachment(chatwoot_config, conversation_id, [file_data]))
+
+            target_id, attachment_sent = None, False
+            processing_error = None
+            try:
+                try:
+                    if message_type == 'audio':
+                        conteudo = core.FIXED_TEXTS['audio'] + await transcribe_audio(media)
+                    elif message_type == 'image':
+                        conteudo = core.FIXED_TEXTS['image'] + await describe_image(media, content_type)
+                    elif message_type == 'document':
+                        conteudo = core.FIXED_TEXTS['document'] + await asyncio.to_thread(core.document_content, media, content_type, data['twilio_url'])
+                    else:
+                        conteudo = core.FIXED_TEXTS['video'] + "(Vídeo enviado - processamento de vídeo não disponível)"
+                finally:
+                    # A mídia só pode ser fechada depois que o upload terminar
+                    target_id, attachment_sent = await upload if upload else (None, False)
+            except Exception as e:
+                if not attachment_sent:
+                    if isinstance(e, core.MediaTooLarge):
+                        return {'success': False, 'error': str(e)}, 413
+                    raise
+                # O anexo já está no Chatwoot e uma retentativa o enviaria de novo
+                core.log.error("Erro ao processar %s já anexado no Chatwoot: %s", message_type, e)
+                conteudo = core.FIXED_TEXTS[message_type] + core.PROCESSING_FALLBACK
+                processing_error = str(e)
+
+            if slot is not None:
+                result = await send(conteudo, file_data=file_data)
+                attachment_sent = file_data is not None and result['chatwoot_sent']
+            else:
+                result = await send(conteudo, target_id)
+            body = {'success': True, 'conteudo': conteudo, **result, 'attachment_sent': attachment_sent}
+            if processing_error:
+                body['processing_error'] = processing_error
+            return body, 200
+    finally:
+        if slot is not None:
+            coalescer.cancel(slot)
+        core.openai_tenant.reset(tenant_token)
+
+# Execuções em andamento por chave de idempotência, neste processo
+idempotency_flights = {}
+
+async def _run_shared_idempotent(key, compute):
+    store = await asyncio.to_thread(core.get_idempotency_store)
+    deadline = time.time() + core.IDEMPOTENCY_LOCK_SECONDS
+    while True:
+        state, stored = await asyncio.to_thread(store.acquire, key)
+        if state == 'done':
+            return stored[0], stored[1], True
+        if state == 'leader':
+            break
+        if time.time() > deadline:
+            return (*core.IN_PROGRESS_RESPONSE, False)
+        await asyncio.sleep(core.IDEMPOTENCY_POLL_SECONDS)
+
+    try:
+        body, status = await compute()
+    except Exception:
+        await asyncio.to_thread(store.release, key)
+        raise
+    await asyncio.to_thread(store.complete, key, body, status)
+    return body, status, False
+
+async def run_idempotent(key, compute):
+    """Versão assíncrona de app.IdempotencyStore.run."""
+    flight = idempotency_flights.get(key)
+    if flight is not None:
+        body, status = await asyncio.shield(flight)
+        if core.replayable(body, status):
+            return body, status, True
+        return await _run_shared_idempotent(key, compute)
+
+    flight = idempotency_flights[key] = asyncio.get_running_loop().create_future()
+    result = (None, 500)
+    try:
+        body, status, replayed = await _run_shared_idempotent(key, compute)
+        result = (body, status)
+        return body, status, replayed
+    finally:
+        del idempotency_flights[key]
+        flight.set_result(result)
+
+async def run_process_and_send(request, kind, new_conversation):
+    data = await read_json(request)
+    if not data:
+        return error('Body vazio', 400)
+    core.set_message_type(data.get('message_type', '').lower())
+
+    async def run():
+        if data.get('async'):
+            return await asyncio.to_thread(core.enqueue_process_job, kind, data, new_conversation)
+        models = core.MESSAGE_MODELS.get(data.get('message_type', '').lower(), [])
+        get_openai_scheduler().admit(models, str(data.get('chatwoot', {}).get('account_id', '')))
+        return await process_and_send_pipeline(data, new_conversation)
+
+    key = core.idempotency_key(data, kind, request.headers.get('Idempotency-Key'))
+    if key is None:
+        body, status = await run()
+        replayed = False
+    else:
+        body, status, replayed = await run_idempotent(key, run)
+
+    headers = {'Idempotent-Replayed': 'true'} if replayed else None
+    return JSONResponse(body, status_code=status, headers=headers)
+
+@handle_errors
+async def process_and_send_new(request):
+    return await run_process_and_send(request, 'process-and-send-new', new_conversation=True)
+
+@handle_errors
+async def process_and_send(request):
+    return await run_process_and_send(request, 'process-and-send', new_conversation=False)
+
+@handle_errors
+async def job_status(request):
+    job = await asyncio.to_thread(lambda: core.get_job_queue().get(request.path_params['job_id']))
+    if job is None:
+        return error('Job não encontrado', 404)
+    return JSONResponse({'success': True, **job})
+
+@handle_errors
+async def chatwoot_webhook(request):
+    refused = core.webhook_token_error(request.query_params.get('token'))
+    if refused:
+        return error(*refused)
+
+    resolved = core.resolved_conversation(await read_json(request) or {})
+    if resolved is None:
+        return JSONResponse({'success': True, 'invalidated': 0})
+    resolver = await asyncio.to_thread(core.get_conversation_resolver)
+    invalidated = await asyncio.to_thread(resolver.invalidate, *resolved)
+    return JSONResponse({'success': True, 'invalidated': invalidated})
+
+@asynccontextmanager
+async def lifespan(app):
+    await asyncio.to_thread(core.start_job_queue, True)
+    yield
+    if http_client is not None:
+        await http_client.aclose()
+    if openai_client is not None:
+        await openai_client.close()
+
+app = Starlette(
+    routes=[
+        Route('/transcribe', transcribe, methods=['POST']),
+        Route('/analyze-image', analyze_image, methods=['POST']),
+        Route('/extract-document', extract_document, methods=['POST']),
+        Route('/health', health, methods=['GET']),
+        Route('/metrics', metrics, methods=['GET']),
+        Route('/process-and-send-new', process_and_send_new, methods=['POST']),
+        Route('/process-and-send', process_and_send, methods=['POST']),
+        Route('/jobs/{job_id}', job_status, methods=['GET']),
+        Route('/chatwoot/webhook', chatwoot_webhook, methods=['POST']),
+    ],
+    lifespan=lifespan
+)
@@ -0,0 +1,338 @@
+"""Servidores locais que imitam Twilio, OpenAI e Chatwoot para os benchmarks.
+
+- FakeTwilio serve mídias (áudio, imagem, documento) do tamanho pedido. Cada
+  URL com ?n= devolve um conteúdo diferente, para não cair no cache de
+  resultados.
+- FakeOpenAI responde /v1/audio/transcriptions e /v1/chat/completions no
+  formato do SDK (whisper-1 e gpt-4.1-mini). Tem latência configurável e dois
+  modos de 429: uma fração aleatória das chamadas ou um limite de requisições
+  por minuto, informado nos headers x-ratelimit-*.
+- FakeChatwoot cria conversas, aceita mensagens e anexos e guarda os envios
+  recebidos.
+
+Uso avulso, para apontar um servidor iniciado à mão:
+    python bench/fakes.py --openai-latency 0.8 --openai-429-rate 0.05
+"""
+import argparse
+import io
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+CONTENT_TYPES = {
+    'audio': 'audio/ogg',
+    'image': 'image/jpeg',
+    'document': 'application/pdf',
+    'text': 'text/plain',
+}
+
+def noise_jpeg(target_bytes):
+    """JPEG com ruído de aproximadamente target_bytes (o ruído não comprime, como numa foto)."""
+    from PIL import Image
+
+    side = 256
+    for _ in range(3):
+        image = Image.effect_noise((side, side), 40).convert('RGB')
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=90)
+        side = max(64, int(side * (target_bytes / buffer.tell()) ** 0.5))
+    return buffer.getvalue()
+
+def text_pdf(pages, lines_per_page=40):
+    """PDF com texto extraível, montado à mão para não depender de outra biblioteca."""
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>', None, b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    kids = []
+    for page in range(pages):
+        text = b' '.join(
+            b'BT /F1 9 Tf 20 %d Td (Pagina %d linha %d: item %d valor R$ %d,%02d) Tj ET' % (
+                800 - line * 19, page + 1, line + 1, line, (page * 37 + line * 11) % 900, line % 100
+            )
+            for line in range(lines_per_page)
+        )
+        objects.append(b'<< /Length %d >>\nstream\n' % len(text) + text + b'\nendstream')
+        objects.append(
+            b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] '
+            b'/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>' % len(objects)
+        )
+        kids.append(len(objects))
+    objects[1] = b'<< /Type /Pages /Kids [' + b' '.join(b'%d 0 R' % kid for kid in kids) + b'] /Count %d >>' % len(kids)
+
+    out = b'%PDF-1.4\n'
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b'%d 0 obj\n' % number + body + b'\nendobj\n'
+    xref = len(out)
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    out += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    out += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    return out
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def reply(self, status, body, content_type='application/json', headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.fake.get(self)
+
+    def do_POST(self):
+        self.server.fake.post(self)
+
+class FakeServer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.httpd = None
+
+    def start(self, port=0):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.httpd.server_address[1]}'
+
+    def get(self, handler):
+        handler.reply(404, {'error': 'not found'})
+
+    def post(self, handler):
+        handler.reply(404, {'error': 'not found'})
+
+class FakeTwilio(FakeServer):
+    """GET /media/<tipo>?size=<bytes>&n=<id> (pages=<n> para documentos)."""
+
+    def __init__(self, latency=0.0):
+        super().__init__()
+        self.latency = latency
+        self.requests = 0
+        self.bytes_sent = 0
+        self._templates = {}
+
+    def template(self, kind, size, pages):
+        key = (kind, size, pages)
+        with self.lock:
+            body = self._templates.get(key)
+        if body is None:
+            if kind == 'image':
+                body = noise_jpeg(size)
+            elif kind == 'document':
+                body = text_pdf(pages)
+            else:
+                body = random.Random(size).randbytes(size)
+            with self.lock:
+                self._templates[key] = body
+        return body
+
+    def get(self, handler):
+        url = urlparse(handler.path)
+        query = parse_qs(url.query)
+        kind = url.path.rstrip('/').split('/')[-1]
+        if kind not in CONTENT_TYPES:
+            return handler.reply(404, {'error': f'tipo desconhecido: {kind}'})
+        body = self.template(kind, int(query.get('size', ['65536'])[0]), int(query.get('pages', ['3'])[0]))
+        tag = query.get('n', [''])[0].encode('ascii')
+        if tag:
+            # Conteúdo diferente a cada n, sem invalidar o formato
+            if kind == 'image':
+                body = body[:2] + b'\xff\xfe' + (len(tag) + 2).to_bytes(2, 'big') + tag + body[2:]
+            elif kind == 'document':
+                body = body + b'%' + tag + b'\n'
+            else:
+                body = tag + body[len(tag):]
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.requests += 1
+            self.bytes_sent += len(body)
+        handler.reply(200, body, CONTENT_TYPES[kind])
+
+    def stats(self):
+        return {'requests': self.requests, 'bytes': self.bytes_sent}
+
+class FakeOpenAI(FakeServer):
+    """Imita whisper-1 e gpt-4.1-mini.
+
+    latency é a média em segundos, com variação uniforme de +-jitter. rate_429
+    é a fração de chamadas recusadas ao acaso; rpm, se definido, é um limite
+    de requisições por minuto aplicado de verdade (balde contínuo), com os
+    headers x-ratelimit-* que o agendador do app usa para se ajustar.
+    """
+
+    def __init__(self, latency=0.5, jitter=0.5, rate_429=0.0, rpm=None, seed=None):
+        super().__init__()
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.rpm = rpm
+        self.random = random.Random(seed)
+        self.calls = {}
+        self.rejected = 0
+        self.tokens = 0
+        self._level = float(rpm or 0)
+        self._updated = time.monotonic()
+
+    def _admit(self):
+        """Retorna (aceita, headers de limite)."""
+        with self.lock:
+            if self.rate_429 and self.random.random() < self.rate_429:
+                self.rejected += 1
+                return False, {'retry-after-ms': '500'}
+            if not self.rpm:
+                return True, {}
+            now = time.monotonic()
+            self._level = min(self.rpm, self._level + (now - self._updated) * self.rpm / 60)
+            self._updated = now
+            if self._level < 1:
+                self.rejected += 1
+                reset = (1 - self._level) * 60 / self.rpm
+                return False, {
+                    'x-ratelimit-limit-requests': str(self.rpm),
+                    'x-ratelimit-remaining-requests': '0',
+                    'x-ratelimit-reset-requests': f'{int(reset * 1000)}ms',
+                }
+            self._level -= 1
+            return True, {
+                'x-ratelimit-limit-requests': str(self.rpm),
+                'x-ratelimit-remaining-requests': str(int(self._level)),
+            }
+
+    def _sleep(self):
+        if self.latency:
+            time.sleep(max(0.0, self.latency * self.random.uniform(1 - self.jitter, 1 + self.jitter)))
+
+    def post(self, handler):
+        path = urlparse(handler.path).path
+        body = handler.read_body()
+        if path.endswith('/audio/transcriptions'):
+            model = 'whisper-1'
+        elif path.endswith('/chat/completions'):
+            model = json.loads(body).get('model', 'gpt-4.1-mini')
+        else:
+            return handler.reply(404, {'error': {'message': f'rota desconhecida: {path}'}})
+
+        accepted, headers = self._admit()
+        if not accepted:
+            return handler.reply(429, {
+                'error': {'message': 'Rate limit reached', 'type': 'requests', 'code': 'rate_limit_exceeded'}
+            }, headers=headers)
+
+        self._sleep()
+        with self.lock:
+            self.calls[model] = self.calls.get(model, 0) + 1
+        if model == 'whisper-1':
+            return handler.reply(200, {'text': f'Transcrição simulada de {len(body)} bytes.'}, headers=headers)
+
+        prompt_tokens = len(body) // 4
+        completion_tokens = 60
+        with self.lock:
+            self.tokens += prompt_tokens + completion_tokens
+        handler.reply(200, {
+            'id': 'chatcmpl-bench',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': model,
+            'choices': [{
+                'index': 0,
+                'finish_reason': 'stop',
+                'message': {'role': 'assistant', 'content': 'Análise simulada do conteúdo enviado.'},
+            }],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens,
+            },
+        }, headers=headers)
+
+    def stats(self):
+        return {'calls': dict(self.calls), 'rejected_429': self.rejected, 'tokens': self.tokens}
+
+class FakeChatwoot(FakeServer):
+    """Cria conversas e aceita mensagens (JSON ou multipart), guardando cada envio."""
+
+    def __init__(self, latency=0.05, rate_429=0.0, seed=None):
+        super().__init__()
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.random = random.Random(seed)
+        self.posts = []
+        self._next_id = 1000
+
+    def post(self, handler):
+        path = urlparse(handler.path).path
+        body = handler.read_body()
+        content_type = handler.headers.get('Content-Type', '').split(';')[0]
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            rejected = self.rate_429 and self.random.random() < self.rate_429
+        if rejected:
+            return handler.reply(429, {'error': 'Too many requests'}, headers={'Retry-After': '1'})
+        with self.lock:
+            self._next_id += 1
+            record_id = self._next_id
+            self.posts.append({
+                'path': path,
+                'kind': 'attachment' if content_type == 'multipart/form-data' else
+                        'conversation' if path.endswith('/conversations') else 'message',
+                'bytes': len(body),
+                'at': time.time(),
+            })
+        handler.reply(200, {'id': record_id})
+
+    def stats(self):
+        with self.lock:
+            kinds = {}
+            for post in self.posts:
+                kinds[post['kind']] = kinds.get(post['kind'], 0) + 1
+            return {'posts': len(self.posts), **kinds, 'bytes': sum(post['bytes'] for post in self.posts)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--openai-latency', type=float, default=0.5)
+    parser.add_argument('--openai-jitter', type=float, default=0.5)
+    parser.add_argument('--openai-429-rate', type=float, default=0.0)
+    parser.add_argument('--openai-rpm', type=int)
+    parser.add_argument('--chatwoot-latency', type=float, default=0.05)
+    parser.add_argument('--twilio-latency', type=float, default=0.0)
+    args = parser.parse_args()
+
+    twilio = FakeTwilio(args.twilio_latency).start()
+    openai = FakeOpenAI(args.openai_latency, args.openai_jitter, args.openai_429_rate, args.openai_rpm).start()
+    chatwoot = FakeChatwoot(args.chatwoot_latency).start()
+    print(f"Twilio:   {twilio.url}/media/audio?size=65536&n=1")
+    print(f"OpenAI:   OPENAI_BASE_URL={openai.url}/v1")
+    print(f"Chatwoot: {chatwoot.url}")
+    try:
+        while True:
+            time.sleep(10)
+            print(json.dumps({'twilio': twilio.stats(), 'openai': openai.stats(), 'chatwoot': chatwoot.stats()}))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
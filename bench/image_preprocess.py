@@ -0,0 +1,135 @@
+"""Benchmark do pré-processamento de imagens (app.prepare_image).
+
+Mede, para cada imagem do corpus, o tamanho original e o enviado à OpenAI
+(já em base64), o tempo de pré-processamento e, com --live, a latência e os
+tokens de entrada do gpt-4.1-mini com e sem o pré-processamento.
+
+Uso:
+    python bench/image_preprocess.py                  # corpus sintético (offline)
+    python bench/image_preprocess.py fotos/ --live    # corpus próprio + chamadas reais
+"""
+import argparse
+import io
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app as core
+
+CONTENT_TYPES = {
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+    '.webp': 'image/webp',
+    '.gif': 'image/gif',
+}
+
+def synthetic_corpus():
+    """Gera fotos de comprovantes (JPEG de celular) e prints de tela (PNG)."""
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(42)
+    corpus = []
+    for i in range(4):
+        receipt = Image.new('RGB', (3024, 4032), (235, 232, 225))
+        draw = ImageDraw.Draw(receipt)
+        draw.rectangle((600, 300, 2400, 3800), fill=(250, 250, 248))
+        for line in range(60):
+            y = 400 + line * 55
+            draw.text((700, y), f"ITEM {line:02d} ........ R$ {rng.randint(1, 999)},{rng.randint(0, 99):02d}", fill=(20, 20, 20))
+        # Ruído de sensor, que é o que infla o JPEG de uma foto real
+        noise = Image.effect_noise((3024, 4032), 12).convert('RGB')
+        receipt = Image.blend(receipt, noise, 0.08)
+        buffer = io.BytesIO()
+        receipt.save(buffer, format='JPEG', quality=95)
+        corpus.append((f'comprovante_{i}.jpg', buffer.getvalue(), 'image/jpeg'))
+
+    for i in range(4):
+        screenshot = Image.new('RGB', (1080, 2400), (255, 255, 255))
+        draw = ImageDraw.Draw(screenshot)
+        draw.rectangle((0, 0, 1080, 180), fill=(7, 94, 84))
+        for line in range(30):
+            y = 220 + line * 70
+            x = 40 if line % 2 else 400
+            draw.rounded_rectangle((x, y, x + 640, y + 56), 12, fill=(220, 248, 198) if line % 2 else (240, 240, 240))
+            draw.text((x + 20, y + 18), f"mensagem {line} do pedido {rng.randint(1000, 9999)}", fill=(0, 0, 0))
+        buffer = io.BytesIO()
+        screenshot.save(buffer, format='PNG')
+        corpus.append((f'print_{i}.png', buffer.getvalue(), 'image/png'))
+    return corpus
+
+def load_corpus(directory):
+    corpus = []
+    for name in sorted(os.listdir(directory)):
+        content_type = CONTENT_TYPES.get(os.path.splitext(name)[1].lower())
+        if content_type:
+            with open(os.path.join(directory, name), 'rb') as f:
+                corpus.append((name, f.read(), content_type))
+    return corpus
+
+def to_media(data, content_type):
+    media = core.Media(200, content_type, max_bytes=len(data))
+    media.write(data)
+    return media
+
+def payload_size(image):
+    return len(core.image_data_url(image.stream, image.content_type))
+
+def timed_call(image, prompt):
+    started = time.perf_counter()
+    response = core.get_openai_client().chat.completions.create(
+        model="gpt-4.1-mini",
+        messages=core.image_messages(core.image_data_url(image.stream, image.content_type), prompt, image.detail),
+        max_tokens=300
+    )
+    return time.perf_counter() - started, response.usage.prompt_tokens
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('corpus', nargs='?', help='pasta com imagens (padrão: corpus sintético)')
+    parser.add_argument('--live', action='store_true', help='chama o gpt-4.1-mini (requer OPENAI_API_KEY)')
+    parser.add_argument('--prompt', default='Descreva esta imagem em detalhes.')
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus) if args.corpus else synthetic_corpus()
+    if not corpus:
+        sys.exit('Nenhuma imagem encontrada no corpus')
+
+    print(f"{'arquivo':<20} {'original':>10} {'enviado':>10} {'redução':>8} {'prep ms':>8} {'detail':>6}"
+          + (f" {'lat. orig':>9} {'lat. prep':>9} {'tok orig':>8} {'tok prep':>8}" if args.live else ''))
+    reductions, prep_times, latency_gains = [], [], []
+    for name, data, content_type in corpus:
+        with to_media(data, content_type) as media:
+            raw = core.PreparedImage(media.stream(), content_type, 'auto', media.size, media.size)
+            original_payload = payload_size(raw)
+
+            started = time.perf_counter()
+            image = core.prepare_image(media, content_type)
+            prep_ms = (time.perf_counter() - started) * 1000
+            sent_payload = payload_size(image)
+
+            reduction = 100 * (1 - sent_payload / original_payload)
+            reductions.append(reduction)
+            prep_times.append(prep_ms)
+            line = f"{name:<20} {original_payload:>10} {sent_payload:>10} {reduction:>7.1f}% {prep_ms:>8.1f} {image.detail:>6}"
+
+            if args.live:
+                raw_latency, raw_tokens = timed_call(raw._replace(stream=media.stream()), args.prompt)
+                image.stream.seek(0)
+                prep_latency, prep_tokens = timed_call(image, args.prompt)
+                latency_gains.append(raw_latency - prep_latency - prep_ms / 1000)
+                line += f" {raw_latency:>8.2f}s {prep_latency:>8.2f}s {raw_tokens:>8} {prep_tokens:>8}"
+            print(line)
+
+    print()
+    print(f"Redução média do payload: {statistics.mean(reductions):.1f}%")
+    print(f"Pré-processamento: média {statistics.mean(prep_times):.1f} ms, máx {max(prep_times):.1f} ms")
+    if latency_gains:
+        print(f"Ganho médio de latência (já descontado o pré-processamento): {statistics.mean(latency_gains):.2f}s")
+
+if __name__ == '__main__':
+    main()
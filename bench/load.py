@@ -0,0 +1,343 @@
+"""Teste de carga offline dos endpoints, com Twilio, OpenAI e Chatwoot simulados.
+
+Sobe os servidores falsos de bench/fakes.py, inicia o app (gunicorn app:app
+ou uvicorn asgi:app) apontando para eles e dispara uma mistura de mensagens
+em cada nível de concorrência. Para cada combinação de servidor,
+configuração e concorrência mostra vazão e latência p50/p95/p99 por
+endpoint e message_type, além do que chegou à OpenAI e ao Chatwoot.
+
+Uso:
+    python bench/load.py                                   # flask e asgi, concorrência 1, 8 e 32
+    python bench/load.py --servers asgi --concurrency 64 --duration 60
+    python bench/load.py --openai-latency 1.5 --openai-rpm 600 --media-kb 512
+    python bench/load.py --config base: --config sem-anexo:CHATWOOT_ATTACHMENTS=false
+    python bench/load.py --save base.json                  # guarda os resultados
+    python bench/load.py --compare base.json --tolerance 0.2   # sai com erro se piorar
+
+O áudio servido não é decodificável, então AUDIO_CHUNKING fica desligado
+(a divisão de áudios longos depende do ffmpeg e é medida à parte).
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import FakeChatwoot, FakeOpenAI, FakeTwilio
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# (endpoint, message_type, peso na mistura)
+SCENARIOS = [
+    ('/process-and-send', 'audio', 3),
+    ('/process-and-send', 'image', 2),
+    ('/process-and-send', 'document', 1),
+    ('/process-and-send', 'text', 3),
+    ('/process-and-send-new', 'audio', 1),
+    ('/process-and-send-new', 'text', 1),
+    ('/transcribe', 'audio', 1),
+    ('/analyze-image', 'image', 1),
+    ('/extract-document', 'document', 1),
+]
+
+SERVER_COMMANDS = {
+    'flask': lambda port, args: [
+        sys.executable, '-m', 'gunicorn', 'app:app', '-b', f'127.0.0.1:{port}',
+        '-w', str(args.workers), '-k', 'gthread', '--threads', str(args.threads), '--timeout', '300',
+    ],
+    'asgi': lambda port, args: [
+        sys.executable, '-m', 'uvicorn', 'asgi:app', '--host', '127.0.0.1', '--port', str(port),
+        '--workers', str(args.workers), '--log-level', 'warning',
+    ],
+}
+
+# Limites altos por padrão: quem limita é o FakeOpenAI (--openai-rpm), que o agendador aprende pelos headers
+BENCH_RATE_LIMITS = {'gpt-4.1-mini': {'rpm': 100000, 'tpm': 100000000}, 'whisper-1': {'rpm': 100000}}
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def percentile(values, fraction):
+    """Percentil pelo método nearest-rank."""
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+class Workload:
+    """Gera as requisições: URLs de mídia únicas (sem acerto de cache) e contatos repetidos."""
+
+    def __init__(self, args, twilio_url, chatwoot_url):
+        self.args = args
+        self.twilio_url = twilio_url
+        self.chatwoot_url = chatwoot_url
+        self.scenarios = [s for s in SCENARIOS if not args.only or f'{s[0]}:{s[1]}' in args.only or s[0] in args.only]
+        if not self.scenarios:
+            sys.exit(f'Nenhum cenário corresponde a --only {",".join(args.only)}')
+        self.weights = [s[2] for s in self.scenarios]
+        self.counter = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def media_url(self, kind, n):
+        query = f'size={self.args.media_kb * 1024}&pages={self.args.doc_pages}'
+        if not self.args.cache_hits:
+            query += f'&n={self.args.run_id}-{n}'
+        return f'{self.twilio_url}/media/{kind}?{query}'
+
+    def next(self, rng):
+        with self._lock:
+            n = next(self.counter)
+        endpoint, message_type, _ = rng.choices(self.scenarios, self.weights)[0]
+        chatwoot = {
+            'api_url': self.chatwoot_url,
+            'api_token': 'bench',
+            'account_id': rng.randrange(self.args.accounts) + 1,
+            'inbox_id': 1,
+            'source_id': f'contato-{rng.randrange(self.args.contacts)}',
+            'conversation_id': 500 + rng.randrange(self.args.contacts),
+        }
+        if endpoint == '/transcribe':
+            return endpoint, message_type, {'twilio_url': self.media_url('audio', n)}
+        if endpoint == '/analyze-image':
+            return endpoint, message_type, {'twilio_url': self.media_url('image', n)}
+        if endpoint == '/extract-document':
+            return endpoint, message_type, {'twilio_url': self.media_url('document', n), 'analyze': self.args.analyze}
+
+        payload = {'message_type': message_type, 'chatwoot': chatwoot, 'message_sid': f'SM{self.args.run_id}{n}'}
+        if message_type == 'text':
+            payload['text_content'] = f'Mensagem de teste {n}'
+        else:
+            payload['twilio_url'] = self.media_url(message_type, n)
+        return endpoint, message_type, payload
+
+def drive(base_url, workload, concurrency, duration, seed):
+    """Mantém `concurrency` requisições em andamento por `duration` segundos."""
+    results = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(index):
+        rng = random.Random(seed * 1000 + index)
+        session = requests.Session()
+        while time.perf_counter() < deadline:
+            endpoint, message_type, payload = workload.next(rng)
+            started = time.perf_counter()
+            try:
+                status = session.post(base_url + endpoint, json=payload, timeout=300).status_code
+            except requests.exceptions.RequestException:
+                status = 0
+            with lock:
+                results.append((endpoint, message_type, status, time.perf_counter() - started))
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - started
+
+def summarize(results, elapsed):
+    groups = {}
+    for endpoint, message_type, status, latency in results:
+        groups.setdefault((endpoint, message_type), []).append((status, latency))
+    groups[('total', '')] = [(status, latency) for _, _, status, latency in results]
+
+    rows = []
+    for (endpoint, message_type), samples in groups.items():
+        ok = [latency for status, latency in samples if 200 <= status < 300]
+        rows.append({
+            'endpoint': endpoint,
+            'message_type': message_type,
+            'requests': len(samples),
+            'errors': sum(1 for status, _ in samples if not 200 <= status < 300 and status != 503),
+            'shed': sum(1 for status, _ in samples if status == 503),
+            'rps': len(ok) / elapsed,
+            'p50': percentile(ok, 0.50),
+            'p95': percentile(ok, 0.95),
+            'p99': percentile(ok, 0.99),
+        })
+    rows.sort(key=lambda row: (row['endpoint'] == 'total', row['endpoint'], row['message_type']))
+    return rows
+
+def print_rows(rows):
+    print(f"  {'endpoint':<22} {'message_type':<12} {'req':>6} {'erros':>6} {'503':>5} {'req/s':>7} {'p50':>7} {'p95':>7} {'p99':>7}")
+    for row in rows:
+        print(
+            f"  {row['endpoint']:<22} {row['message_type']:<12} {row['requests']:>6} {row['errors']:>6} {row['shed']:>5} "
+            f"{row['rps']:>7.2f} {row['p50']:>6.2f}s {row['p95']:>6.2f}s {row['p99']:>6.2f}s"
+        )
+
+def wait_ready(base_url, process, log_path, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            break
+        try:
+            if requests.get(base_url + '/health', timeout=1).status_code == 200:
+                return
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.2)
+    process.kill()
+    with open(log_path, errors='replace') as f:
+        sys.exit(f'O servidor não respondeu em {timeout}s. Log ({log_path}):\n{f.read()[-3000:]}')
+
+def start_server(kind, args, env, workdir):
+    port = free_port()
+    log_path = os.path.join(workdir, f'{kind}-{port}.log')
+    log_file = open(log_path, 'w')
+    process = subprocess.Popen(SERVER_COMMANDS[kind](port, args), cwd=ROOT, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+    base_url = f'http://127.0.0.1:{port}'
+    wait_ready(base_url, process, log_path)
+    return process, base_url, log_file
+
+def stop_server(process, log_file):
+    process.terminate()
+    try:
+        process.wait(15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+    log_file.close()
+
+def server_env(args, fakes, workdir, overrides):
+    env = dict(os.environ)
+    env.update({
+        'OPENAI_API_KEY': 'bench',
+        'OPENAI_BASE_URL': f"{fakes['openai'].url}/v1",
+        'OPENAI_RATE_LIMITS': json.dumps(BENCH_RATE_LIMITS),
+        'AUDIO_CHUNKING': 'false',
+        'LOG_LEVEL': 'WARNING',
+        # Bancos novos a cada execução, para uma rodada não aproveitar a anterior
+        'JOBS_DB_PATH': os.path.join(workdir, 'jobs.sqlite3'),
+        'IDEMPOTENCY_DB_PATH': os.path.join(workdir, 'idempotency.sqlite3'),
+        'CONVERSATIONS_DB_PATH': os.path.join(workdir, 'conversations.sqlite3'),
+    })
+    env.pop('CACHE_DB_PATH', None)
+    env.pop('PROMETHEUS_MULTIPROC_DIR', None)
+    env.update(overrides)
+    return env
+
+def parse_config(value):
+    name, _, assignments = value.partition(':')
+    overrides = dict(item.split('=', 1) for item in assignments.split(',') if item)
+    return name or 'base', overrides
+
+def compare(results, baseline_path, tolerance):
+    """Compara com uma execução salva; retorna as linhas que pioraram além da tolerância."""
+    with open(baseline_path) as f:
+        baseline = {
+            (run['server'], run['config'], run['concurrency'], row['endpoint'], row['message_type']): row
+            for run in json.load(f) for row in run['rows']
+        }
+    regressions = []
+    for run in results:
+        for row in run['rows']:
+            key = (run['server'], run['config'], run['concurrency'], row['endpoint'], row['message_type'])
+            before = baseline.get(key)
+            if before is None or row['requests'] < 20:
+                continue
+            if row['p95'] > before['p95'] * (1 + tolerance):
+                regressions.append(f"{' '.join(map(str, key))}: p95 {before['p95']:.2f}s -> {row['p95']:.2f}s")
+            if row['endpoint'] == 'total' and row['rps'] < before['rps'] * (1 - tolerance):
+                regressions.append(f"{' '.join(map(str, key))}: vazão {before['rps']:.2f} -> {row['rps']:.2f} req/s")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--servers', default='flask,asgi', help='flask, asgi ou URL de um servidor já em execução')
+    parser.add_argument('--concurrency', default='1,8,32', help='níveis de concorrência, separados por vírgula')
+    parser.add_argument('--duration', type=float, default=20, help='segundos por nível')
+    parser.add_argument('--workers', type=int, default=1, help='processos do gunicorn/uvicorn')
+    parser.add_argument('--threads', type=int, default=16, help='threads por worker do gunicorn')
+    parser.add_argument('--config', action='append', metavar='NOME:VAR=VALOR,...',
+                        help='configuração do servidor (variáveis de ambiente); pode repetir')
+    parser.add_argument('--only', type=lambda v: v.split(','), default=[],
+                        help='cenários, ex.: /transcribe,/process-and-send:audio')
+    parser.add_argument('--media-kb', type=int, default=256, help='tamanho das mídias servidas')
+    parser.add_argument('--doc-pages', type=int, default=5, help='páginas dos PDFs servidos')
+    parser.add_argument('--analyze', action='store_true', help='extract-document com analyze=true')
+    parser.add_argument('--cache-hits', action='store_true', help='repete as mesmas mídias (mede o cache)')
+    parser.add_argument('--accounts', type=int, default=4, help='contas do Chatwoot distintas')
+    parser.add_argument('--contacts', type=int, default=200, help='contatos/conversas distintos')
+    parser.add_argument('--openai-latency', type=float, default=0.5)
+    parser.add_argument('--openai-jitter', type=float, default=0.5)
+    parser.add_argument('--openai-429-rate', type=float, default=0.0, help='fração de chamadas com 429')
+    parser.add_argument('--openai-rpm', type=int, help='limite de requisições por minuto do FakeOpenAI')
+    parser.add_argument('--chatwoot-latency', type=float, default=0.05)
+    parser.add_argument('--chatwoot-429-rate', type=float, default=0.0)
+    parser.add_argument('--twilio-latency', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--save', help='grava os resultados em JSON')
+    parser.add_argument('--compare', help='JSON de uma execução anterior para comparar')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='piora aceita no p95 e na vazão (0.2 = 20%%)')
+    args = parser.parse_args()
+    args.run_id = f'{int(time.time())}'
+
+    fakes = {
+        'twilio': FakeTwilio(args.twilio_latency).start(),
+        'openai': FakeOpenAI(args.openai_latency, args.openai_jitter, args.openai_429_rate, args.openai_rpm, args.seed).start(),
+        'chatwoot': FakeChatwoot(args.chatwoot_latency, args.chatwoot_429_rate, args.seed).start(),
+    }
+    workload = Workload(args, fakes['twilio'].url, fakes['chatwoot'].url)
+    configs = [parse_config(value) for value in (args.config or ['base:'])]
+    levels = [int(level) for level in args.concurrency.split(',')]
+
+    results = []
+    for server, (config_name, overrides) in itertools.product(args.servers.split(','), configs):
+        with tempfile.TemporaryDirectory(prefix='bench-') as workdir:
+            process = log_file = None
+            if server in SERVER_COMMANDS:
+                process, base_url, log_file = start_server(server, args, server_env(args, fakes, workdir, overrides), workdir)
+            else:
+                base_url = server.rstrip('/')
+            try:
+                for concurrency in levels:
+                    before = {name: fake.stats() for name, fake in fakes.items()}
+                    rows = summarize(*drive(base_url, workload, concurrency, args.duration, args.seed))
+                    after = {name: fake.stats() for name, fake in fakes.items()}
+                    print(f"\n== {server} (workers={args.workers}) | {config_name} {overrides or ''} | concorrência {concurrency} ==")
+                    print_rows(rows)
+                    openai_calls = sum(after['openai']['calls'].values()) - sum(before['openai']['calls'].values())
+                    print(
+                        f"  OpenAI: {openai_calls} chamadas, {after['openai']['rejected_429'] - before['openai']['rejected_429']} com 429 | "
+                        f"Chatwoot: {after['chatwoot']['posts'] - before['chatwoot']['posts']} envios "
+                        f"({after['chatwoot'].get('attachment', 0) - before['chatwoot'].get('attachment', 0)} anexos) | "
+                        f"Twilio: {(after['twilio']['bytes'] - before['twilio']['bytes']) / 1024 / 1024:.1f} MB"
+                    )
+                    results.append({
+                        'server': server, 'config': config_name, 'overrides': overrides,
+                        'workers': args.workers, 'concurrency': concurrency, 'rows': rows,
+                    })
+            finally:
+                if process is not None:
+                    stop_server(process, log_file)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResultados gravados em {args.save}")
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        if regressions:
+            print(f"\nPioras acima de {args.tolerance:.0%} em relação a {args.compare}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"\nSem pioras acima de {args.tolerance:.0%} em relação a {args.compare}")
+
+if __name__ == '__main__':
+    main()
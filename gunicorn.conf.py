@@ -0,0 +1,6 @@
+# Lido automaticamente pelo gunicorn quando iniciado nesta pasta
+
+def post_worker_init(worker):
+    # A fila de jobs roda nos workers, nunca no master nem em processos que só importam o app
+    import app
+    app.start_job_queue(server=True)
@@ -0,0 +1,37 @@
+"""Extração de páginas de PDF nos processos do pool de extração.
+
+Fica fora do app.py para que cada processo do pool importe só o PyPDF2,
+e não o serviço inteiro (Flask, OpenAI, métricas, logs).
+"""
+import logging
+import signal
+
+import PyPDF2
+
+log = logging.getLogger('twilio_whisper')
+
+class PageTimeout(Exception):
+    pass
+
+def _raise_page_timeout(signum, frame):
+    raise PageTimeout()
+
+def extract_batch(path, start, stop, page_timeout):
+    """Extrai as páginas [start, stop) do PDF, ignorando as que passam de page_timeout."""
+    use_alarm = hasattr(signal, 'setitimer')
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _raise_page_timeout)
+    reader = PyPDF2.PdfReader(path)
+    pages = []
+    for number in range(start, stop):
+        try:
+            if use_alarm:
+                signal.setitimer(signal.ITIMER_REAL, page_timeout)
+            pages.append(reader.pages[number].extract_text() or '')
+        except PageTimeout:
+            log.warning("Página %s excedeu %ss e foi ignorada", number + 1, page_timeout)
+            pages.append('')
+        finally:
+            if use_alarm:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+    return pages
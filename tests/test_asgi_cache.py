@@ -0,0 +1,57 @@
+import asyncio
+import io
+import threading
+
+import app as core
+import asgi
+
+class RecordingCache:
+    def __init__(self, value=None):
+        self.value = value
+        self.threads = []
+
+    def make_key(self, *args, **kwargs):
+        return 'key'
+
+    def get(self, key):
+        self.threads.append(threading.current_thread())
+        return self.value
+
+    def set(self, key, value):
+        self.threads.append(threading.current_thread())
+
+def test_cache_is_read_outside_the_event_loop(monkeypatch):
+    cache = RecordingCache('em cache')
+    monkeypatch.setattr(core, 'result_cache', cache)
+    assert asyncio.run(asgi.complete_text('resuma', 100)) == 'em cache'
+    assert cache.threads and threading.main_thread() not in cache.threads
+
+def test_async_body_streams_the_whole_multipart_body(monkeypatch):
+    monkeypatch.setattr(core, 'DOWNLOAD_CHUNK_SIZE', 7)
+    body = core.MultipartBody([('content', 'oi')], 'attachments[]', [('a.bin', io.BytesIO(b'x' * 50), 'application/octet-stream')])
+
+    async def collect():
+        return b''.join([chunk async for chunk in asgi.AsyncBody(body)])
+
+    first = asyncio.run(collect())
+    assert len(first) == len(body)
+    assert b'x' * 50 in first
+    # Cada tentativa (retry após 429) começa do início
+    assert asyncio.run(collect()) == first
+
+def test_image_is_prepared_and_encoded_outside_the_event_loop(monkeypatch):
+    monkeypatch.setattr(core, 'result_cache', RecordingCache())
+    threads = []
+
+    def prepare_image_messages(media, content_type, prompt):
+        threads.append(threading.current_thread())
+        raise RuntimeError('parou aqui')
+
+    monkeypatch.setattr(core, 'prepare_image_messages', prepare_image_messages)
+    media = core.Media(200, 'image/jpeg')
+    media.write(b'\xff\xd8')
+    try:
+        asyncio.run(asgi.describe_image(media, 'image/jpeg'))
+    except RuntimeError:
+        pass
+    assert threads and threading.main_thread() not in threads
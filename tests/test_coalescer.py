@@ -0,0 +1,121 @@
+import time
+
+import pytest
+
+import app as core
+
+CONFIG = {'account_id': 1, 'inbox_id': 2, 'source_id': 'abc'}
+
+@pytest.fixture
+def sent(monkeypatch):
+    sent = []
+
+    def send_coalesced(config, conversation_id, content, files):
+        sent.append((content, files))
+        return conversation_id, True
+
+    monkeypatch.setattr(core, 'send_coalesced', send_coalesced)
+    return sent
+
+def test_messages_keep_arrival_order_even_when_filled_out_of_order(sent):
+    coalescer = core.MessageCoalescer(0.2, 10)
+    first = coalescer.join(CONFIG, 42)
+    second = coalescer.join(CONFIG, 42)
+    # A segunda termina antes (ex.: texto depois de um áudio lento)
+    coalescer.fill(second, 'segunda')
+    time.sleep(0.3)
+    coalescer.fill(first, 'primeira', ('a.ogg', None, 'audio/ogg'))
+
+    conversation_id, success, content, count = coalescer.wait(first)
+    assert (conversation_id, success, count) == (42, True, 2)
+    assert content.index('1. primeira') < content.index('2. segunda')
+    assert (first.index, second.index) == (1, 2)
+    assert sent == [(content, [('a.ogg', None, 'audio/ogg')])]
+
+def test_single_message_is_sent_as_is(sent):
+    coalescer = core.MessageCoalescer(0.05, 10)
+    slot = coalescer.join(CONFIG, 42)
+    coalescer.fill(slot, 'oi')
+    assert coalescer.wait(slot) == (42, True, 'oi', 1)
+
+def test_cancelled_slot_does_not_hold_the_batch(sent):
+    coalescer = core.MessageCoalescer(0.05, 10)
+    failed = coalescer.join(CONFIG, 42)
+    ok = coalescer.join(CONFIG, 42)
+    coalescer.cancel(failed)
+    coalescer.fill(ok, 'oi')
+    assert coalescer.wait(ok) == (42, True, 'oi', 1)
+    assert failed.index is None and ok.index == 1
+
+def test_cancel_after_fill_keeps_the_message(sent):
+    coalescer = core.MessageCoalescer(0.05, 10)
+    slot = coalescer.join(CONFIG, 42)
+    coalescer.fill(slot, 'oi')
+    coalescer.cancel(slot)
+    assert coalescer.wait(slot)[2] == 'oi'
+
+def test_all_cancelled_sends_nothing(sent):
+    coalescer = core.MessageCoalescer(0.05, 10)
+    slot = coalescer.join(CONFIG, 42)
+    coalescer.cancel(slot)
+    assert coalescer.wait(slot) == (42, False, None, 0)
+    assert sent == []
+
+def test_max_messages_starts_a_new_batch_sent_after_the_first(sent):
+    coalescer = core.MessageCoalescer(0.1, 2)
+    slots = [coalescer.join(CONFIG, 42) for _ in range(3)]
+    assert slots[0].batch is slots[1].batch is not slots[2].batch
+    # O segundo grupo fica pronto antes, mas só é enviado depois do primeiro
+    coalescer.fill(slots[2], 'terceira')
+    time.sleep(0.2)
+    coalescer.fill(slots[0], 'primeira')
+    coalescer.fill(slots[1], 'segunda')
+    for slot in slots:
+        coalescer.wait(slot)
+    assert [content for content, _ in sent][1] == 'terceira'
+    assert 'primeira' in sent[0][0] and 'segunda' in sent[0][0]
+
+def test_conversations_are_not_mixed(sent):
+    coalescer = core.MessageCoalescer(0.05, 10)
+    a = coalescer.join(CONFIG, 1)
+    b = coalescer.join(CONFIG, 2)
+    coalescer.fill(a, 'a')
+    coalescer.fill(b, 'b')
+    assert coalescer.wait(a) == (1, True, 'a', 1)
+    assert coalescer.wait(b) == (2, True, 'b', 1)
+
+def test_sent_batches_release_previous_batches_and_files(sent):
+    coalescer = core.MessageCoalescer(0.01, 1)
+    slots = []
+    for i in range(30):
+        slot = coalescer.join(CONFIG, 42)
+        coalescer.fill(slot, f'm{i}', (f'{i}.jpg', object(), 'image/jpeg'))
+        slots.append(slot)
+    for slot in slots:
+        coalescer.wait(slot)
+    assert len(sent) == 30
+    assert all(slot.batch.previous is None and slot.files == [] for slot in slots)
+
+def test_async_sent_batches_release_previous_batches_and_files(monkeypatch):
+    import asyncio
+
+    import asgi
+
+    async def send_coalesced(config, conversation_id, content, files):
+        return conversation_id, True
+
+    monkeypatch.setattr(asgi, 'send_coalesced', send_coalesced)
+
+    async def run():
+        coalescer = asgi.AsyncMessageCoalescer(0.01, 1)
+        slots = []
+        for i in range(30):
+            slot = coalescer.join(CONFIG, 42)
+            coalescer.fill(slot, f'm{i}', (f'{i}.jpg', object(), 'image/jpeg'))
+            slots.append(slot)
+        for slot in slots:
+            await coalescer.wait(slot)
+        return slots
+
+    slots = asyncio.run(run())
+    assert all(slot.batch.previous is None and slot.files == [] for slot in slots)
@@ -0,0 +1,54 @@
+import io
+
+import pytest
+
+import app as core
+from bench.fakes import text_pdf
+
+def test_text_stops_at_max_chars():
+    assert core.extract_document_text(io.BytesIO(b'a' * 200), 'text/plain', '', 50) == 'a' * 50
+
+def test_text_is_read_incrementally(monkeypatch):
+    monkeypatch.setattr(core, 'DOCUMENT_TEXT_READ_SIZE', 8)
+    stream = io.BytesIO('ação '.encode('utf-8') * 1000)
+    text = core.extract_document_text(stream, 'text/plain', '', 20)
+    assert text == ('ação ' * 4)
+    assert stream.tell() < 100
+
+def test_multibyte_characters_split_across_blocks(monkeypatch):
+    monkeypatch.setattr(core, 'DOCUMENT_TEXT_READ_SIZE', 3)
+    content = 'coração\nmaçã'
+    assert core.extract_document_text(io.BytesIO(content.encode('utf-8')), 'text/plain') == content
+
+def test_invalid_text_is_unsupported():
+    assert core.extract_document_text(io.BytesIO(b'\xff\xfe\xfa'), 'application/octet-stream') is None
+
+def test_small_pdf_goes_through_pool(monkeypatch):
+    submitted = []
+    pool = core.get_extraction_pool()
+    original = pool.submit
+    monkeypatch.setattr(pool, 'submit', lambda *args: submitted.append(args[2:4]) or original(*args))
+    text = core.extract_document_text(io.BytesIO(text_pdf(2)), 'application/pdf')
+    assert 'Pagina 1 linha 1' in text and 'Pagina 2 linha 1' in text
+    assert submitted == [(0, 2)]
+
+@pytest.mark.parametrize('value, expected', [
+    (50, 50),
+    ('50', 50),
+    (10 ** 9, core.DOCUMENT_MAX_CHARS),
+    (0, None),
+    (-5, None),
+    ('abc', None),
+    (None, None),
+    (1.5, None),
+    (True, None),
+    ([10], None),
+])
+def test_parse_max_chars(value, expected):
+    assert core.parse_max_chars(value) == expected
+
+def test_extraction_workers_do_not_import_the_service():
+    core.extract_document_text(io.BytesIO(text_pdf(1)), 'application/pdf')
+    modules = core.get_extraction_pool().submit(eval, "sorted(__import__('sys').modules)").result()
+    assert 'pdf_pages' in modules
+    assert not {'app', 'flask', 'openai', 'prometheus_client'} & set(modules)
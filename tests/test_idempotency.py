@@ -0,0 +1,83 @@
+import threading
+import time
+
+import pytest
+
+import app as core
+
+@pytest.fixture
+def store(tmp_path):
+    return core.IdempotencyStore(str(tmp_path / 'idempotency.sqlite3'))
+
+def test_success_is_replayed(store):
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return {'success': True, 'chatwoot_sent': True}, 200
+
+    assert store.run('k', compute) == ({'success': True, 'chatwoot_sent': True}, 200, False)
+    assert store.run('k', compute) == ({'success': True, 'chatwoot_sent': True}, 200, True)
+    assert len(calls) == 1
+
+@pytest.mark.parametrize('body, status', [
+    ({'success': False, 'error': 'Erro ao baixar arquivo: 404'}, 400),
+    ({'success': False, 'error': 'Arquivo excede o limite'}, 413),
+    ({'success': True, 'chatwoot_sent': False}, 200),
+    ({'success': False, 'error': 'Erro interno'}, 500),
+])
+def test_failures_are_not_replayed(store, body, status):
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return body, status
+
+    store.run('k', compute)
+    _, _, replayed = store.run('k', compute)
+    assert not replayed
+    assert len(calls) == 2
+
+def test_concurrent_duplicates_join_the_running_call(store):
+    calls = []
+    results = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.2)
+        return {'success': True}, 200
+
+    threads = [threading.Thread(target=lambda: results.append(store.run('k', compute))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert sorted(replayed for _, _, replayed in results) == [False, True, True, True, True]
+
+def test_duplicates_rerun_after_a_failed_leader(store):
+    calls = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.1)
+        return {'success': True, 'chatwoot_sent': len(calls) > 1}, 200
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(store.run('k', compute))) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 2
+    assert {body['chatwoot_sent'] for body, _, _ in results} == {False, True}
+
+def test_exception_releases_the_key(store):
+    def fail():
+        raise RuntimeError('falhou')
+
+    with pytest.raises(RuntimeError):
+        store.run('k', fail)
+    assert store.acquire('k') == ('leader', None)
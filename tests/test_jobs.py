@@ -0,0 +1,98 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import app as core
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return False
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'jobs.sqlite3')
+
+def test_queued_jobs_resume_when_the_queue_starts(db_path, monkeypatch):
+    monkeypatch.setattr(core, 'process_and_send_pipeline', lambda data, **kwargs: ({'success': True, 'n': data['n']}, 200))
+    job_id = core.JobQueue(db_path, 1).enqueue('process-and-send', {'n': 1})
+
+    queue = core.JobQueue(db_path, 1)
+    queue.start()
+    assert wait_for(lambda: queue.get(job_id)['status'] == 'done')
+    assert queue.get(job_id)['result'] == {'success': True, 'n': 1}
+
+def test_worker_survives_errors_outside_the_pipeline(db_path, monkeypatch):
+    monkeypatch.setattr(core, 'process_and_send_pipeline', lambda data, **kwargs: ({'success': True}, 200))
+
+    def broken_callback(*args, **kwargs):
+        raise ValueError('callback quebrado')
+
+    monkeypatch.setattr(core, 'http_request', broken_callback)
+    queue = core.JobQueue(db_path, 1)
+    original_purge = queue._purge
+    failures = iter([core.sqlite3.OperationalError('database is locked')])
+
+    def flaky_purge():
+        failure = next(failures, None)
+        if failure:
+            raise failure
+        original_purge()
+
+    queue._purge = flaky_purge
+    queue.start()
+    first = queue.enqueue('process-and-send', {'callback_url': 'http://callback.invalid'})
+    second = queue.enqueue('process-and-send', {})
+    assert wait_for(lambda: queue.get(second)['status'] == 'done')
+    assert queue.get(first)['status'] == 'done'
+
+def test_lease_is_renewed_while_the_job_runs(db_path, monkeypatch):
+    monkeypatch.setattr(core, 'JOB_LEASE_SECONDS', 0.6)
+    release = threading.Event()
+    calls = []
+
+    def slow_pipeline(data, **kwargs):
+        calls.append(1)
+        release.wait(5)
+        return {'success': True}, 200
+
+    monkeypatch.setattr(core, 'process_and_send_pipeline', slow_pipeline)
+    first = core.JobQueue(db_path, 1)
+    first.start()
+    job_id = first.enqueue('process-and-send', {})
+    assert wait_for(lambda: calls)
+
+    # Outro worker procurando jobs depois de vários leases não pode pegar o mesmo job
+    time.sleep(1.5)
+    assert core.JobQueue(db_path, 1)._claim() is None
+    release.set()
+    assert wait_for(lambda: first.get(job_id)['status'] == 'done')
+    assert len(calls) == 1
+
+def test_expired_lease_is_reclaimed(db_path, monkeypatch):
+    monkeypatch.setattr(core, 'JOB_LEASE_SECONDS', 0.2)
+    queue = core.JobQueue(db_path, 1)
+    job_id = queue.enqueue('process-and-send', {'n': 1})
+    assert queue._claim()[0] == job_id
+    time.sleep(0.3)
+    row = queue._claim()
+    assert row[0] == job_id and json.loads(row[2]) == {'n': 1}
+
+def test_importing_the_app_does_not_start_the_queue():
+    script = "import threading, app; print(any(t.name.startswith('job-') for t in threading.enumerate()))"
+    output = subprocess.run([sys.executable, '-c', script], cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    assert output.strip() == 'False'
+
+def test_child_processes_never_start_the_queue(monkeypatch):
+    monkeypatch.setattr(core.multiprocessing, 'parent_process', lambda: object())
+    assert core.start_job_queue() is None
@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+import app as core
+import asgi
+
+DATA = {
+    'message_type': 'audio',
+    'twilio_url': 'https://api.twilio.com/media/1',
+    'chatwoot': {'account_id': 1, 'conversation_id': 42},
+}
+
+def audio_media():
+    media = core.Media(200, 'audio/ogg')
+    media.write(b'OggS' + b'\0' * 100)
+    return media
+
+class Recorder:
+    def __init__(self, uploaded=True):
+        self.uploaded = uploaded
+        self.uploads = []
+        self.messages = []
+
+    def upload(self, config, conversation_id, files, content=None):
+        self.uploads.append(conversation_id)
+        return conversation_id, self.uploaded
+
+    def send(self, config, conversation_id, content):
+        self.messages.append(content)
+        return True
+
+def fail(*args, **kwargs):
+    raise core.OpenAIOverloaded(5)
+
+@pytest.fixture
+def recorder(monkeypatch):
+    monkeypatch.setattr(core, 'COALESCE_WINDOW_SECONDS', 0)
+    monkeypatch.setattr(core, 'fetch_media', lambda url, max_bytes=None: audio_media())
+    monkeypatch.setattr(core, 'transcribe_audio', fail)
+    return Recorder()
+
+def test_ai_failure_after_upload_sends_fallback(monkeypatch, recorder):
+    monkeypatch.setattr(core, 'upload_attachment', recorder.upload)
+    monkeypatch.setattr(core, 'send_to_chatwoot_existing', recorder.send)
+
+    body, status = core.process_and_send_pipeline(DATA, new_conversation=False)
+
+    assert status == 200 and body['success'] and body['attachment_sent']
+    assert body['processing_error']
+    assert recorder.uploads == [42]
+    assert recorder.messages == [core.FIXED_TEXTS['audio'] + core.PROCESSING_FALLBACK]
+    assert core.replayable(body, status)
+
+def test_ai_failure_without_upload_still_raises(monkeypatch, recorder):
+    recorder.uploaded = False
+    monkeypatch.setattr(core, 'upload_attachment', recorder.upload)
+    monkeypatch.setattr(core, 'send_to_chatwoot_existing', recorder.send)
+
+    with pytest.raises(core.OpenAIOverloaded):
+        core.process_and_send_pipeline(DATA, new_conversation=False)
+    assert recorder.messages == []
+
+def test_async_ai_failure_after_upload_sends_fallback(monkeypatch, recorder):
+    async def upload(*args):
+        return recorder.upload(*args)
+
+    async def send(*args):
+        return recorder.send(*args)
+
+    async def fetch(url, max_bytes=None):
+        return audio_media()
+
+    async def transcribe(*args):
+        fail()
+
+    monkeypatch.setattr(asgi, 'fetch_media', fetch)
+    monkeypatch.setattr(asgi, 'upload_attachment', upload)
+    monkeypatch.setattr(asgi, 'send_to_chatwoot_existing', send)
+    monkeypatch.setattr(asgi, 'transcribe_audio', transcribe)
+
+    body, status = asyncio.run(asgi.process_and_send_pipeline(DATA, new_conversation=False))
+
+    assert status == 200 and body['attachment_sent'] and body['processing_error']
+    assert recorder.messages == [core.FIXED_TEXTS['audio'] + core.PROCESSING_FALLBACK]
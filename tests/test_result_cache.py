@@ -0,0 +1,54 @@
+import sqlite3
+import time
+
+import app as core
+
+def test_disk_tier_is_shared_and_expires(tmp_path):
+    path = str(tmp_path / 'cache.sqlite3')
+    writer = core.ResultCache(1024, 60, path)
+    writer.set('k', 'valor')
+    reader = core.ResultCache(1024, 60, path)
+    assert reader.get('k') == 'valor'
+    assert reader.stats()['disk_hits'] == 1
+
+    expired = core.ResultCache(1024, -1, str(tmp_path / 'expired.sqlite3'))
+    expired.set('k', 'velho')
+    assert core.ResultCache(1024, 60, str(tmp_path / 'expired.sqlite3')).get('k') is None
+
+def test_expired_rows_are_purged_by_index_at_most_once_per_interval(tmp_path):
+    path = str(tmp_path / 'cache.sqlite3')
+    cache = core.ResultCache(1024, 60, path)
+    db = sqlite3.connect(path, isolation_level=None)
+    plan = ' '.join(row[-1] for row in db.execute('EXPLAIN QUERY PLAN DELETE FROM result_cache WHERE expires_at <= 1'))
+    assert 'result_cache_expires' in plan
+
+    def expire(key):
+        db.execute('INSERT INTO result_cache (key, value, expires_at) VALUES (?, ?, ?)', (key, 'x', time.time() - 1))
+
+    expire('old-1')
+    cache.set('a', '1')
+    expire('old-2')
+    # Dentro do intervalo a gravação não limpa de novo
+    cache.set('b', '2')
+    assert sorted(row[0] for row in db.execute('SELECT key FROM result_cache')) == ['a', 'b', 'old-2']
+    cache._next_purge = time.time() - 1
+    cache.set('c', '3')
+    assert sorted(row[0] for row in db.execute('SELECT key FROM result_cache')) == ['a', 'b', 'c']
+
+def test_image_cache_key_follows_preprocessing_settings(monkeypatch):
+    media = core.Media(200, 'image/jpeg')
+    media.write(b'imagem')
+    key = core.image_cache_key(media, 'Descreva', 1000)
+    assert core.image_cache_key(media, 'Descreva', 1000) == key
+    for name, value in [('IMAGE_MAX_DIMENSION', 768), ('IMAGE_FORMAT', 'WEBP'), ('IMAGE_QUALITY', 60), ('IMAGE_PREPROCESS', False)]:
+        with monkeypatch.context() as patched:
+            patched.setattr(core, name, value)
+            assert core.image_cache_key(media, 'Descreva', 1000) != key
+
+def test_idempotency_and_conversation_tables_are_indexed_by_expiry(tmp_path):
+    core.IdempotencyStore(str(tmp_path / 'idempotency.sqlite3'))
+    core.ConversationResolver(str(tmp_path / 'conversations.sqlite3'), 60)
+    for name, table in [('idempotency', 'idempotency'), ('conversations', 'conversations')]:
+        db = sqlite3.connect(str(tmp_path / f'{name}.sqlite3'))
+        plan = ' '.join(row[-1] for row in db.execute(f'EXPLAIN QUERY PLAN DELETE FROM {table} WHERE expires_at < 1'))
+        assert f'{table}_expires' in plan
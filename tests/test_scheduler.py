@@ -0,0 +1,146 @@
+import threading
+import time
+
+import pytest
+
+import app as core
+
+def waiter(tenant, tokens=10):
+    return core._Waiter(tenant, tokens)
+
+def test_admission_rejects_when_the_queue_is_full(monkeypatch):
+    monkeypatch.setattr(core, 'OPENAI_QUEUE_MAX', 3)
+    lane = core.ModelLane({'rpm': 60})
+    now = time.monotonic()
+    for tenant in 'abc':
+        lane.check_admission(tenant, now)
+        lane.enqueue(waiter(tenant))
+    with pytest.raises(core.OpenAIOverloaded):
+        lane.check_admission('d', now)
+
+def test_admission_limits_each_tenant(monkeypatch):
+    monkeypatch.setattr(core, 'OPENAI_TENANT_QUEUE_MAX', 2)
+    lane = core.ModelLane({'rpm': 60})
+    now = time.monotonic()
+    lane.enqueue(waiter('busy'))
+    lane.enqueue(waiter('busy'))
+    with pytest.raises(core.OpenAIOverloaded):
+        lane.check_admission('busy', now)
+    lane.check_admission('quiet', now)
+
+def test_admission_rejects_long_estimated_wait(monkeypatch):
+    monkeypatch.setattr(core, 'OPENAI_MAX_QUEUE_SECONDS', 5)
+    lane = core.ModelLane({'rpm': 60, 'tpm': 600})
+    now = time.monotonic()
+    lane.check_admission('a', now)
+    lane.enqueue(waiter('a', tokens=600))
+    lane.grant(lane.head(), now)
+    # Balde de tokens vazio: uma nova chamada de 600 tokens esperaria um minuto
+    lane.enqueue(waiter('a', tokens=600))
+    with pytest.raises(core.OpenAIOverloaded) as overloaded:
+        lane.check_admission('b', now)
+    assert overloaded.value.retry_after > 5
+
+def test_blocked_lane_reports_retry_after():
+    lane = core.ModelLane({'rpm': 60})
+    now = time.monotonic()
+    delay = lane.penalize({'retry-after': '40'}, 0, now)
+    assert delay == 40
+    with pytest.raises(core.OpenAIOverloaded) as overloaded:
+        lane.check_admission('a', now)
+    assert overloaded.value.retry_after == 40
+
+def test_tenants_are_served_round_robin():
+    lane = core.ModelLane({'rpm': 1000})
+    busy = [waiter('busy') for _ in range(4)]
+    for item in busy:
+        lane.enqueue(item)
+    quiet = waiter('quiet')
+    lane.enqueue(quiet)
+
+    order = []
+    now = time.monotonic()
+    while lane.head() is not None:
+        item = lane.head()
+        order.append(item.tenant)
+        lane.grant(item, now)
+    assert order == ['busy', 'quiet', 'busy', 'busy', 'busy']
+    assert lane.queued_tokens == 0
+
+def test_discard_removes_waiter_and_tokens():
+    lane = core.ModelLane({'rpm': 60, 'tpm': 1000})
+    first, second = waiter('a', 100), waiter('b', 200)
+    lane.enqueue(first)
+    lane.enqueue(second)
+    lane.discard(first)
+    assert lane.head() is second
+    assert lane.queued_tokens == 200 and 'a' not in lane.queues
+
+def test_scheduler_serves_quiet_tenant_before_the_backlog(monkeypatch):
+    # 60 rpm e balde vazio: uma liberação por segundo
+    scheduler = core.OpenAIScheduler({'m': {'rpm': 60}})
+    lane = scheduler.lane('m')
+    lane.requests.level = 0
+    lane.requests.updated = time.monotonic()
+    monkeypatch.setattr(lane.requests, 'capacity', 600.0)
+
+    served = []
+
+    def call(tenant):
+        scheduler._acquire(lane, waiter(tenant))
+        served.append(tenant)
+
+    threads = [threading.Thread(target=call, args=('busy',)) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    while lane.waiting < 3:
+        time.sleep(0.01)
+    quiet = threading.Thread(target=call, args=('quiet',))
+    quiet.start()
+    for thread in threads + [quiet]:
+        thread.join(5)
+    assert served.index('quiet') <= 1
+
+def throttled_scheduler():
+    # 600 rpm com o balde vazio: uma liberação a cada 0,1s
+    scheduler = core.OpenAIScheduler({'m': {'rpm': 600}})
+    lane = scheduler.lane('m')
+    lane.requests.level = 0
+    lane.requests.updated = time.monotonic()
+    return scheduler, lane
+
+@pytest.mark.parametrize('sync_first', [True, False])
+def test_async_and_thread_callers_share_one_queue(sync_first):
+    import asyncio
+
+    import asgi
+
+    scheduler, lane = throttled_scheduler()
+    served = []
+
+    def sync_call():
+        scheduler._acquire(lane, waiter('thread'))
+        served.append('thread')
+
+    async def run():
+        front = asgi.AsyncOpenAIScheduler(scheduler)
+        thread = threading.Thread(target=sync_call)
+        if sync_first:
+            thread.start()
+            while lane.waiting < 1:
+                await asyncio.sleep(0.01)
+        task = asyncio.create_task(front._acquire(lane, waiter('loop')))
+        if not sync_first:
+            while lane.waiting < 1:
+                await asyncio.sleep(0.01)
+            thread.start()
+        await asyncio.wait_for(task, 2)
+        served.append('loop')
+        await asyncio.to_thread(thread.join, 2)
+
+    started = time.monotonic()
+    asyncio.run(run())
+    assert sorted(served) == ['loop', 'thread']
+    # Duas liberações do mesmo balde: ~0,2s, não ~0,1s como em baldes separados
+    assert time.monotonic() - started >= 0.18
+    assert lane.waiting == 0
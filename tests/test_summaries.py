@@ -0,0 +1,35 @@
+import app as core
+
+def chars(tokens):
+    return tokens * core.CHARS_PER_TOKEN
+
+def test_split_keeps_short_text_in_one_chunk():
+    assert core.split_text_chunks("a\nb\nc", 5) == ["a\nb\nc"]
+
+def test_split_cuts_between_lines():
+    lines = ["x" * 8] * 5
+    chunks = core.split_text_chunks("\n".join(lines), 5)
+    assert chunks == ["x" * 8 + "\n" + "x" * 8] * 2 + ["x" * 8]
+    assert all(len(chunk) <= chars(5) for chunk in chunks)
+
+def test_split_long_line_keeps_order():
+    text = "first line\n" + "X" * 30 + "\nlast"
+    chunks = core.split_text_chunks(text, 5)
+    assert chunks == ["first line", "X" * 20, "X" * 10 + "\nlast"]
+    assert "".join(chunks).replace("\n", "") == text.replace("\n", "")
+
+def test_split_ignores_blank_tail():
+    assert core.split_text_chunks("abc\n\n", 5) == ["abc\n"]
+    assert core.split_text_chunks("", 5) == []
+
+def test_group_summaries_respects_budget(monkeypatch):
+    monkeypatch.setattr(core, 'SUMMARY_CHUNK_TOKENS', 5)
+    groups = core.group_summaries(["a" * 8, "b" * 8, "c" * 8, "d" * 8, "e" * 8])
+    assert groups == [["a" * 8, "b" * 8], ["c" * 8, "d" * 8], ["e" * 8]]
+
+def test_group_summaries_always_pairs_oversized(monkeypatch):
+    monkeypatch.setattr(core, 'SUMMARY_CHUNK_TOKENS', 1)
+    summaries = ["s%d" % i * 10 for i in range(5)]
+    groups = core.group_summaries(summaries)
+    assert [len(group) for group in groups] == [2, 2, 1]
+    assert [s for group in groups for s in group] == summaries
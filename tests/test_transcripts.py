@@ -0,0 +1,85 @@
+import pytest
+
+import app as core
+
+def test_stitch_removes_overlap():
+    texts = ["o cliente pediu o boleto de março", "boleto de março e também o de abril"]
+    assert core.stitch_transcripts(texts) == "o cliente pediu o boleto de março e também o de abril"
+
+def test_stitch_ignores_case_and_punctuation():
+    texts = ["vou mandar amanhã cedo.", "Amanhã cedo, sem falta"]
+    assert core.stitch_transcripts(texts) == "vou mandar amanhã cedo. sem falta"
+
+def test_stitch_keeps_single_word_repetition():
+    assert core.stitch_transcripts(["é", "é isso"]) == "é é isso"
+
+def test_stitch_without_overlap_and_empty_parts():
+    assert core.stitch_transcripts(["bom dia", "", "tudo bem"]) == "bom dia tudo bem"
+
+def large_audio(size):
+    media = core.Media(200, 'audio/ogg', max_bytes=size + 1)
+    media.write(b'\0' * size)
+    return media
+
+def test_audio_cap_is_raised_only_when_chunking_is_available(monkeypatch):
+    monkeypatch.setattr(core, 'AUDIO_CHUNKING_AVAILABLE', True)
+    assert core.audio_max_bytes() == max(core.AUDIO_MAX_BYTES, core.MEDIA_MAX_BYTES)
+    monkeypatch.setattr(core, 'AUDIO_CHUNKING_AVAILABLE', False)
+    assert core.audio_max_bytes() == core.MEDIA_MAX_BYTES
+
+def test_whisper_limit_applies_to_the_single_call(monkeypatch):
+    monkeypatch.setattr(core, 'WHISPER_MAX_BYTES', 1000)
+    monkeypatch.setattr(core, 'split_audio', lambda media, filename: None)
+    monkeypatch.setattr(core, '_whisper', lambda file: 'nunca chamado')
+    with large_audio(2000) as media, pytest.raises(core.MediaTooLarge):
+        core.transcribe_audio(media)
+
+def test_chunked_audio_skips_the_whisper_limit(monkeypatch):
+    monkeypatch.setattr(core, 'WHISPER_MAX_BYTES', 1000)
+    monkeypatch.setattr(core, 'split_audio', lambda media, filename: ['a', 'b'])
+    monkeypatch.setattr(core, '_whisper', lambda file: {'a': 'bom dia', 'b': 'tudo bem'}[file[1]])
+    with large_audio(2000) as media:
+        assert core.transcribe_audio(media) == 'bom dia tudo bem'
+
+def tone(seconds, volume=-10):
+    from pydub.generators import Sine
+
+    return Sine(440, sample_rate=core.AUDIO_SAMPLE_RATE).to_audio_segment(duration=seconds * 1000, volume=volume).set_channels(1)
+
+def silent(seconds):
+    from pydub import AudioSegment
+
+    return AudioSegment.silent(duration=seconds * 1000, frame_rate=core.AUDIO_SAMPLE_RATE)
+
+def test_trailing_silence_matches_reversed_detection():
+    from pydub import silence
+
+    audio = silent(1) + tone(3) + silent(2.5)
+    thresh = audio.dBFS - 16
+    assert abs(core._trailing_silence(audio, thresh) - silence.detect_leading_silence(audio.reverse(), silence_threshold=thresh)) <= 10
+
+def test_split_cuts_at_silences_and_trims_the_ends(monkeypatch):
+    audio = silent(2) + tone(8) + silent(1) + tone(8) + silent(1) + tone(5) + silent(3)
+    monkeypatch.setattr(core, 'AUDIO_CHUNKING_AVAILABLE', True)
+    monkeypatch.setattr(core, 'AUDIO_CHUNK_SECONDS', 10)
+    monkeypatch.setattr(core, 'AUDIO_CHUNK_OVERLAP_SECONDS', 0)
+    monkeypatch.setattr(core, '_decode_pcm', lambda media, filename: audio)
+
+    from pydub import AudioSegment
+
+    with large_audio(core.AUDIO_CHUNK_MIN_BYTES) as media:
+        chunks = [AudioSegment.from_wav(chunk) for chunk in core.split_audio(media)]
+    assert len(chunks) == 3
+    assert all(len(chunk) <= 10000 for chunk in chunks)
+    # Sem o silêncio das pontas: 8 + 1 + 8 + 1 + 5 segundos
+    assert abs(sum(len(chunk) for chunk in chunks) - 23000) < 100
+
+@pytest.mark.skipif(not core.shutil.which('ffmpeg'), reason='ffmpeg não instalado')
+def test_decoding_stops_at_the_duration_limit(monkeypatch, tmp_path):
+    path = tmp_path / 'long.wav'
+    tone(5).export(path, format='wav')
+    media = core.Media(200, 'audio/wav', max_bytes=10 ** 8)
+    media.write(path.read_bytes())
+    monkeypatch.setattr(core, 'AUDIO_MAX_SECONDS', 2)
+    with media, pytest.raises(core.AudioTooLong):
+        core._decode_pcm(media, 'audio.wav')
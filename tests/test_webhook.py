@@ -0,0 +1,40 @@
+import pytest
+from starlette.testclient import TestClient
+
+import app as core
+import asgi
+
+RESOLVED = {'event': 'conversation_status_changed', 'status': 'resolved', 'id': 7, 'account': {'id': 1}}
+
+@pytest.fixture
+def invalidated(monkeypatch):
+    calls = []
+
+    class Resolver:
+        def invalidate(self, *args):
+            calls.append(args)
+            return 1
+
+    monkeypatch.setattr(core, 'get_conversation_resolver', lambda: Resolver())
+    return calls
+
+def post(kind, query):
+    if kind == 'flask':
+        response = core.app.test_client().post(f'/chatwoot/webhook{query}', json=RESOLVED)
+        return response.status_code
+    return TestClient(asgi.app).post(f'/chatwoot/webhook{query}', json=RESOLVED).status_code
+
+@pytest.mark.parametrize('kind', ['flask', 'asgi'])
+def test_webhook_is_disabled_without_a_token(kind, monkeypatch, invalidated):
+    monkeypatch.setattr(core, 'CHATWOOT_WEBHOOK_TOKEN', None)
+    assert post(kind, '') == 503
+    assert invalidated == []
+
+@pytest.mark.parametrize('kind', ['flask', 'asgi'])
+def test_webhook_requires_the_configured_token(kind, monkeypatch, invalidated):
+    monkeypatch.setattr(core, 'CHATWOOT_WEBHOOK_TOKEN', 'segredo')
+    assert post(kind, '') == 401
+    assert post(kind, '?token=errado') == 401
+    assert invalidated == []
+    assert post(kind, '?token=segredo') == 200
+    assert len(invalidated) == 1